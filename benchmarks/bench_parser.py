@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Benchmark del parser dell'output di cloudflared su log registrati: righe/s del parser a passata singola
+contro la vecchia scansione con cinque regex più fallback per riga
+
+Uso: python benchmarks/bench_parser.py [--log tunnel-manager-data/cloudflared.log] [--repeat 200]
+
+Il log viene riprodotto così com'è (JSON, come con --output json) e convertito nel formato testo di
+cloudflared, più alcune righe di errore fisse; gli URL trovati dai due metodi devono coincidere e nessuna riga
+di errore deve diventare un URL.
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from cloudflared_parser import parse_line, match_tunnel_url, EVENT_URL, ERROR_LEVELS
+
+# Richiesta del quick tunnel fallita: citano l'API di trycloudflare.com, che non è l'URL del tunnel
+API_ERROR_JSON_LINES = [
+    '{"level":"error","time":"2025-05-27T16:52:06Z","error":"Post \\"https://api.trycloudflare.com/tunnel\\": dial tcp: i/o timeout","message":"failed to request quick Tunnel"}',
+]
+API_ERROR_TEXT_LINES = [
+    '2025-05-27T16:52:06Z ERR failed to request quick Tunnel: Post "https://api.trycloudflare.com/tunnel": dial tcp: i/o timeout',
+]
+
+# Copia della vecchia cattura (supervisor.py prima del parser): riferimento per velocità e risultati
+LEGACY_URL_PATTERNS = [
+    re.compile(r"INF Starting tunnel.*url=(https://[a-zA-Z0-9.-]+\.trycloudflare\.com)"),
+    re.compile(r"Connection [a-f0-9-]+ registered connIndex=\d+ ip=[0-9.]+ location=[\w\d]+.*URL: (https://[a-zA-Z0-9.-]+\.trycloudflare\.com)"),
+    re.compile(r"Your quick Tunnel has been created! Visit it at:\s*(https://[a-zA-Z0-9.-]+\.trycloudflare\.com)"),
+    re.compile(r"URL:\s*(https://[a-zA-Z0-9.-]+\.trycloudflare\.com)"),
+    re.compile(r"url=(https://[a-zA-Z0-9.-]+\.trycloudflare\.com)"),
+]
+LEGACY_GENERIC_URL_PATTERN = re.compile(r"(https://[a-zA-Z0-9.-]+\.trycloudflare\.com)")
+
+
+# Host esclusi; api.trycloudflare.com aggiunto qui come nel parser: il riferimento resta il risultato atteso
+LEGACY_EXCLUDED = ["website-terms", "developers.cloudflare", "://api.trycloudflare.com"]
+
+
+def legacy_match(line):
+    for pattern in LEGACY_URL_PATTERNS:
+        match = pattern.search(line)
+        if match and not any(bad in match.group(1) for bad in LEGACY_EXCLUDED):
+            return match.group(1)
+    match = LEGACY_GENERIC_URL_PATTERN.search(line)
+    if match and not any(bad in match.group(1) for bad in LEGACY_EXCLUDED):
+        return match.group(1)
+    return None
+
+
+def load_corpus(path):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        json_lines = [line.rstrip('\r\n') for line in f if line.strip()]
+    # Stesse righe nel formato testo ("<time> INF messaggio chiave=valore"), come senza --output json
+    text_lines = [parse_line(line).text for line in json_lines]
+    return json_lines + API_ERROR_JSON_LINES, text_lines + API_ERROR_TEXT_LINES
+
+
+def run(lines, repeat, func):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for line in lines:
+            func(line)
+    return time.perf_counter() - started
+
+
+def bench(lines, repeat):
+    total = len(lines) * repeat
+    legacy_seconds = run(lines, repeat, legacy_match)
+    match_seconds = run(lines, repeat, match_tunnel_url)
+    parser_seconds = run(lines, repeat, parse_line)
+    events = [parse_line(line) for line in lines]
+    legacy_urls = [url for url in map(legacy_match, lines) if url]
+    parser_urls = [event.url for event in events if event.url]
+    return {
+        'lines': len(lines),
+        'legacy_lines_per_second': round(total / legacy_seconds),
+        # Solo ricerca dell'URL (prefiltro + regex combinata): confronto diretto con la vecchia cattura
+        'url_match_lines_per_second': round(total / match_seconds),
+        # Il parser fa più lavoro (decodifica completa, livelli, tipo di evento), la vecchia cattura solo l'URL
+        'parser_lines_per_second': round(total / parser_seconds),
+        'events': dict(collections.Counter(event.kind for event in events)),
+        'urls_found': len(parser_urls),
+        'urls_match_legacy': parser_urls == legacy_urls,
+        'error_lines_as_url': sum(1 for event in events if event.level in ERROR_LEVELS and event.kind == EVENT_URL),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--log', default=os.path.join(ROOT, 'tunnel-manager-data', 'cloudflared.log'))
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    json_lines, text_lines = load_corpus(args.log)
+    result = {
+        'benchmark': 'cloudflared_parser',
+        'log': os.path.relpath(args.log, ROOT),
+        'repeat': args.repeat,
+        'json': bench(json_lines, args.repeat),
+        'text': bench(text_lines, args.repeat),
+    }
+    print(json.dumps(result, indent=2))
+    if not all(result[form]['urls_match_legacy'] and not result[form]['error_lines_as_url'] for form in ('json', 'text')):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
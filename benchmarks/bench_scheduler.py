@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Benchmark dello scheduler scadenze con orologio virtuale: min-heap contro la scansione completa ogni 30 s
+
+Uso: python benchmarks/bench_scheduler.py [--tunnels 10000] [--extend-ratio 0.2]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scheduler import DeadlineScheduler
+
+SCAN_INTERVAL_SECONDS = 30
+HORIZON_SECONDS = 48 * 3600
+
+
+class VirtualClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def make_workload(tunnels, extend_ratio, seed):
+    rng = random.Random(seed)
+    expirations = {f"svc-{i}": rng.uniform(60, HORIZON_SECONDS) for i in range(tunnels)}
+    # Estensioni: (istante dell'estensione, nome, nuova scadenza)
+    extensions = []
+    for name in rng.sample(sorted(expirations), int(tunnels * extend_ratio)):
+        at = rng.uniform(0, expirations[name])
+        extensions.append((at, name, at + rng.uniform(60, HORIZON_SECONDS)))
+    extensions.sort()
+    return expirations, extensions
+
+
+def bench_heap(expirations, extensions):
+    clock = VirtualClock()
+    scheduler = DeadlineScheduler(clock=clock)
+    fired = {}
+    current = dict(expirations)
+
+    def expire(name, deadline):
+        fired[name] = clock.now - deadline
+
+    started = time.perf_counter()
+    for name, deadline in expirations.items():
+        scheduler.schedule((name, 'expire'), deadline, expire, name, deadline)
+    schedule_seconds = time.perf_counter() - started
+
+    wakeups = 0
+    ext_index = 0
+    started = time.perf_counter()
+    while True:
+        next_deadline = scheduler.next_deadline()
+        next_extension = extensions[ext_index][0] if ext_index < len(extensions) else None
+        if next_deadline is None and next_extension is None:
+            break
+        if next_extension is not None and (next_deadline is None or next_extension < next_deadline):
+            clock.now, name, new_deadline = extensions[ext_index]
+            ext_index += 1
+            if name not in fired:
+                current[name] = new_deadline
+                scheduler.schedule((name, 'expire'), new_deadline, expire, name, new_deadline)
+            continue
+        # Il thread reale dorme esattamente fino alla prossima scadenza
+        clock.now = next_deadline
+        wakeups += 1
+        for _, action, args in scheduler.pop_due():
+            action(*args)
+    run_seconds = time.perf_counter() - started
+    lateness = list(fired.values())
+    return {
+        'schedule_all_seconds': round(schedule_seconds, 6),
+        'run_seconds': round(run_seconds, 6),
+        'wakeups': wakeups,
+        'entries_examined': len(expirations) + len(extensions),
+        'expired': len(fired),
+        'max_lateness_seconds': round(max(lateness), 3),
+        'avg_lateness_seconds': round(sum(lateness) / len(lateness), 3),
+    }
+
+
+def bench_scan(expirations, extensions):
+    # Riproduce il vecchio controllore: ogni 30 s scorre tutti i tunnel ancora attivi
+    current = dict(expirations)
+    fired = {}
+    examined = 0
+    wakeups = 0
+    ext_index = 0
+    now = 0.0
+    started = time.perf_counter()
+    while current:
+        now += SCAN_INTERVAL_SECONDS
+        while ext_index < len(extensions) and extensions[ext_index][0] <= now:
+            _, name, new_deadline = extensions[ext_index]
+            ext_index += 1
+            if name in current:
+                current[name] = new_deadline
+        wakeups += 1
+        for name in list(current):
+            examined += 1
+            if current[name] <= now:
+                fired[name] = now - current.pop(name)
+    run_seconds = time.perf_counter() - started
+    lateness = list(fired.values())
+    return {
+        'run_seconds': round(run_seconds, 6),
+        'wakeups': wakeups,
+        'entries_examined': examined,
+        'expired': len(fired),
+        'max_lateness_seconds': round(max(lateness), 3),
+        'avg_lateness_seconds': round(sum(lateness) / len(lateness), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tunnels', type=int, default=10000)
+    parser.add_argument('--extend-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    expirations, extensions = make_workload(args.tunnels, args.extend_ratio, args.seed)
+    result = {
+        'benchmark': 'scheduler',
+        'tunnels': args.tunnels,
+        'extensions': len(extensions),
+        'simulated_hours': round(max([*expirations.values(), *(e[2] for e in extensions)]) / 3600, 1),
+        'heap': bench_heap(expirations, extensions),
+        'scan_30s': bench_scan(expirations, extensions),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Benchmark della serializzazione di /api/status e /api/debug: byte e tempo di codifica con il vecchio jsonify
+(chiavi ordinate), l'encoder compatto (orjson se installato), ?fields= della pagina web e compressione gzip/brotli
+
+Uso: python benchmarks/bench_serialization.py [--services 1000] [--repeat 50]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from response_encoding import dumps, compress, parse_fields, select_fields, orjson, brotli, ALWAYS_INCLUDED_FIELDS
+
+# Campi richiesti da templates/universal.html
+UI_FIELDS = ('local_ip,default_tunnel_duration_hours,services.name,services.image,services.status,services.ports,'
+             'active_tunnels.service_name,active_tunnels.url,active_tunnels.port,active_tunnels.is_running,'
+             'active_tunnels.expiration_time')
+DEBUG_FIELDS = 'active_tunnels_count,active_tunnels_details.*.url,active_tunnels_details.*.is_running'
+
+
+def make_payloads(services, seed):
+    rng = random.Random(seed)
+    now = time.time()
+    probe = lambda url: {'url': url, 'up': True, 'status_code': 200, 'last_error': None, 'last_check': now,
+                         'consecutive_failures': 0, 'latency_p50_ms': round(rng.uniform(1, 80), 1),
+                         'latency_p95_ms': round(rng.uniform(80, 300), 1), 'latency_last_ms': round(rng.uniform(1, 300), 1)}
+    status = {'version': 123456, 'local_ip': '172.17.0.1', 'default_tunnel_duration_hours': 6,
+              'services': [], 'active_tunnels': []}
+    for i in range(services):
+        name = f"svc-{i:04d}"
+        status['services'].append({'name': name, 'status': f"Up {rng.randint(1, 48)} hours",
+                                   'ports': sorted(rng.sample(range(3000, 9000), rng.randint(1, 3))),
+                                   'image': f"registry.example.com/team/{name}:latest"})
+        url = f"https://{name}-{rng.getrandbits(48):012x}.trycloudflare.com"
+        local_url = f"http://172.17.0.1:{rng.randint(3000, 9000)}"
+        expiration = now + rng.uniform(60, 6 * 3600)
+        status['active_tunnels'].append({
+            'service_name': name, 'url': url, 'port': rng.randint(3000, 9000), 'local_url': local_url,
+            'is_running': True, 'profile': 'default', 'expiration_time': expiration,
+            'time_remaining_seconds': expiration - now, 'origin_up': True, 'public_up': True,
+            'probe': {'origin': probe(local_url), 'public': probe(url)}
+        })
+    debug = {
+        'registry_version': 4242, 'active_tunnels_count': services,
+        'active_tunnels_details': {
+            tunnel['service_name']: {'url': tunnel['url'], 'port': tunnel['port'], 'is_running': True,
+                                     'edge_connections': 4, 'last_error': None, 'rate_limited': False,
+                                     'expiration': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(tunnel['expiration_time']))}
+            for tunnel in status['active_tunnels']
+        },
+        'tunnel_pool': {'size': 4, 'ready': 4, 'hits': 120, 'misses': 3},
+        'docker_inventory': {'services_count': services, 'last_sync_time': now, 'events_received': 981},
+        'web_worker_pid': os.getpid()
+    }
+    return status, debug
+
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - started) / repeat * 1000
+
+
+def bench(payload, fields, always, repeat):
+    # Vecchio jsonify di Flask fuori dal debug: compatto ma con le chiavi ordinate
+    legacy, legacy_ms = timed(lambda: json.dumps(payload, separators=(',', ':'), sort_keys=True).encode(), repeat)
+    compact, compact_ms = timed(lambda: dumps(payload), repeat)
+    selection = parse_fields(fields)
+    selected, selected_ms = timed(lambda: dumps(select_fields(payload, selection, always)), repeat)
+    result = {
+        'legacy': {'bytes': len(legacy), 'encode_ms': round(legacy_ms, 3)},
+        'compact': {'bytes': len(compact), 'encode_ms': round(compact_ms, 3)},
+        # Tempo di selezione più codifica
+        'fields': {'bytes': len(selected), 'encode_ms': round(selected_ms, 3)},
+    }
+    for encoding in ('gzip', 'br') if brotli else ('gzip',):
+        for name in ('compact', 'fields'):
+            body = compact if name == 'compact' else selected
+            compressed, compress_ms = timed(lambda: compress(body, encoding), repeat)
+            result[f"{name}+{encoding}"] = {'bytes': len(compressed), 'encode_ms': round(result[name]['encode_ms'] + compress_ms, 3)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--services', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    status, debug = make_payloads(args.services, args.seed)
+    result = {
+        'benchmark': 'serialization',
+        'services': args.services,
+        'encoder': 'orjson' if orjson else 'json',
+        'brotli': bool(brotli),
+        'status': bench(status, UI_FIELDS, ALWAYS_INCLUDED_FIELDS, args.repeat),
+        'debug': bench(debug, DEBUG_FIELDS, (), args.repeat),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Finto Docker Engine API su socket UNIX per i test di carico: N container con una porta pubblicata ciascuno
+e, opzionalmente, eventi start/stop periodici
+
+Uso: python benchmarks/fakes/docker_engine.py /tmp/fake-docker.sock [--containers 1000] [--churn-seconds 0]
+Il manager lo usa con DOCKER_HOST=unix:///tmp/fake-docker.sock
+"""
+
+import argparse
+import http.server
+import itertools
+import json
+import os
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+
+BASE_PORT = 20000
+
+
+class FakeEngine:
+    def __init__(self, containers, churn_seconds=0, seed=42):
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.containers = {}
+        for i in range(containers):
+            container_id = f"{i:064x}"
+            self.containers[container_id] = {
+                'Id': container_id, 'Names': [f"/svc-{i:04d}"], 'Image': "fake/service:latest", 'State': 'running',
+                'Status': "Up 1 hour",
+                'Ports': [{'IP': '0.0.0.0', 'PrivatePort': 80, 'PublicPort': BASE_PORT + i, 'Type': 'tcp'}]
+            }
+        self.events = []   # [(seq, evento)]
+        self.sequence = itertools.count(1)
+        self.churn_seconds = churn_seconds
+        self.random = random.Random(seed)
+
+    def list(self, filters):
+        with self.lock:
+            containers = list(self.containers.values())
+        ids = set(filters.get('id', [])) if filters else None
+        if ids:
+            containers = [c for c in containers if c['Id'] in ids]
+        return containers
+
+    def churn(self):
+        # Un container a caso si ferma o riparte: il manager riceve l'evento e aggiorna l'inventario
+        while True:
+            time.sleep(self.churn_seconds)
+            with self.cond:
+                container = self.random.choice(list(self.containers.values()))
+                running = container['State'] == 'running'
+                container['State'], container['Status'] = ('exited', "Exited (0) 1 second ago") if running else ('running', "Up 1 second")
+                container['Ports'] = [] if running else [{'IP': '0.0.0.0', 'PrivatePort': 80, 'Type': 'tcp',
+                                                          'PublicPort': BASE_PORT + int(container['Id'], 16)}]
+                event = {'Type': 'container', 'Action': 'die' if running else 'start', 'id': container['Id'],
+                         'Actor': {'ID': container['Id']}, 'time': int(time.time())}
+                self.events.append((next(self.sequence), event))
+                del self.events[:-100]
+                self.cond.notify_all()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    engine = None
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self):
+        return "unix"
+
+    def send_body(self, body, content_type='application/json', status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path.split('/', 2)[-1] if url.path.startswith('/v1.') else url.path.lstrip('/')
+        query = urllib.parse.parse_qs(url.query)
+        if path == '_ping':
+            self.send_body(b"OK", 'text/plain')
+        elif path == 'version':
+            self.send_body(json.dumps({'Version': "fake", 'ApiVersion': "1.41"}).encode())
+        elif path == 'containers/json':
+            filters = json.loads(query['filters'][0]) if 'filters' in query else None
+            self.send_body(json.dumps(self.engine.list(filters)).encode())
+        elif path == 'events':
+            self.stream_events()
+        else:
+            self.send_body(json.dumps({'message': f"page not found: {url.path}"}).encode(), status=404)
+
+    def stream_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.flush()
+        engine = self.engine
+        with engine.cond:
+            last = engine.events[-1][0] if engine.events else 0
+        try:
+            while True:
+                with engine.cond:
+                    engine.cond.wait_for(lambda: engine.events and engine.events[-1][0] > last, timeout=30)
+                    pending = [(seq, event) for seq, event in engine.events if seq > last]
+                for seq, event in pending:
+                    chunk = (json.dumps(event) + "\n").encode()
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    last = seq
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('socket')
+    parser.add_argument('--containers', type=int, default=100)
+    parser.add_argument('--churn-seconds', type=float, default=0, help="intervallo tra due eventi start/stop (0 = nessuno)")
+    args = parser.parse_args()
+
+    Handler.engine = engine = FakeEngine(args.containers, args.churn_seconds)
+    if engine.churn_seconds > 0:
+        threading.Thread(target=engine.churn, daemon=True).start()
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = Server(args.socket, Handler)
+    print(f"Finto Docker Engine su {args.socket} con {args.containers} container", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Finto endpoint --metrics di cloudflared: le famiglie principali di cloudflared (richieste, errori, codici di
+risposta, connessioni HA, latenza di connessione all'origine, località dell'edge) più qualche metrica del
+runtime Go, con contatori che crescono a ogni lettura come con traffico reale
+
+Uso: python benchmarks/fakes/metrics_server.py 127.0.0.1:20241 [--parent PID] [--chunked]
+Avviato da benchmarks/fakes/cloudflared con FAKE_CLOUDFLARED_METRICS=1; termina insieme al processo --parent.
+"""
+
+import argparse
+import http.server
+import os
+import random
+import threading
+import time
+
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class FakeTunnelTraffic:
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.codes = {'200': 0, '304': 0, '404': 0, '502': 0}
+        self.latencies = []
+        self.started = time.time()
+
+    def advance(self):
+        with self.lock:
+            for _ in range(self.rng.randint(0, 20)):
+                self.requests += 1
+                code = self.rng.choices(list(self.codes), weights=(85, 8, 5, 2))[0]
+                self.codes[code] += 1
+                if code == '502':
+                    self.errors += 1
+                self.latencies.append(self.rng.uniform(0.5, 40))
+
+    def render(self):
+        self.advance()
+        with self.lock:
+            lines = [
+                "# HELP go_goroutines Number of goroutines that currently exist.",
+                "# TYPE go_goroutines gauge",
+                f"go_goroutines {self.rng.randint(40, 60)}",
+                "# HELP cloudflared_tunnel_ha_connections Number of active ha connections",
+                "# TYPE cloudflared_tunnel_ha_connections gauge",
+                "cloudflared_tunnel_ha_connections 4",
+                "# HELP cloudflared_tunnel_server_locations Where each tunnel is connected to. 1 means current location, 0 means previous locations.",
+                "# TYPE cloudflared_tunnel_server_locations gauge",
+            ]
+            lines += [f'cloudflared_tunnel_server_locations{{connection_id="{i}",edge_location="{location}"}} 1'
+                      for i, location in enumerate(("mxp01", "fra08", "mxp02", "fra10"))]
+            if self.requests: # Come cloudflared: le famiglie delle richieste compaiono dopo la prima
+                lines += [
+                    "# HELP cloudflared_tunnel_total_requests Amount of requests proxied through all the tunnels",
+                    "# TYPE cloudflared_tunnel_total_requests counter",
+                    f"cloudflared_tunnel_total_requests {self.requests}",
+                    "# HELP cloudflared_tunnel_request_errors Amount of errors due to proxying",
+                    "# TYPE cloudflared_tunnel_request_errors counter",
+                    f"cloudflared_tunnel_request_errors {self.errors}",
+                    "# HELP cloudflared_tunnel_concurrent_requests_per_tunnel Concurrent requests proxied through each tunnel",
+                    "# TYPE cloudflared_tunnel_concurrent_requests_per_tunnel gauge",
+                    f"cloudflared_tunnel_concurrent_requests_per_tunnel {self.rng.randint(0, 5)}",
+                    "# HELP cloudflared_tunnel_response_by_code Count of responses by HTTP status code",
+                    "# TYPE cloudflared_tunnel_response_by_code counter",
+                ]
+                lines += [f'cloudflared_tunnel_response_by_code{{status_code="{code}"}} {count}'
+                          for code, count in self.codes.items() if count]
+                lines += [
+                    "# HELP cloudflared_proxy_connect_latency Time it takes to establish and acknowledge connections in milliseconds",
+                    "# TYPE cloudflared_proxy_connect_latency histogram",
+                ]
+                lines += [f'cloudflared_proxy_connect_latency_bucket{{le="{bound}"}} {sum(1 for v in self.latencies if v <= bound)}'
+                          for bound in LATENCY_BUCKETS_MS]
+                lines += [f'cloudflared_proxy_connect_latency_bucket{{le="+Inf"}} {len(self.latencies)}',
+                          f"cloudflared_proxy_connect_latency_sum {sum(self.latencies)!r}",
+                          f"cloudflared_proxy_connect_latency_count {len(self.latencies)}"]
+        return "\n".join(lines) + "\n"
+
+
+def make_handler(traffic, chunked):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = traffic.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            if chunked: # Come promhttp con risposte grandi: nessuna Content-Length
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for start in range(0, len(body), 1024):
+                    chunk = body[start:start + 1024]
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.write(b"0\r\n\r\n")
+            else:
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def watch_parent(pid, server):
+    while True:
+        time.sleep(1)
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            server.shutdown()
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('address', help="host:porta, come --metrics di cloudflared")
+    parser.add_argument('--parent', type=int, help="PID del finto cloudflared: alla sua uscita il server termina")
+    parser.add_argument('--chunked', action='store_true', help="Risposte con Transfer-Encoding: chunked")
+    args = parser.parse_args()
+
+    host, _, port = args.address.rpartition(':')
+    server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)),
+                                             make_handler(FakeTunnelTraffic(args.parent or port), args.chunked))
+    server.daemon_threads = True
+    if args.parent:
+        threading.Thread(target=watch_parent, args=(args.parent, server), daemon=True).start()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Test di carico del manager con finti cloudflared e Docker: avvio a freddo, avvio in blocco, latenza di /api/status,
+memoria e thread per tunnel, durata di stop-all e dell'arresto a 10, 100 e 1000 tunnel
+
+Uso: python benchmarks/loadtest.py [--scales 10,100,1000] [--delay 0.5] [--output risultati.json]
+
+Ogni scala avvia un'istanza nuova di app.py (directory dati temporanea, porta dedicata) accanto a
+benchmarks/fakes/docker_engine.py; il finto cloudflared è benchmarks/fakes/cloudflared.
+I risultati sono scritti in JSON (default benchmarks/results/loadtest-<data>.json) per il confronto tra versioni.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKES = os.path.join(ROOT, 'benchmarks', 'fakes')
+BASE_PORT = 20000  # Porte pubblicate dal finto Docker Engine (vedi fakes/docker_engine.py)
+
+
+def http(method, url, payload=None, timeout=600):
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def wait_until(condition, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def resources(process):
+    with process.oneshot():
+        return {'rss_bytes': process.memory_info().rss, 'threads': process.num_threads(), 'fds': process.num_fds(),
+                'children': len(process.children(recursive=True))}
+
+
+class ManagerUnderTest:
+    """app.py e il finto Docker Engine in una directory temporanea."""
+
+    def __init__(self, tunnels, args):
+        self.tmp = tempfile.mkdtemp(prefix='tunnel-loadtest-')
+        self.socket = os.path.join(self.tmp, 'docker.sock')
+        self.base_url = f"http://127.0.0.1:{args.port}"
+        self.engine = subprocess.Popen(
+            [sys.executable, os.path.join(FAKES, 'docker_engine.py'), self.socket, '--containers', str(tunnels)],
+            stdout=subprocess.DEVNULL)
+        if not wait_until(lambda: os.path.exists(self.socket), 10):
+            raise RuntimeError("Il finto Docker Engine non si è avviato")
+        env = {
+            **os.environ,
+            'DOCKER_HOST': f"unix://{self.socket}",
+            'CLOUDFLARED_BIN': os.path.join(FAKES, 'cloudflared'),
+            'TUNNEL_MANAGER_DATA_DIR': os.path.join(self.tmp, 'data'),
+            'TUNNEL_MANAGER_PORT': str(args.port),
+            'LOCAL_IP': '127.0.0.1',
+            'FAKE_CLOUDFLARED_DELAY': str(args.delay),
+        }
+        self.log = open(os.path.join(self.tmp, 'app.log'), 'w')
+        self.app = subprocess.Popen([sys.executable, os.path.join(ROOT, 'app.py')], cwd=ROOT, env=env,
+                                    stdout=self.log, stderr=subprocess.STDOUT)
+        self.process = psutil.Process(self.app.pid)
+        if not wait_until(self.ready, 30, interval=0.2):
+            self.close()
+            raise RuntimeError(f"app.py non risponde su {self.base_url} (log in {self.log.name})")
+
+    def ready(self):
+        if self.app.poll() is not None:
+            raise RuntimeError(f"app.py terminato con codice {self.app.returncode}")
+        try:
+            return http('GET', self.base_url + '/api/ready', timeout=2)[0] == 200
+        except OSError:
+            return False
+
+    def startup(self):
+        """Fasi dell'avvio a freddo riportate da /api/ready."""
+        return json.loads(http('GET', self.base_url + '/api/ready')[1]).get('startup_seconds')
+
+    def start_batch(self, tunnels, concurrency):
+        items = [{'service_name': f"svc-{i:04d}", 'port': BASE_PORT + i, 'duration_hours': 1} for i in range(tunnels)]
+        started = time.perf_counter()
+        status, body = http('POST', self.base_url + '/api/start-tunnels',
+                            {'tunnels': items, 'concurrency': concurrency, 'wait_for_urls': True})
+        elapsed = time.perf_counter() - started
+        response = json.loads(body)
+        results = response.get('results', [])
+        return {
+            'http_status': status,
+            'request_seconds': round(elapsed, 3),
+            'started': sum(1 for result in results if result.get('success')),
+            'time_to_all_urls_seconds': response.get('time_to_all_urls_seconds'),
+            'tunnels_per_second': round(tunnels / elapsed, 1),
+        }
+
+    def status_latency(self, requests):
+        samples = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            status, _ = http('GET', self.base_url + '/api/status')
+            samples.append(time.perf_counter() - started)
+            if status != 200:
+                raise RuntimeError(f"/api/status ha risposto {status}")
+        return {
+            'requests': requests,
+            'p50_ms': round(percentile(samples, 0.5) * 1000, 2),
+            'p99_ms': round(percentile(samples, 0.99) * 1000, 2),
+            'max_ms': round(max(samples) * 1000, 2),
+        }
+
+    def stop_all(self, timeout=120):
+        started = time.perf_counter()
+        status, _ = http('POST', self.base_url + '/api/stop-all')
+        response_seconds = time.perf_counter() - started
+        # Lo stop risponde subito: si misura anche il tempo fino all'uscita dell'ultimo cloudflared
+        drained = wait_until(lambda: not self.process.children(recursive=True), timeout)
+        return {
+            'http_status': status,
+            'response_seconds': round(response_seconds, 3),
+            'all_exited_seconds': round(time.perf_counter() - started, 3) if drained else None,
+        }
+
+    def shutdown(self, timeout=60):
+        children = self.process.children(recursive=True)
+        started = time.perf_counter()
+        self.app.send_signal(signal.SIGTERM)
+        try:
+            returncode = self.app.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.app.kill()
+            returncode = None
+        seconds = time.perf_counter() - started
+        leftovers = [child for child in children if child.is_running() and child.status() != psutil.STATUS_ZOMBIE]
+        for child in leftovers:
+            child.kill()
+        return {'seconds': round(seconds, 3), 'exit_code': returncode, 'tunnels': len(children),
+                'leftover_processes': len(leftovers)}
+
+    def close(self):
+        for process in (self.app, self.engine):
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        self.log.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def run_scale(tunnels, args):
+    manager = ManagerUnderTest(tunnels, args)
+    try:
+        idle = resources(manager.process)
+        result = {'tunnels': tunnels, 'startup_seconds': manager.startup(),
+                  'start': manager.start_batch(tunnels, args.concurrency)}
+        loaded = resources(manager.process)
+        result['resources'] = {
+            'idle': idle,
+            'loaded': loaded,
+            'rss_bytes_per_tunnel': round((loaded['rss_bytes'] - idle['rss_bytes']) / tunnels),
+            'threads_per_tunnel': round((loaded['threads'] - idle['threads']) / tunnels, 3),
+            'fds_per_tunnel': round((loaded['fds'] - idle['fds']) / tunnels, 3),
+        }
+        result['status'] = manager.status_latency(args.status_requests)
+        result['stop_all'] = manager.stop_all()
+        # Arresto con tutti i tunnel attivi (SIGTERM, come docker stop)
+        manager.start_batch(tunnels, args.concurrency)
+        result['shutdown'] = manager.shutdown()
+        return result
+    finally:
+        manager.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scales', default='10,100,1000', help="numeri di tunnel separati da virgola")
+    parser.add_argument('--delay', type=float, default=0.5, help="secondi del finto cloudflared prima dell'URL")
+    parser.add_argument('--concurrency', type=int, default=32, help="avvii in parallelo per /api/start-tunnels")
+    parser.add_argument('--status-requests', type=int, default=200)
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--output', help="file JSON dei risultati")
+    args = parser.parse_args()
+
+    result = {
+        'benchmark': 'loadtest',
+        'version': git_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'settings': {'delay_seconds': args.delay, 'concurrency': args.concurrency, 'status_requests': args.status_requests},
+        'scales': [],
+    }
+    for tunnels in (int(value) for value in args.scales.split(',')):
+        print(f"Scala {tunnels} tunnel...", file=sys.stderr, flush=True)
+        result['scales'].append(run_scale(tunnels, args))
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"loadtest-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps(result, indent=2))
+    print(f"Risultati salvati in {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Metriche interne di cloudflared: ogni tunnel espone le sue metriche Prometheus su una porta locale (--metrics),
+lette a intervalli e in parallelo dentro il loop del supervisore su connessioni keep-alive riutilizzate, poi
+riesportate in /metrics con l'etichetta tunnel e riassunte per servizio in /api/cloudflared-metrics
+"""
+
+import collections
+import threading
+import asyncio
+import logging
+import socket
+import time
+import os
+
+METRICS_INTERVAL_SECONDS = float(os.environ.get('TUNNEL_METRICS_INTERVAL_SECONDS', 15))  # 0 = niente --metrics
+METRICS_TIMEOUT_SECONDS = float(os.environ.get('TUNNEL_METRICS_TIMEOUT_SECONDS', 2))
+METRICS_CONCURRENCY = int(os.environ.get('TUNNEL_METRICS_CONCURRENCY', 32))
+METRICS_HOST = '127.0.0.1'
+# Famiglie riesportate: le metriche del runtime Go (go_*, process_*) sono omesse
+EXPORTED_PREFIXES = ('cloudflared_', 'quic_client_')
+MAX_HEADER_LINES = 100
+MAX_BODY_BYTES = 8 * 1024 * 1024
+# Una porta assegnata resta riservata finché cloudflared non l'ha aperta (il bind su :0 la vede ancora libera)
+PORT_RESERVATION_SECONDS = 60
+
+_reserved_ports = {}  # {porta: istante dell'assegnazione}
+_reserved_ports_lock = threading.Lock()  # Avvii in parallelo (start_tunnels_batch, pool): mai la stessa porta a due tunnel
+
+
+def metrics_enabled():
+    return METRICS_INTERVAL_SECONDS > 0
+
+
+def allocate_metrics_port():
+    """Porta TCP libera su 127.0.0.1 per --metrics, mai assegnata due volte a breve distanza."""
+    with _reserved_ports_lock:
+        now = time.monotonic()
+        for port, allocated in list(_reserved_ports.items()):
+            if now - allocated > PORT_RESERVATION_SECONDS:
+                del _reserved_ports[port]
+        for _ in range(20):
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.bind((METRICS_HOST, 0))
+                port = sock.getsockname()[1]
+            if port not in _reserved_ports:
+                _reserved_ports[port] = now
+                return port
+    raise OSError("Nessuna porta libera per le metriche di cloudflared")
+
+
+def metrics_args(port):
+    return ["--metrics", f"{METRICS_HOST}:{port}"] if port else []
+
+
+def metrics_address(cmdline):
+    """(host, porta) di --metrics nella riga di comando di cloudflared, oppure None."""
+    value = None
+    for i, arg in enumerate(cmdline or ()):
+        if arg == '--metrics' and i + 1 < len(cmdline):
+            value = cmdline[i + 1]
+        elif arg.startswith('--metrics='):
+            value = arg[len('--metrics='):]
+    if not value:
+        return None
+    host, _, port = value.rpartition(':')
+    if not port.isdigit():
+        return None
+    return host.strip('[]') or METRICS_HOST, int(port)
+
+
+def parse_metrics_text(text):
+    """Formato testo di Prometheus -> {famiglia: {'type', 'help', 'samples': [(nome, etichette, testo etichette, valore)]}}.
+    Solo le famiglie di EXPORTED_PREFIXES; i campioni di un istogramma (_bucket, _sum, _count) restano nella famiglia."""
+    families = collections.OrderedDict()
+    meta = {}
+    for line in text.splitlines():
+        if not line:
+            continue
+        if line.startswith('#'):
+            parts = line.split(None, 3)
+            if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                meta.setdefault(parts[2], {})[parts[1].lower()] = parts[3] if len(parts) > 3 else ''
+            continue
+        name_end = line.find('{')
+        if name_end == -1:
+            name, _, rest = line.partition(' ')
+            label_text = ''
+        else:
+            name = line[:name_end]
+            label_end = line.rfind('}')
+            label_text, rest = line[name_end + 1:label_end], line[label_end + 1:]
+        if not name.startswith(EXPORTED_PREFIXES):
+            continue
+        try:
+            value = float(rest.split()[0])
+        except (IndexError, ValueError):
+            continue
+        family = name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if name.endswith(suffix) and name[:-len(suffix)] in meta:
+                family = name[:-len(suffix)]
+        entry = families.get(family)
+        if entry is None:
+            entry = families[family] = {'type': meta.get(family, {}).get('type', 'untyped'),
+                                         'help': meta.get(family, {}).get('help', ''), 'samples': []}
+        entry['samples'].append((name, parse_labels(label_text), label_text, value))
+    return families
+
+
+def parse_labels(label_text):
+    labels = {}
+    for pair in _split_labels(label_text):
+        key, _, value = pair.partition('=')
+        labels[key.strip()] = value.strip()[1:-1].replace('\\"', '"').replace('\\n', '\n').replace('\\\\', '\\')
+    return labels
+
+
+def _split_labels(label_text):
+    # Le virgole dentro i valori tra virgolette non separano le etichette
+    pairs, current, quoted, escaped = [], [], False, False
+    for char in label_text:
+        if char == ',' and not quoted:
+            pairs.append(''.join(current))
+            current = []
+            continue
+        current.append(char)
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+    if ''.join(current).strip():
+        pairs.append(''.join(current))
+    return pairs
+
+
+class TunnelMetrics:
+    def __init__(self, address):
+        self.address = address
+        self.families = {}
+        self.last_scrape = None
+        self.scrape_seconds = None
+        self.error = None
+
+    def total(self, sample_name, family=None):
+        """Somma dei campioni sample_name su tutte le etichette (es. le connessioni HA); None se assenti."""
+        samples = self.families.get(family or sample_name, {}).get('samples', ())
+        values = [value for name, _, _, value in samples if name == sample_name]
+        if not values:
+            return None
+        total = sum(values)
+        return int(total) if total.is_integer() else total
+
+    def summary(self):
+        responses = collections.Counter()
+        for name, labels, _, value in self.families.get('cloudflared_tunnel_response_by_code', {}).get('samples', ()):
+            responses[labels.get('status_code', '?')] += value
+        # Istogramma in millisecondi
+        latency_sum = self.total('cloudflared_proxy_connect_latency_sum', 'cloudflared_proxy_connect_latency')
+        latency_count = self.total('cloudflared_proxy_connect_latency_count', 'cloudflared_proxy_connect_latency')
+        # Prima della prima richiesta cloudflared non espone le famiglie dei contatori: zero, non "sconosciuto"
+        scraped = self.last_scrape is not None and self.error is None
+        return {
+            'metrics_address': f"{self.address[0]}:{self.address[1]}",
+            'requests_total': self.total('cloudflared_tunnel_total_requests') or (0 if scraped else None),
+            'request_errors_total': self.total('cloudflared_tunnel_request_errors') or (0 if scraped else None),
+            'concurrent_requests': self.total('cloudflared_tunnel_concurrent_requests_per_tunnel'),
+            'ha_connections': self.total('cloudflared_tunnel_ha_connections'),
+            'responses_by_code': {code: int(count) for code, count in sorted(responses.items())},
+            'origin_connect_latency_avg_ms': round(latency_sum / latency_count, 1) if latency_count else None,
+            'edge_locations': sorted({labels['edge_location'] for _, labels, _, _ in self.families.get(
+                'cloudflared_tunnel_server_locations', {}).get('samples', ()) if labels.get('edge_location')}),
+            'last_scrape': self.last_scrape,
+            'scrape_seconds': round(self.scrape_seconds, 4) if self.scrape_seconds is not None else None,
+            'error': self.error
+        }
+
+
+class CloudflaredMetricsScraper:
+    """targets() -> {nome tunnel: (host, porta)} degli endpoint --metrics; chiamata nel loop a ogni giro.
+    Registrabile nel registro di metrics.py: render() riesporta le serie con l'etichetta tunnel."""
+    name = 'cloudflared' # Chiave nel registro: lo scraper di un nuovo manager sostituisce il precedente
+
+    def __init__(self, supervisor, targets, interval=METRICS_INTERVAL_SECONDS, timeout=METRICS_TIMEOUT_SECONDS,
+                 concurrency=METRICS_CONCURRENCY):
+        self.supervisor = supervisor
+        self.targets = targets
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = max(1, concurrency)
+        self.tunnels = {}     # {nome tunnel: TunnelMetrics}
+        self._idle = {}       # {(host, porta): (reader, writer)} connessione keep-alive libera per endpoint
+        self._task = None
+        self.rounds = 0
+        self.last_round_seconds = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    # --- API sincrona ---
+
+    def start(self):
+        if self.enabled:
+            self._task = asyncio.run_coroutine_threadsafe(self._run(), self.supervisor.loop)
+            logging.info(f"Lettura metriche cloudflared attiva: ogni {self.interval}s, timeout {self.timeout}s, "
+                         f"{self.concurrency} tunnel in parallelo")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            try:
+                self.supervisor.call(self._close_idle(), timeout=2)
+            except Exception:
+                pass
+
+    def get(self, tunnel):
+        metrics = self.tunnels.get(tunnel)
+        return metrics.summary() if metrics else None
+
+    def summary(self):
+        """Riepilogo per servizio più i totali; letto dai thread di Flask senza lock (dati indicativi)."""
+        tunnels = {name: metrics.summary() for name, metrics in sorted(list(self.tunnels.items()))}
+        totals = {key: sum(summary[key] or 0 for summary in tunnels.values())
+                  for key in ('requests_total', 'request_errors_total', 'concurrent_requests', 'ha_connections')}
+        return {'interval_seconds': self.interval, 'last_round_seconds': self.last_round_seconds,
+                'totals': totals, 'tunnels': tunnels}
+
+    def render(self):
+        """Righe Prometheus: una famiglia per nome con i campioni di tutti i tunnel, etichetta tunnel in testa."""
+        merged = collections.OrderedDict()
+        for tunnel, metrics in sorted(list(self.tunnels.items())):
+            for family, entry in list(metrics.families.items()):
+                target = merged.setdefault(family, {'type': entry['type'], 'help': entry['help'], 'lines': []})
+                tunnel_label = 'tunnel="' + tunnel.replace('\\', '\\\\').replace('"', '\\"') + '"'
+                for name, _, label_text, value in entry['samples']:
+                    labels = f"{tunnel_label},{label_text}" if label_text else tunnel_label
+                    target['lines'].append(f"{name}{{{labels}}} {value!r}")
+        lines = []
+        for family, entry in merged.items():
+            lines.append(f"# HELP {family} {entry['help'] or 'Metrica di cloudflared'} (per tunnel)")
+            lines.append(f"# TYPE {family} {entry['type']}")
+            lines.extend(entry['lines'])
+        return lines
+
+    # --- Nel loop del supervisore ---
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.scrape_all()
+            except Exception as e:
+                logging.error(f"Metriche cloudflared: giro fallito: {e}", exc_info=True)
+            self.last_round_seconds = time.monotonic() - started
+            await asyncio.sleep(max(0, self.interval - self.last_round_seconds))
+
+    async def scrape_all(self):
+        targets = self.targets()
+        for name in list(self.tunnels):
+            if name not in targets or self.tunnels[name].address != targets[name]:
+                del self.tunnels[name]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(name, address):
+            async with semaphore:
+                await self._scrape(name, address)
+
+        # Budget fisso per l'intero giro: con molti tunnel lenti il giro non si sovrappone al successivo
+        tasks = [asyncio.ensure_future(bounded(name, address)) for name, address in targets.items()]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=max(self.timeout, self.interval))
+            for task in pending:
+                task.cancel()
+        await self._close_idle(set(targets.values()))
+        self.rounds += 1
+
+    async def _scrape(self, name, address):
+        metrics = self.tunnels.get(name)
+        if metrics is None:
+            metrics = self.tunnels[name] = TunnelMetrics(address)
+        started = time.monotonic()
+        try:
+            body = await asyncio.wait_for(self._get(address), self.timeout)
+            metrics.families = parse_metrics_text(body.decode('utf-8', 'replace'))
+        except asyncio.TimeoutError:
+            metrics.error = f"timeout dopo {self.timeout}s"
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            # Connessione rifiutata anche nei primi istanti, prima che cloudflared apra la porta
+            metrics.error = str(e) or e.__class__.__name__
+        else:
+            metrics.error = None
+            metrics.last_scrape = time.time()
+        metrics.scrape_seconds = time.monotonic() - started
+
+    async def _get(self, address):
+        """GET /metrics su una connessione keep-alive riutilizzata; restituisce il corpo."""
+        host, port = address
+        request = (f"GET /metrics HTTP/1.1\r\nHost: {host}:{port}\r\nUser-Agent: tunnel-manager-metrics\r\n"
+                   f"Accept: text/plain\r\nConnection: keep-alive\r\n\r\n").encode()
+        idle = self._idle.pop(address, None)
+        if idle:
+            try:
+                return await self._exchange(address, *idle, request)
+            except (OSError, asyncio.IncompleteReadError):
+                pass  # Chiusa da cloudflared nel frattempo: si riprova su una nuova
+        reader, writer = await asyncio.open_connection(host, port)
+        return await self._exchange(address, reader, writer, request)
+
+    async def _exchange(self, address, reader, writer, request):
+        reusable = False
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise asyncio.IncompleteReadError(b'', None)
+            version, status_code = status_line.decode('latin-1').split(' ', 2)[:2]
+            headers = {}
+            for _ in range(MAX_HEADER_LINES):
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip().lower()
+            if headers.get('transfer-encoding') == 'chunked':
+                body = await self._read_chunked(reader)
+            elif 'content-length' in headers:
+                length = int(headers['content-length'])
+                if length > MAX_BODY_BYTES:
+                    raise ValueError(f"risposta troppo grande: {length} byte")
+                body = await reader.readexactly(length)
+            else:
+                body = await reader.read(MAX_BODY_BYTES)
+                headers['connection'] = 'close'
+            if status_code != '200':
+                raise ValueError(f"HTTP {status_code}")
+            reusable = headers.get('connection') != 'close' and version == 'HTTP/1.1'
+            return body
+        finally:
+            if reusable:
+                self._idle[address] = (reader, writer)
+            else:
+                writer.close()
+
+    @staticmethod
+    async def _read_chunked(reader):
+        chunks, size = [], 0
+        while True:
+            length = int((await reader.readline()).split(b';')[0].strip() or b'0', 16)
+            if length == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''): # Trailer
+                    pass
+                return b''.join(chunks)
+            size += length
+            if size > MAX_BODY_BYTES:
+                raise ValueError(f"risposta oltre {MAX_BODY_BYTES} byte")
+            chunks.append(await reader.readexactly(length))
+            await reader.readline()
+
+    async def _close_idle(self, keep=None):
+        for address in list(self._idle):
+            if keep is None or address not in keep:
+                self._idle.pop(address)[1].close()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Parser a passata singola dell'output di cloudflared: ogni riga (JSON con --output json, oppure testo) viene
+decodificata una sola volta in un evento tipizzato
+"""
+
+import collections
+import json
+import os
+import re
+
+# Formato dei log richiesto a cloudflared: 'json' (--output json) oppure 'default' (testo, per versioni vecchie)
+CLOUDFLARED_OUTPUT = os.environ.get('CLOUDFLARED_OUTPUT', 'json').lower()
+
+EVENT_LOG = 'log'
+EVENT_URL = 'url'                    # URL del quick tunnel assegnato
+EVENT_CONNECTION = 'connection'      # Connessione all'edge registrata
+EVENT_ERROR = 'error'
+EVENT_RATE_LIMITED = 'rate_limited'  # trycloudflare.com ha risposto 429: troppi quick tunnel richiesti
+
+CloudflaredEvent = collections.namedtuple('CloudflaredEvent', ['kind', 'level', 'message', 'fields', 'url', 'label', 'text'])
+
+# api.trycloudflare.com è l'API che assegna i quick tunnel (compare negli errori di richiesta), mai l'URL di un tunnel
+URL_HOST = r"https://(?!api\.trycloudflare\.com\b)[a-zA-Z0-9.-]+\.trycloudflare\.com"
+# Pattern storici uniti in un'unica alternanza: il nome del gruppo che corrisponde è l'etichetta (stesso ordine di prima)
+URL_PATTERN = re.compile("|".join(f"(?:{context}(?P<p{i}>{URL_HOST}))" for i, context in enumerate([
+    r"INF Starting tunnel.*url=",
+    r"Connection [a-f0-9-]+ registered connIndex=\d+ ip=[0-9.]+ location=[\w\d]+.*URL: ",
+    r"Your quick Tunnel has been created! Visit it at:\s*",
+    r"URL:\s*",
+    r"url=",
+])))
+GENERIC_URL_PATTERN = re.compile(f"({URL_HOST})")  # Ultima spiaggia, es. la riga del riquadro "|  https://…  |"
+URL_PREFILTER = ".trycloudflare.com"
+
+# Livelli del formato testo ("2025-05-27T16:52:06Z INF messaggio chiave=valore") e nomi del formato JSON
+TEXT_LEVELS = {'DBG': 'debug', 'INF': 'info', 'WRN': 'warn', 'ERR': 'error', 'FTL': 'fatal'}
+LEVEL_TAGS = {level: tag for tag, level in TEXT_LEVELS.items()}
+ERROR_LEVELS = ('error', 'fatal', 'panic')
+CONNECTION_MESSAGES = ("Registered tunnel connection", "Connection registered")
+RATE_LIMIT_MARKERS = ("Too Many Requests", "error code: 1015", "rate limit")
+
+
+def match_tunnel_url(text):
+    """Restituisce (url, etichetta pattern) se il testo contiene l'URL del quick tunnel, altrimenti (None, None)."""
+    if URL_PREFILTER not in text:  # Quasi tutte le righe si fermano qui, senza regex
+        return None, None
+    match = URL_PATTERN.search(text)
+    if match:
+        return match.group(match.lastgroup), match.lastgroup[1:]
+    match = GENERIC_URL_PATTERN.search(text)
+    if match:
+        return match.group(1), "generico"
+    return None, None
+
+
+def _classify(level, message, fields, text):
+    # Prima gli errori: una richiesta fallita del quick tunnel cita l'URL dell'API, che non è l'URL del tunnel
+    if level in ERROR_LEVELS:
+        # Il 429 di trycloudflare.com arriva come errore: le altre righe non vengono controllate
+        error = str(fields.get('error', '')) if fields else ''
+        kind = EVENT_RATE_LIMITED if any(marker in message or marker in error for marker in RATE_LIMIT_MARKERS) else EVENT_ERROR
+        return CloudflaredEvent(kind, level, message, fields, None, None, text)
+    url, label = match_tunnel_url(text)
+    if url:
+        return CloudflaredEvent(EVENT_URL, level, message, fields, url, label, text)
+    if message.startswith(CONNECTION_MESSAGES) or ' registered connIndex=' in message:
+        return CloudflaredEvent(EVENT_CONNECTION, level, message, fields, None, None, text)
+    return CloudflaredEvent(EVENT_LOG, level, message, fields, None, None, text)
+
+
+def _json_text(record, level, message):
+    # Stessa forma del formato testo di cloudflared, più leggibile nel buffer dei log e nell'interfaccia
+    extra = " ".join(f"{key}={value}" for key, value in record.items() if key not in ('level', 'time', 'message'))
+    return f"{record.get('time', '')} {LEVEL_TAGS.get(level, level.upper()[:3])} {message}" + (f" {extra}" if extra else "")
+
+
+def parse_line(line):
+    """Decodifica una riga di output di cloudflared in un CloudflaredEvent."""
+    if line.startswith('{'):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if isinstance(record, dict):
+            level = str(record.get('level', 'info'))
+            message = str(record.get('message', ''))
+            return _classify(level, message, record, _json_text(record, level, message))
+    parts = line.split(' ', 2)
+    if len(parts) == 3 and parts[1] in TEXT_LEVELS:
+        return _classify(TEXT_LEVELS[parts[1]], parts[2], None, line)
+    # Righe senza prefisso (es. i riquadri o l'output di versioni vecchie): si cerca solo l'URL
+    url, label = match_tunnel_url(line)
+    return CloudflaredEvent(EVENT_URL if url else EVENT_LOG, 'info', line, None, url, label, line)
+
+
+def error_text(event):
+    """Messaggio di un evento di errore con il dettaglio del campo 'error' (solo formato JSON)."""
+    error = event.fields.get('error') if event.fields else None
+    return f"{event.message}: {error}" if error else event.message
+
+
+def output_args():
+    return ["--output", "json"] if CLOUDFLARED_OUTPUT == 'json' else []
@@ -14,6 +14,12 @@ case "$1" in
         # Crea backup della configurazione corrente
         if [ -f "$CONFIG_FILE" ]; then
             cp "$CONFIG_FILE" "$CONFIG_FILE.bak"
+            # Le modifiche più recenti possono essere ancora nel journal
+            if [ -f "$CONFIG_FILE.journal" ]; then
+                cp "$CONFIG_FILE.journal" "$CONFIG_FILE.journal.bak"
+            else
+                rm -f "$CONFIG_FILE.journal.bak"
+            fi
             echo "✅ Backup completato: $CONFIG_FILE.bak"
         else
             echo "⚠️ Nessun file di configurazione da eseguire il backup."
@@ -24,6 +30,11 @@ case "$1" in
         # Ripristina da backup se esiste
         if [ -f "$CONFIG_FILE.bak" ]; then
             cp "$CONFIG_FILE.bak" "$CONFIG_FILE"
+            if [ -f "$CONFIG_FILE.journal.bak" ]; then
+                cp "$CONFIG_FILE.journal.bak" "$CONFIG_FILE.journal"
+            else
+                rm -f "$CONFIG_FILE.journal"
+            fi
             echo "✅ Ripristino completato da: $CONFIG_FILE.bak"
         else
             echo "⚠️ Nessun backup trovato da ripristinare."
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Client minimale per la Docker Engine API sul socket UNIX, con connessioni keep-alive riutilizzate
+"""
+
+import http.client
+import socket
+import json
+import os
+import queue
+import threading
+import logging
+from urllib.parse import urlencode
+
+DEFAULT_SOCKET_PATH = "/var/run/docker.sock"
+DEFAULT_POOL_SIZE = 4
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Docker API {status}: {message}")
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=10):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def socket_path_from_env():
+    docker_host = os.environ.get('DOCKER_HOST', '')
+    if docker_host.startswith('unix://'):
+        return docker_host[len('unix://'):]
+    return DEFAULT_SOCKET_PATH
+
+
+class DockerClient:
+    def __init__(self, socket_path=None, pool_size=DEFAULT_POOL_SIZE, timeout=10):
+        self.socket_path = socket_path or socket_path_from_env()
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._streams = set()
+        self._streams_lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+
+    def _release(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _url(self, path, params=None):
+        if params:
+            return f"{path}?{urlencode(params)}"
+        return path
+
+    def request(self, method, path, params=None):
+        url = self._url(path, params)
+        # Una connessione keep-alive rimasta nel pool può essere stata chiusa dal daemon: un solo nuovo tentativo
+        for attempt in range(2):
+            conn = self._acquire()
+            try:
+                conn.request(method, url, headers={'Host': 'docker'})
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if attempt == 0:
+                    continue
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if response.status >= 400:
+                try: message = json.loads(body).get('message', '')
+                except ValueError: message = body.decode('utf-8', 'replace')
+                raise DockerAPIError(response.status, message)
+            content_type = response.getheader('Content-Type', '')
+            if 'application/json' in content_type:
+                return json.loads(body)
+            return body.decode('utf-8', 'replace')
+
+    def ping(self):
+        return self.request('GET', '/_ping') == 'OK'
+
+    def list_containers(self, all=True, filters=None):
+        params = {'all': '1' if all else '0'}
+        if filters:
+            params['filters'] = json.dumps(filters)
+        return self.request('GET', '/containers/json', params)
+
+    def events(self, filters=None):
+        """Apre lo stream eventi su una connessione dedicata senza timeout e restituisce un iteratore."""
+        params = {'filters': json.dumps(filters)} if filters else None
+        conn = UnixHTTPConnection(self.socket_path, timeout=None)
+        try:
+            conn.request('GET', self._url('/events', params), headers={'Host': 'docker'})
+            # getresponse() può azzerare conn.sock: si tiene il socket per poterlo chiudere da close()
+            conn.stream_sock = conn.sock
+            with self._streams_lock:
+                self._streams.add(conn)
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise DockerAPIError(response.status, response.read().decode('utf-8', 'replace'))
+        except Exception:
+            self._close_stream(conn)
+            raise
+        return self._iter_events(conn, response)
+
+    def _iter_events(self, conn, response):
+        try:
+            for line in iter(response.readline, b''):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logging.debug(f"Evento Docker non valido: {line[:200]!r}")
+        finally:
+            self._close_stream(conn)
+
+    def _close_stream(self, conn):
+        with self._streams_lock:
+            self._streams.discard(conn)
+        conn.close()
+
+    def close(self):
+        with self._streams_lock:
+            streams = list(self._streams)
+        for conn in streams:
+            # shutdown sblocca il thread fermo in lettura sullo stream eventi
+            try:
+                conn.stream_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
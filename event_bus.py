@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Bus eventi in memoria per notificare ai client (Server-Sent Events) i cambi di stato di tunnel e servizi
+"""
+
+import threading
+import queue
+import time
+from response_encoding import dumps
+
+SUBSCRIBER_QUEUE_SIZE = 256
+KEEPALIVE_SECONDS = 15
+
+
+class Subscription:
+    def __init__(self, maxsize=SUBSCRIBER_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=maxsize)
+        # Se il client è troppo lento la coda si riempie: gli eventi vengono scartati
+        # e il client riceve una nuova istantanea completa al posto dei delta persi
+        self.overflowed = False
+
+    def get(self, timeout=KEEPALIVE_SECONDS):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self.sequence = 0
+
+    def publish(self, event_type, data):
+        with self._lock:
+            self.sequence += 1
+            event = {'id': self.sequence, 'type': event_type, 'time': time.time(), 'data': data}
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                subscription.overflowed = True
+        return event
+
+    def subscribe(self):
+        subscription = Subscription()
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    @property
+    def subscribers_count(self):
+        return len(self._subscribers)
+
+
+def format_sse(event_type, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {dumps(data).decode()}") # L'istantanea iniziale contiene tutti i servizi
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Arresto dei tunnel inattivi: un solo thread conta a intervalli le connessioni TCP stabilite da ogni processo
+cloudflared verso la propria origine; un tunnel senza connessioni per più della sua finestra viene fermato
+"""
+
+import collections
+import threading
+import logging
+import psutil
+import socket
+import time
+import os
+
+# Finestra di inattività dei tunnel avviati senza idle_timeout_minutes; 0 = mai fermati per inattività
+IDLE_TIMEOUT_MINUTES = float(os.environ.get('TUNNEL_IDLE_TIMEOUT_MINUTES', 0))
+# cloudflared tiene aperte le connessioni inattive verso l'origine per 90 s (--proxy-keepalive-timeout): con un
+# intervallo più corto ogni richiesta viene vista in almeno un controllo
+IDLE_CHECK_INTERVAL_SECONDS = float(os.environ.get('TUNNEL_IDLE_CHECK_INTERVAL_SECONDS', 60))  # 0 = disattivato
+
+# Un tunnel da controllare: host/porta a cui cloudflared si collega (l'origine, o il forwarder del pool)
+IdleTarget = collections.namedtuple('IdleTarget', ['pid', 'host', 'port', 'timeout_seconds'])
+# Stato di un tunnel: ultimo istante con connessioni verso l'origine (o del primo controllo del processo)
+Activity = collections.namedtuple('Activity', ['pid', 'last_activity', 'origin_connections'])
+
+
+def resolve_addresses(hosts):
+    """{host: insieme degli IP, anche in forma ::ffff:} oppure None se il nome non si risolve. L'origine può essere
+    un nome (es. LOCAL_IP=host.docker.internal), mentre la tabella TCP riporta solo indirizzi."""
+    addresses = {}
+    for host in hosts:
+        try:
+            infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+        except (OSError, UnicodeError) as e:
+            logging.warning(f"Controllo inattività: {host} non risolvibile ({e}), nessuna decisione in questo giro")
+            addresses[host] = None
+            continue
+        ips = {info[4][0].split('%')[0] for info in infos}
+        addresses[host] = frozenset(ips | {f"::ffff:{ip}" for ip in ips if ':' not in ip})
+    return addresses
+
+
+def count_origin_connections(targets):
+    """{nome: connessioni ESTABLISHED dal pid verso host:porta}, None se host non si risolve. Una sola
+    risoluzione per host e una sola lettura della tabella TCP per tutti i tunnel (psutil.net_connections);
+    dove non è permessa (es. macOS senza root) una lettura per processo."""
+    addresses = resolve_addresses({target.host for target in targets.values()})
+    counts = {name: None if addresses[target.host] is None else 0 for name, target in targets.items()}
+    targets = {name: target for name, target in targets.items() if counts[name] is not None}
+    by_pid = {target.pid: name for name, target in targets.items()}
+    try:
+        connections = [(conn.pid, conn) for conn in psutil.net_connections(kind='tcp') if conn.pid in by_pid]
+    except psutil.AccessDenied:
+        connections = []
+        for name, target in targets.items():
+            try:
+                connections += [(target.pid, conn) for conn in psutil.Process(target.pid).connections(kind='tcp')]
+            except psutil.Error:
+                counts[name] = None
+    for pid, conn in connections:
+        target = targets[by_pid[pid]]
+        if (conn.status == psutil.CONN_ESTABLISHED and conn.raddr and conn.raddr.port == target.port
+                and conn.raddr.ip in addresses[target.host]):
+            counts[by_pid[pid]] += 1
+    return counts
+
+
+class IdleReaper:
+    """targets() -> {nome tunnel: IdleTarget} dei tunnel in esecuzione; on_idle(nome, pid, secondi di inattività)
+    per quelli con timeout_seconds superato. Entrambe chiamate dal thread del controllore."""
+
+    def __init__(self, targets, on_idle, interval=IDLE_CHECK_INTERVAL_SECONDS):
+        self.targets = targets
+        self.on_idle = on_idle
+        self.interval = interval
+        self.activity = {}      # {nome tunnel: Activity}
+        self.last_round_seconds = None
+        self.shutdown_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True, name="IdleReaper")
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def start(self):
+        if self.enabled:
+            self.thread.start()
+            logging.info(f"Controllo inattività tunnel attivo: ogni {self.interval}s")
+
+    def stop(self):
+        self.shutdown_event.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=2)
+
+    def get(self, tunnel):
+        """{last_activity, idle_seconds, origin_connections} per un tunnel; letta senza lock (dati indicativi)."""
+        activity = self.activity.get(tunnel)
+        if not activity:
+            return None
+        return {'last_activity': activity.last_activity, 'idle_seconds': round(time.time() - activity.last_activity),
+                'origin_connections': activity.origin_connections}
+
+    def run(self):
+        while not self.shutdown_event.is_set():
+            started = time.monotonic()
+            try:
+                self.check_round()
+            except Exception as e:
+                logging.error(f"Errore controllo inattività tunnel: {e}", exc_info=True)
+            self.last_round_seconds = time.monotonic() - started
+            self.shutdown_event.wait(max(0.1, self.interval - self.last_round_seconds))
+
+    def check_round(self):
+        targets = self.targets()
+        for name in list(self.activity):
+            if name not in targets:
+                del self.activity[name]
+        if not targets:
+            return
+        now = time.time()
+        counts = count_origin_connections(targets)
+        idle = []
+        for name, target in targets.items():
+            previous = self.activity.get(name)
+            if previous is None or previous.pid != target.pid:
+                # Nuovo processo (avvio, riavvio, riadozione): la finestra parte dal primo controllo
+                previous = Activity(target.pid, now, 0)
+            count = counts.get(name)
+            if count is None: # Processo non leggibile: nessuna decisione in questo giro
+                continue
+            last_activity = now if count else previous.last_activity
+            self.activity[name] = Activity(target.pid, last_activity, count)
+            if target.timeout_seconds and now - last_activity >= target.timeout_seconds:
+                idle.append((name, target.pid, now - last_activity))
+        for name, pid, idle_seconds in idle:
+            try:
+                self.on_idle(name, pid, idle_seconds)
+            except Exception as e:
+                logging.error(f"Errore arresto tunnel inattivo {name}: {e}", exc_info=True)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Buffer circolare a dimensione fissa per l'output di un processo cloudflared, con supporto al follow
+"""
+
+import collections
+import threading
+import time
+import os
+
+LOG_BUFFER_LINES = int(os.environ.get('TUNNEL_LOG_BUFFER_LINES', 1000))
+MAX_LINE_LENGTH = 2048
+
+
+class LogRingBuffer:
+    def __init__(self, maxlen=LOG_BUFFER_LINES):
+        self._lines = collections.deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self.sequence = 0   # Numero dell'ultima riga scritta, anche se già uscita dal buffer
+        self.closed = False
+
+    def append(self, stream, line):
+        if len(line) > MAX_LINE_LENGTH:
+            line = line[:MAX_LINE_LENGTH] + " …[troncata]"
+        with self._cond:
+            self.sequence += 1
+            self._lines.append({'seq': self.sequence, 'time': time.time(), 'stream': stream, 'line': line})
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def tail(self, count=None, after=0):
+        with self._cond:
+            lines = [entry for entry in self._lines if entry['seq'] > after]
+        return lines[-count:] if count else lines
+
+    def wait_for_lines(self, after, timeout=None):
+        """Attende righe con seq > after; restituisce [] allo scadere del timeout o a buffer chiuso."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.sequence > after or self.closed, timeout)
+            return [entry for entry in self._lines if entry['seq'] > after]
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Persistenza write-behind di tunnel_config.json: journal append-only delle modifiche più snapshot compattati atomici
+"""
+
+import threading
+import tempfile
+import logging
+import json
+import time
+import os
+
+FLUSH_DELAY_SECONDS = 0.5     # Finestra in cui le modifiche ravvicinate vengono accorpate in una sola scrittura
+COMPACT_EVERY_ENTRIES = 500   # Righe di journal oltre le quali si riscrive lo snapshot
+COMPACT_INTERVAL_SECONDS = 300
+
+
+def fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_json(path, data):
+    """Scrive su file temporaneo, fsync e rename: il file di destinazione è sempre completo."""
+    directory = os.path.dirname(path) or '.'
+    try: mode = os.stat(path).st_mode & 0o777
+    except OSError: mode = 0o644
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try: os.unlink(tmp_path)
+        except OSError: pass
+        raise
+    fsync_directory(directory)
+
+
+class ConfigStore:
+    def __init__(self, path, flush_delay=FLUSH_DELAY_SECONDS, compact_every=COMPACT_EVERY_ENTRIES, on_flush=None):
+        self.path = path
+        self.on_flush = on_flush  # callback(secondi, modifiche scritte) dopo ogni scrittura del journal
+        self.journal_path = path + ".journal"
+        self.flush_delay = flush_delay
+        self.compact_every = compact_every
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()
+        self._tunnels = {}      # Stato persistito più recente, in memoria
+        self._service_profiles = {}  # {servizio: profilo} scelto via API: resta anche dopo lo stop del tunnel
+        self._pending = []      # Operazioni non ancora nel journal
+        self._journal = None
+        self._journal_entries = 0
+        self._last_compact = time.time()
+        self._stopped = False
+        self.flush_count = 0
+        self.last_flush_seconds = None
+        self.thread = threading.Thread(target=self.run, daemon=True, name="ConfigWriter")
+
+    def load(self):
+        """Carica snapshot e journal; un'ultima riga troncata da un crash viene ignorata."""
+        tunnels, service_profiles = {}, {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                tunnels = data.get('tunnels', {}) or {}
+                service_profiles = data.get('service_profiles', {}) or {}
+                logging.info(f"Configurazione caricata da: {self.path}")
+            except Exception as e:
+                logging.error(f"Errore nel caricamento della configurazione: {e}")
+        else:
+            logging.info(f"File di configurazione non trovato: {self.path}")
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        logging.warning("Journal configurazione: riga incompleta ignorata.")
+                        break
+                    self._apply(tunnels, service_profiles, op)
+                    replayed += 1
+            if replayed:
+                logging.info(f"Journal configurazione: {replayed} modifiche riapplicate.")
+        with self._cond:
+            self._tunnels = tunnels
+            self._service_profiles = service_profiles
+            self._journal_entries = replayed
+        return {name: dict(data) for name, data in tunnels.items()}
+
+    @staticmethod
+    def _apply(tunnels, service_profiles, op):
+        if op.get('op') == 'put':
+            tunnels[op['name']] = op['data']
+        elif op.get('op') == 'delete':
+            tunnels.pop(op['name'], None)
+        elif op.get('op') == 'profile':
+            if op.get('profile'):
+                service_profiles[op['name']] = op['profile']
+            else:
+                service_profiles.pop(op['name'], None)
+
+    def start(self):
+        # Si riparte da uno snapshot pulito: nuove righe non finiscono mai dopo una riga troncata
+        if self._journal_entries or (os.path.exists(self.journal_path) and os.path.getsize(self.journal_path)):
+            self.compact()
+        self.thread.start()
+
+    def _record(self, op):
+        with self._cond:
+            self._apply(self._tunnels, self._service_profiles, op)
+            self._pending.append(op)
+            self._cond.notify()
+
+    def put(self, name, data):
+        with self._cond:
+            if self._tunnels.get(name) == data:
+                return
+        self._record({'op': 'put', 'name': name, 'data': data})
+
+    def delete(self, name):
+        with self._cond:
+            if name not in self._tunnels:
+                return
+        self._record({'op': 'delete', 'name': name})
+
+    def set_service_profile(self, name, profile):
+        """Profilo salvato per un servizio; None lo rimuove."""
+        with self._cond:
+            if self._service_profiles.get(name) == profile:
+                return
+        self._record({'op': 'profile', 'name': name, 'profile': profile})
+
+    def get_service_profile(self, name):
+        with self._cond:
+            return self._service_profiles.get(name)
+
+    def service_profiles(self):
+        with self._cond:
+            return dict(self._service_profiles)
+
+    def snapshot(self):
+        with self._cond:
+            return {'timestamp': time.time(), 'tunnels': {name: dict(data) for name, data in self._tunnels.items()},
+                    'service_profiles': dict(self._service_profiles)}
+
+    def flush(self):
+        with self._io_lock:
+            with self._cond:
+                pending, self._pending = self._pending, []
+            if pending:
+                self._write_journal(pending)
+            if self._journal_entries >= self.compact_every or \
+               (self._journal_entries and time.time() - self._last_compact > COMPACT_INTERVAL_SECONDS):
+                self._compact()
+
+    def _write_journal(self, pending):
+        # Chiamato con self._io_lock acquisito
+        started = time.perf_counter()
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a')
+        # Un'unica write + fsync per tutte le modifiche accumulate
+        self._journal.write("".join(json.dumps(op, separators=(',', ':')) + "\n" for op in pending))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal_entries += len(pending)
+        self.flush_count += 1
+        self.last_flush_seconds = time.perf_counter() - started
+        logging.debug(f"Configurazione: {len(pending)} modifiche scritte nel journal")
+        if self.on_flush:
+            self.on_flush(self.last_flush_seconds, len(pending))
+
+    def _compact(self):
+        # Snapshot e modifiche in sospeso presi insieme, e queste scritte nel journal prima del rename: lo snapshot
+        # è esattamente lo stato dopo tutto il journal, quindi se il processo muore prima del troncamento
+        # riapplicare il vecchio journal sullo snapshot nuovo dà lo stesso stato
+        with self._cond:
+            pending, self._pending = self._pending, []
+            snapshot = self.snapshot()
+        if pending:
+            self._write_journal(pending)
+        atomic_write_json(self.path, snapshot)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        open(self.journal_path, 'w').close()
+        self._journal_entries = 0
+        self._last_compact = time.time()
+        logging.debug(f"Configurazione compattata in: {self.path}")
+
+    def compact(self):
+        with self._io_lock:
+            self._compact()
+
+    def run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._stopped, timeout=COMPACT_INTERVAL_SECONDS)
+                if self._stopped:
+                    break
+            # Attende un attimo per accorpare le modifiche che arrivano a raffica (es. stop di tutti i tunnel)
+            time.sleep(self.flush_delay)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Errore nel salvataggio della configurazione: {e}")
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout=self.flush_delay + 2)
+        try:
+            self.compact()
+        except Exception as e:
+            logging.error(f"Errore nel salvataggio finale della configurazione: {e}")
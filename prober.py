@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Sonda di latenza dei tunnel: a intervalli controlla in parallelo l'origine (local_url) e l'URL pubblico di ogni
+tunnel con richieste HEAD su connessioni riutilizzate, dentro il loop del supervisore
+"""
+
+import urllib.parse
+import collections
+import asyncio
+import logging
+import time
+import ssl
+import os
+
+PROBE_INTERVAL_SECONDS = float(os.environ.get('TUNNEL_PROBE_INTERVAL_SECONDS', 30))  # 0 = sonda disattivata
+PROBE_TIMEOUT_SECONDS = float(os.environ.get('TUNNEL_PROBE_TIMEOUT_SECONDS', 5))
+PROBE_CONCURRENCY = int(os.environ.get('TUNNEL_PROBE_CONCURRENCY', 16))
+PROBE_WINDOW = 20          # Campioni per i percentili mobili
+MAX_HEADER_LINES = 100
+# Errori di gateway: cloudflared/Cloudflare non raggiungono l'origine. Altri codici (anche 405/501 a HEAD) = attivo
+DOWN_STATUS_CODES = {502, 503, 504, 530}
+
+ProbeTarget = collections.namedtuple('ProbeTarget', ['tunnel', 'kind', 'url'])  # kind: 'origin' o 'public'
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class ProbeStats:
+    def __init__(self, url):
+        self.url = url
+        self.samples = collections.deque(maxlen=PROBE_WINDOW)  # Latenze (s) delle ultime risposte
+        self.up = None           # None finché non c'è un primo esito
+        self.status_code = None
+        self.last_error = None
+        self.last_check = None
+        self.failures = 0        # Fallimenti consecutivi
+
+    def to_dict(self):
+        samples = list(self.samples)
+        return {
+            'url': self.url, 'up': self.up, 'status_code': self.status_code,
+            'last_error': self.last_error, 'last_check': self.last_check, 'consecutive_failures': self.failures,
+            'latency_p50_ms': round(percentile(samples, 0.5) * 1000, 1) if samples else None,
+            'latency_p95_ms': round(percentile(samples, 0.95) * 1000, 1) if samples else None,
+            'latency_last_ms': round(samples[-1] * 1000, 1) if samples else None
+        }
+
+
+class LatencyProber:
+    """targets() -> [ProbeTarget] viene chiamata nel loop a ogni giro; on_change(tunnel, kind, up) quando un
+    controllo passa da raggiungibile a non raggiungibile o viceversa."""
+
+    def __init__(self, supervisor, targets, on_change=None, interval=PROBE_INTERVAL_SECONDS,
+                 timeout=PROBE_TIMEOUT_SECONDS, concurrency=PROBE_CONCURRENCY):
+        self.supervisor = supervisor
+        self.targets = targets
+        self.on_change = on_change
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = max(1, concurrency)
+        self.stats = {}          # {(tunnel, kind): ProbeStats}
+        self._idle = {}          # {(scheme, host, porta): [(reader, writer)]} connessioni keep-alive libere
+        self._ssl_context = ssl.create_default_context()
+        self._task = None
+        self.rounds = 0
+        self.last_round_seconds = None
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    # --- API sincrona ---
+
+    def start(self):
+        if self.enabled:
+            self._task = asyncio.run_coroutine_threadsafe(self._run(), self.supervisor.loop)
+            logging.info(f"Sonda latenza tunnel attiva: ogni {self.interval}s, timeout {self.timeout}s, "
+                         f"{self.concurrency} controlli in parallelo")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            try:
+                self.supervisor.call(self._close_idle(), timeout=2)
+            except Exception:
+                pass
+
+    def get(self, tunnel):
+        """{kind: statistiche} per un tunnel; letta dai thread di Flask senza lock (dati indicativi)."""
+        return {kind: stats.to_dict() for (name, kind), stats in list(self.stats.items()) if name == tunnel}
+
+    # --- Nel loop del supervisore ---
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logging.error(f"Sonda latenza: giro fallito: {e}", exc_info=True)
+            self.last_round_seconds = time.monotonic() - started
+            await asyncio.sleep(max(0, self.interval - self.last_round_seconds))
+
+    async def probe_all(self):
+        targets = [target for target in self.targets() if target.url]
+        keys = {(target.tunnel, target.kind) for target in targets}
+        for key in list(self.stats):
+            if key not in keys:
+                del self.stats[key]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(target):
+            async with semaphore:
+                await self._probe(target)
+
+        # Budget fisso per l'intero giro: un giro lento non si sovrappone al successivo
+        budget = max(self.timeout, self.interval) if self.interval else None
+        tasks = [asyncio.ensure_future(bounded(target)) for target in targets]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=budget)
+            for task in pending:
+                task.cancel()
+        await self._close_idle({origin for origin in map(self._origin_or_none, (t.url for t in targets)) if origin})
+        self.rounds += 1
+
+    async def _probe(self, target):
+        key = (target.tunnel, target.kind)
+        stats = self.stats.get(key)
+        if stats is None or stats.url != target.url:
+            stats = self.stats[key] = ProbeStats(target.url)
+        started = time.monotonic()
+        try:
+            status_code = await asyncio.wait_for(self._head(target.url), self.timeout)
+        except asyncio.TimeoutError:
+            error = f"timeout dopo {self.timeout}s"
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            error = str(e) or e.__class__.__name__
+        else:
+            error = None
+            stats.samples.append(time.monotonic() - started)
+            stats.status_code = status_code
+        stats.last_check = time.time()
+        stats.last_error = error
+        stats.failures = stats.failures + 1 if error else 0
+        up = error is None and stats.status_code not in DOWN_STATUS_CODES
+        if stats.up is not up:
+            previous, stats.up = stats.up, up
+            if previous is not None or not up:
+                logging.log(logging.INFO if up else logging.WARNING,
+                            f"Sonda latenza: {target.kind} di {target.tunnel} {'raggiungibile' if up else 'non raggiungibile'}"
+                            f" ({target.url}{': ' + (error or str(stats.status_code)) if not up else ''})")
+            if self.on_change:
+                try: # Fuori dal loop: la callback prende il lock del tunnel
+                    await asyncio.get_running_loop().run_in_executor(None, self.on_change, target.tunnel, target.kind, up)
+                except Exception as e:
+                    logging.error(f"Sonda latenza: errore callback per {target.tunnel}: {e}")
+
+    @staticmethod
+    def _origin(url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"URL non valido: {url}")
+        return parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)
+
+    @classmethod
+    def _origin_or_none(cls, url):
+        try: return cls._origin(url)
+        except ValueError: return None
+
+    async def _head(self, url):
+        """HEAD / su una connessione keep-alive riutilizzata; restituisce il codice di stato."""
+        origin = self._origin(url)
+        scheme, host, port = origin
+        path = urllib.parse.urlsplit(url).path or '/'
+        request = (f"HEAD {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: tunnel-manager-probe\r\n"
+                   f"Connection: keep-alive\r\n\r\n").encode()
+        idle = self._idle.get(origin)
+        if idle:
+            reader, writer = idle.pop()
+            try:
+                return await self._exchange(origin, reader, writer, request)
+            except (OSError, asyncio.IncompleteReadError):
+                pass  # Connessione chiusa dal server nel frattempo: si riprova su una nuova
+        reader, writer = await asyncio.open_connection(host, port, ssl=self._ssl_context if scheme == 'https' else None)
+        return await self._exchange(origin, reader, writer, request)
+
+    async def _exchange(self, origin, reader, writer, request):
+        reusable = False
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise asyncio.IncompleteReadError(b'', None)
+            version, status_code = status_line.decode('latin-1').split(' ', 2)[:2]
+            connection = ''
+            for _ in range(MAX_HEADER_LINES):
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'connection':
+                    connection = value.strip().lower()
+            # Risposta a HEAD: nessun corpo, la connessione è subito riutilizzabile
+            reusable = connection != 'close' and (version == 'HTTP/1.1' or connection == 'keep-alive')
+            return int(status_code)
+        finally:
+            if reusable:
+                self._idle.setdefault(origin, []).append((reader, writer))
+            else:
+                writer.close()
+
+    async def _close_idle(self, keep=None):
+        for origin in list(self._idle):
+            if keep is None or origin not in keep:
+                for _, writer in self._idle.pop(origin):
+                    writer.close()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Campionatore delle risorse dei processi cloudflared: un solo thread, psutil oneshot() per processo e una serie
+temporale a dimensione fissa per ogni tunnel
+"""
+
+import collections
+import threading
+import logging
+import psutil
+import time
+import os
+
+STATS_INTERVAL_SECONDS = float(os.environ.get('TUNNEL_STATS_INTERVAL_SECONDS', 5))  # 0 = campionamento disattivato
+STATS_SAMPLES = int(os.environ.get('TUNNEL_STATS_SAMPLES', 120))                     # Campioni per tunnel (10 minuti a 5s)
+# Processi letti per giro: con molti tunnel ognuno viene campionato meno spesso, il costo per giro resta fisso
+STATS_MAX_PER_ROUND = int(os.environ.get('TUNNEL_STATS_MAX_PER_ROUND', 200))
+
+# Un campione: I/O in caratteri letti/scritti (rchar/wchar), che per cloudflared sono quasi solo traffico di rete
+Sample = collections.namedtuple('Sample', ['time', 'cpu_percent', 'rss_bytes', 'num_fds', 'num_threads',
+                                           'read_bytes', 'write_bytes'])
+
+
+class TunnelSeries:
+    def __init__(self, pid, maxlen=STATS_SAMPLES):
+        self.pid = pid
+        self.samples = collections.deque(maxlen=maxlen)
+        self.process = None   # psutil.Process tenuto tra i giri: cpu_percent() misura dall'ultima chiamata
+        self.error = None
+
+    def to_dict(self):
+        samples = list(self.samples)
+        result = []
+        for previous, sample in zip([None] + samples[:-1], samples):
+            entry = sample._asdict()
+            elapsed = sample.time - previous.time if previous else 0
+            # Velocità di I/O tra due campioni consecutivi dello stesso processo
+            entry['read_bytes_per_second'] = round((sample.read_bytes - previous.read_bytes) / elapsed) if elapsed > 0 else None
+            entry['write_bytes_per_second'] = round((sample.write_bytes - previous.write_bytes) / elapsed) if elapsed > 0 else None
+            result.append(entry)
+        return {'pid': self.pid, 'error': self.error, 'samples': result}
+
+
+class ResourceSampler:
+    """targets() -> {nome tunnel: pid} dei processi da seguire; chiamata a ogni giro dal thread del campionatore."""
+
+    def __init__(self, targets, interval=STATS_INTERVAL_SECONDS, max_per_round=STATS_MAX_PER_ROUND, samples=STATS_SAMPLES):
+        self.targets = targets
+        self.interval = interval
+        self.max_per_round = max(1, max_per_round)
+        self.samples = samples
+        self.series = {}        # {nome tunnel: TunnelSeries}
+        self._cursor = 0        # Giro a rotazione quando i tunnel sono più di max_per_round
+        self.last_round_seconds = None
+        self.shutdown_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True, name="ResourceSampler")
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def start(self):
+        if self.enabled:
+            self.thread.start()
+            logging.info(f"Campionamento risorse tunnel attivo: ogni {self.interval}s, "
+                         f"al massimo {self.max_per_round} processi per giro")
+
+    def stop(self):
+        self.shutdown_event.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=2)
+
+    def get(self, tunnel):
+        series = self.series.get(tunnel)
+        return series.to_dict() if series else None
+
+    def latest(self):
+        """{nome tunnel: ultimo campione} per le metriche."""
+        return {name: series.samples[-1] for name, series in list(self.series.items()) if series.samples}
+
+    def run(self):
+        while not self.shutdown_event.is_set():
+            started = time.monotonic()
+            try:
+                self.sample_round()
+            except Exception as e:
+                logging.error(f"Errore campionamento risorse tunnel: {e}", exc_info=True)
+            self.last_round_seconds = time.monotonic() - started
+            self.shutdown_event.wait(max(0.1, self.interval - self.last_round_seconds))
+
+    def sample_round(self):
+        targets = self.targets()
+        for name in list(self.series):
+            if name not in targets:
+                del self.series[name]
+        names = sorted(targets)
+        if len(names) > self.max_per_round:
+            start = self._cursor % len(names)
+            names = (names[start:] + names[:start])[:self.max_per_round]
+            self._cursor = start + self.max_per_round
+        for name in names:
+            self._sample(name, targets[name])
+
+    def _sample(self, name, pid):
+        series = self.series.get(name)
+        if series is None or series.pid != pid:
+            # Nuovo processo (riavvio o cambio porta): la serie ricomincia
+            series = self.series[name] = TunnelSeries(pid, self.samples)
+        try:
+            if series.process is None:
+                series.process = psutil.Process(pid)
+                series.process.cpu_percent()  # La prima lettura inizializza solo il riferimento
+            process = series.process
+            with process.oneshot():
+                io = process.io_counters()
+                sample = Sample(
+                    time.time(), process.cpu_percent(), process.memory_info().rss, process.num_fds(),
+                    process.num_threads(), io.read_chars, io.write_chars
+                )
+        except psutil.Error as e:
+            series.error = f"{e.__class__.__name__}: {e}"
+            series.process = None
+            return
+        series.error = None
+        series.samples.append(sample)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Serializzazione compatta delle risposte: JSON con orjson se installato (altrimenti json senza spazi né ordinamento
+delle chiavi), compressione negoziata brotli/gzip e selezione dei campi (?fields=) per /api/status e /api/debug
+"""
+
+import gzip
+import json
+import os
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError: # Opzionale: pip install orjson
+    orjson = None
+try:
+    import brotli
+except ImportError: # Opzionale: pip install brotli
+    brotli = None
+
+# Sotto questa dimensione la compressione costa più di quanto fa risparmiare
+MIN_COMPRESS_BYTES = int(os.environ.get('TUNNEL_MANAGER_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('TUNNEL_MANAGER_GZIP_LEVEL', 4)) # A 1000 servizi: metà del tempo del livello 6, byte +10%
+BROTLI_QUALITY = int(os.environ.get('TUNNEL_MANAGER_BROTLI_QUALITY', 4)) # Qualità alte: troppo lente per risposte dinamiche
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/html', 'text/plain', 'text/css', 'application/javascript')
+# Campi sempre restituiti con ?fields=: servono al client per If-None-Match e ?since=
+ALWAYS_INCLUDED_FIELDS = ('version', 'since')
+
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+
+
+def dumps(obj, default=str):
+    """JSON compatto in bytes."""
+    if orjson:
+        return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS)
+    return json.dumps(obj, separators=(',', ':'), default=default).encode()
+
+
+def loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """Provider JSON di Flask (jsonify, request.get_json) con l'encoder più veloce disponibile."""
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson and not kwargs:
+            return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode()
+        kwargs.setdefault('sort_keys', self.sort_keys)
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs) # Indentato in debug
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj, default=self.default), mimetype=self.mimetype)
+
+
+def choose_encoding(accept_encodings):
+    """'br', 'gzip' o None secondo Accept-Encoding (werkzeug Accept); a parità di qualità preferisce brotli."""
+    gzip_quality = accept_encodings.quality('gzip')
+    if brotli and accept_encodings.quality('br') and accept_encodings.quality('br') >= gzip_quality:
+        return 'br'
+    return 'gzip' if gzip_quality else None
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def compress_response(response, accept_encodings):
+    """Comprime il corpo di una risposta non in streaming secondo Accept-Encoding (after_request di Flask)."""
+    response.vary.add('Accept-Encoding')
+    if (response.status_code < 200 or response.status_code in (204, 304) or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    encoding = choose_encoding(accept_encodings)
+    if not encoding:
+        return response
+    data = response.get_data()
+    if len(data) < MIN_COMPRESS_BYTES:
+        return response
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def parse_fields(value):
+    """'a,b.c,b.d' -> {'a': None, 'b': {'c': None, 'd': None}}; None se il parametro manca o è vuoto."""
+    if not value:
+        return None
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        parts = [part for part in path.strip().split('.') if part]
+        for index, part in enumerate(parts):
+            if index == len(parts) - 1:
+                node[part] = None # Campo intero (sostituisce eventuali sottocampi)
+            else:
+                child = node.get(part, {})
+                if child is None:
+                    break # Campo già richiesto per intero
+                node = node.setdefault(part, child)
+    return tree or None
+
+
+def select_fields(data, fields, always=()):
+    """Solo i campi richiesti; sulle liste la selezione si applica a ogni elemento, '*' a ogni valore di un
+    oggetto indicizzato per nome (es. active_tunnels_details.*.url)."""
+    if fields is None:
+        return data
+    if isinstance(data, list):
+        return [select_fields(item, fields) for item in data]
+    if not isinstance(data, dict):
+        return data
+    if '*' in fields:
+        return {key: select_fields(value, fields['*']) for key, value in data.items()}
+    selected = {key: data[key] for key in always if key in data}
+    for key, subfields in fields.items():
+        if key in data:
+            selected[key] = select_fields(data[key], subfields)
+    return selected
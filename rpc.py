@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+RPC compatto su socket UNIX tra il demone dei tunnel (tunneld.py) e i worker web (app.py, anche sotto gunicorn):
+una richiesta JSON per riga {"method", "params"}, una risposta per riga {"result"} o {"error"}.
+I metodi in streaming (event_stream) usano una connessione dedicata e rispondono con più righe {"item"}
+"""
+
+import socketserver
+import threading
+import logging
+import socket
+import time
+import os
+from metrics import REGISTRY as METRICS
+from response_encoding import dumps, loads
+
+# Attesa massima di una risposta (gli avvii in blocco non hanno limite: durano quanto gli avvii stessi)
+RPC_TIMEOUT_SECONDS = float(os.environ.get('TUNNEL_MANAGER_RPC_TIMEOUT_SECONDS', 120))
+MAX_MESSAGE_BYTES = 64 * 1024 * 1024
+
+# Metodi del manager esposti dal demone; argomenti e risultati serializzabili in JSON
+METHODS = ('readiness', 'status_version', 'get_status', 'start_tunnel_for_service', 'start_tunnels_batch',
+           'stop_tunnel_for_service', 'stop_all_tunnels', 'read_logs', 'tunnel_stats', 'get_profiles', 'pool_stats', 'cloudflared_metrics_summary', 'debug_info', 'metrics_text')
+STREAM_METHODS = ('event_stream',)
+
+RPC_SECONDS = METRICS.histogram('tunnel_manager_rpc_seconds', "Durata delle chiamate RPC servite dal demone", ['method'])
+
+
+class RPCError(Exception):
+    """Errore restituito dal demone oppure demone non raggiungibile."""
+
+
+def encode(message):
+    return dumps(message) + b'\n'
+
+
+class RPCHandler(socketserver.StreamRequestHandler):
+    # Una connessione per worker/thread, tenuta aperta: più richieste in sequenza
+    def handle(self):
+        manager = self.server.manager
+        while True:
+            line = self.rfile.readline(MAX_MESSAGE_BYTES)
+            if not line:
+                return
+            try:
+                request = loads(line)
+                method, params = request['method'], request.get('params') or {}
+                if method in STREAM_METHODS:
+                    self.stream(getattr(manager, method)(**params))
+                    return
+                if method not in METHODS:
+                    raise RPCError(f"Metodo sconosciuto: {method}")
+                started = time.perf_counter()
+                result = getattr(manager, method)(**params)
+                RPC_SECONDS.observe(time.perf_counter() - started, method)
+                response = {'result': result}
+            except Exception as e:
+                logging.error(f"RPC: errore nella richiesta {line[:200]!r}: {e}", exc_info=not isinstance(e, (RPCError, TypeError)))
+                response = {'error': f"{e.__class__.__name__}: {e}"}
+            try:
+                self.wfile.write(encode(response))
+            except OSError:
+                return # Client disconnesso
+
+    def stream(self, items):
+        try:
+            for item in items:
+                self.wfile.write(encode({'item': item}))
+        except OSError:
+            pass # Client disconnesso: la chiusura del generatore rilascia la sottoscrizione
+        finally:
+            items.close()
+
+
+class RPCServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, manager, path):
+        self.manager = manager
+        self.path = path
+        remove_stale_socket(path)
+        super().__init__(path, RPCHandler)
+        os.chmod(path, 0o660) # Utente e gruppo del demone: i worker web devono condividerne il gruppo
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_stale_socket(path):
+    """Rimuove il socket lasciato da un demone terminato; errore se un altro demone è in ascolto."""
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise RuntimeError(f"Un demone dei tunnel è già in ascolto su {path}")
+    finally:
+        probe.close()
+
+
+class RPCClient:
+    """Client con una connessione per thread (i worker gthread di gunicorn servono richieste in parallelo)."""
+
+    def __init__(self, path, timeout=RPC_TIMEOUT_SECONDS):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            raise RPCError(f"Demone dei tunnel non raggiungibile su {self.path}: {e}") from e
+        return sock, sock.makefile('rb')
+
+    def _drop(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection:
+            for resource in reversed(connection):
+                resource.close()
+
+    def call(self, method, params=None, timeout=RPC_TIMEOUT_SECONDS):
+        request = encode({'method': method, 'params': params or {}})
+        for attempt in (1, 2):
+            connection = getattr(self._local, 'connection', None)
+            reused = connection is not None
+            if not reused:
+                connection = self._local.connection = self._connect(timeout)
+            sock, reader = connection
+            try:
+                sock.settimeout(timeout)
+                sock.sendall(request)
+                line = reader.readline(MAX_MESSAGE_BYTES)
+            except socket.timeout as e:
+                self._drop() # Risposta ancora in arrivo: la connessione non è più allineata
+                raise RPCError(f"Nessuna risposta dal demone dei tunnel a {method} entro {timeout}s") from e
+            except OSError as e:
+                self._drop()
+                if reused and attempt == 1:
+                    continue
+                raise RPCError(f"Errore di comunicazione con il demone dei tunnel: {e}") from e
+            if not line:
+                self._drop()
+                # Connessione inattiva chiusa dal demone (es. riavviato): si riprova una volta su una nuova
+                if reused and attempt == 1:
+                    continue
+                raise RPCError("Connessione chiusa dal demone dei tunnel")
+            response = loads(line)
+            if 'error' in response:
+                raise RPCError(response['error'])
+            return response['result']
+
+    def stream(self, method, params=None):
+        sock, reader = self._connect(None) # Senza timeout: il demone invia keep-alive (None) a intervalli
+        try:
+            sock.sendall(encode({'method': method, 'params': params or {}}))
+            for line in reader:
+                response = loads(line)
+                if 'error' in response:
+                    raise RPCError(response['error'])
+                yield response['item']
+        finally:
+            reader.close()
+            sock.close()
+
+
+class RemoteTunnelManager:
+    """Stessa API di UniversalTunnelManager usata da app.py, servita dal demone tunneld.py."""
+
+    def __init__(self, path):
+        self.path = path
+        self.client = RPCClient(path)
+
+    def readiness(self):
+        return self.client.call('readiness')
+
+    def status_version(self):
+        return self.client.call('status_version')
+
+    def get_status(self, since=None):
+        return self.client.call('get_status', {'since': since})
+
+    def event_stream(self):
+        for item in self.client.stream('event_stream'):
+            yield tuple(item) if item else None
+
+    def start_tunnel_for_service(self, service_name, port, duration_hours=None, profile=None, idle_timeout_minutes=None):
+        return tuple(self.client.call('start_tunnel_for_service', {'service_name': service_name, 'port': port,
+                                                                   'duration_hours': duration_hours, 'profile': profile,
+                                                                   'idle_timeout_minutes': idle_timeout_minutes}))
+
+    def start_tunnels_batch(self, items, concurrency=None, wait_for_urls=True):
+        return tuple(self.client.call('start_tunnels_batch',
+                                      {'items': items, 'concurrency': concurrency, 'wait_for_urls': wait_for_urls},
+                                      timeout=None))
+
+    def stop_tunnel_for_service(self, service_name, reason="richiesta utente"):
+        return tuple(self.client.call('stop_tunnel_for_service', {'service_name': service_name, 'reason': reason}))
+
+    def stop_all_tunnels(self, reason="richiesta utente globale"):
+        return tuple(self.client.call('stop_all_tunnels', {'reason': reason}))
+
+    def read_logs(self, service_name, count=None, after=0, wait=None):
+        return self.client.call('read_logs', {'service_name': service_name, 'count': count, 'after': after, 'wait': wait},
+                                timeout=RPC_TIMEOUT_SECONDS + (wait or 0))
+
+    def tunnel_stats(self, service_name):
+        return self.client.call('tunnel_stats', {'service_name': service_name})
+
+    def get_profiles(self):
+        return self.client.call('get_profiles')
+
+    def pool_stats(self):
+        return self.client.call('pool_stats')
+
+    def cloudflared_metrics_summary(self):
+        return self.client.call('cloudflared_metrics_summary')
+
+    def debug_info(self):
+        return self.client.call('debug_info')
+
+    def metrics_text(self):
+        return self.client.call('metrics_text')
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Scheduler a scadenze ordinate (min-heap) per le azioni temporizzate dei tunnel: scadenza, preavviso, pulizia
+"""
+
+import heapq
+import itertools
+import threading
+import logging
+import time
+
+# Attesa massima tra due controlli: protegge da salti dell'orologio di sistema (NTP, sospensione)
+MAX_WAIT_SECONDS = 60
+
+
+class DeadlineScheduler:
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._heap = []       # (deadline, seq, key); le voci riprogrammate restano come voci obsolete
+        self._entries = {}    # {key: (deadline, seq, action, args)} voce valida per ogni chiave
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, key, deadline, action, *args):
+        """Programma action(*args) a deadline; una voce già presente per key viene sostituita (O(log n))."""
+        with self._cond:
+            seq = next(self._seq)
+            self._entries[key] = (deadline, seq, action, args)
+            heapq.heappush(self._heap, (deadline, seq, key))
+            if len(self._heap) > 2 * len(self._entries) + 64:
+                self._compact()
+            if self._heap[0][1] == seq:
+                self._cond.notify()  # Nuova prima scadenza: il thread deve svegliarsi prima
+
+    def cancel(self, key):
+        with self._cond:
+            return self._entries.pop(key, None) is not None
+
+    def deadline_of(self, key):
+        entry = self._entries.get(key)
+        return entry[0] if entry else None
+
+    def _compact(self):
+        self._heap = [(deadline, seq, key) for key, (deadline, seq, _, _) in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def _discard_stale(self):
+        while self._heap:
+            deadline, seq, key = self._heap[0]
+            entry = self._entries.get(key)
+            if entry and entry[1] == seq:
+                return
+            heapq.heappop(self._heap)
+
+    def next_deadline(self):
+        with self._cond:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """Rimuove e restituisce [(key, action, args)] delle voci scadute, in ordine di scadenza."""
+        now = self.clock() if now is None else now
+        due = []
+        with self._cond:
+            while True:
+                self._discard_stale()
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                _, _, key = heapq.heappop(self._heap)
+                _, _, action, args = self._entries.pop(key)
+                due.append((key, action, args))
+        return due
+
+    def run(self):
+        logging.info("Avvio scheduler scadenze tunnel...")
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    self._discard_stale()
+                    if self._heap:
+                        delay = self._heap[0][0] - self.clock()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(min(delay, MAX_WAIT_SECONDS))
+                    else:
+                        self._cond.wait()
+                if self._stopped:
+                    break
+            for key, action, args in self.pop_due():
+                try:
+                    action(*args)
+                except Exception as e:
+                    logging.error(f"Errore azione programmata {key}: {e}", exc_info=True)
+        logging.info("Scheduler scadenze tunnel fermato.")
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Inventario in memoria dei servizi Docker, aggiornato dallo stream eventi della Docker Engine API
+"""
+
+import collections
+import threading
+import time
+import logging
+from types import MappingProxyType
+from docker_client import DockerClient
+from tunnel_registry import VersionClock
+
+RESYNC_INTERVAL_SECONDS = 300
+EVENTS_RESTART_DELAY_SECONDS = 5
+
+# Come RegistrySnapshot: services è la lista dei servizi "Up", changed {nome: versione dell'ultima modifica}
+InventorySnapshot = collections.namedtuple('InventorySnapshot', ['version', 'services', 'changed'])
+
+# Eventi container che possono cambiare nome, stato o porte pubblicate
+CONTAINER_ACTIONS = {
+    'create', 'start', 'restart', 'stop', 'die', 'kill', 'pause', 'unpause',
+    'rename', 'update', 'oom', 'destroy'
+}
+
+
+def extract_ports(ports):
+    """Porte TCP pubblicate su tutte le interfacce, oppure solo su 127.0.0.1 se non ce ne sono."""
+    if not ports: return []
+    public = {p['PublicPort'] for p in ports if p.get('PublicPort') and p.get('Type') == 'tcp' and p.get('IP') in ('0.0.0.0', '::')}
+    if not public:
+        public = {p['PublicPort'] for p in ports if p.get('PublicPort') and p.get('Type') == 'tcp' and p.get('IP') == '127.0.0.1'}
+    return sorted(public)
+
+
+def service_from_container(container):
+    names = container.get('Names') or ['']
+    return {
+        'name': names[0].lstrip('/'), 'status': container.get('Status', ''),
+        'ports': extract_ports(container.get('Ports')), 'image': container.get('Image') or "unknown"
+    }
+
+
+class ServiceInventory:
+    def __init__(self, docker=None, resync_interval=RESYNC_INTERVAL_SECONDS, clock=None):
+        self.docker = docker or DockerClient()
+        self.resync_interval = resync_interval
+        self.clock = clock or VersionClock()
+        self._lock = threading.Lock()
+        self._containers = {}  # {container_id: servizio}, anche i container fermi
+        self._snapshot = InventorySnapshot(self.clock.origin, [], MappingProxyType({}))  # Vista dei soli container "Up"
+        self.last_sync_time = None
+        self.events_received = 0
+        self.listeners = []    # callback(kind, name, service) per 'added', 'changed', 'removed'
+        self.shutdown_event = threading.Event()
+        self._events = None    # Stream eventi aperto da start() prima della prima risincronizzazione
+        self.events_thread = threading.Thread(target=self.follow_events, daemon=True, name="DockerEvents")
+        self.resync_thread = threading.Thread(target=self.resync_periodically, daemon=True, name="DockerResync")
+
+    def start(self):
+        # Prima la sottoscrizione, poi la lista: gli eventi dei container cambiati durante la risincronizzazione
+        # restano nello stream e vengono applicati subito dopo
+        self._events = self._open_events()
+        self.resync()
+        self.events_thread.start()
+        self.resync_thread.start()
+
+    def stop(self):
+        self.shutdown_event.set()
+        self.docker.close()
+
+    def get_services(self):
+        return self._snapshot.services
+
+    def snapshot(self):
+        return self._snapshot
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def _rebuild_services(self):
+        # Chiamato con self._lock acquisito; i lettori vedono sempre una lista completa
+        old = {svc['name']: svc for svc in self._snapshot.services}
+        services = sorted(
+            (svc for svc in self._containers.values() if "Up" in svc['status']),
+            key=lambda svc: svc['name']
+        )
+        changes = []
+        for svc in services:
+            previous = old.pop(svc['name'], None)
+            if previous is None:
+                changes.append(('added', svc['name'], svc))
+            elif previous != svc:
+                changes.append(('changed', svc['name'], svc))
+        changes.extend(('removed', name, None) for name in old)
+        if changes:
+            def swap(version):
+                changed = dict(self._snapshot.changed)
+                changed.update((name, version) for _, name, _ in changes)
+                self._snapshot = InventorySnapshot(version, services, MappingProxyType(changed))
+            self.clock.tick(swap)
+        return changes
+
+    def _notify(self, changes):
+        for kind, name, service in changes:
+            for callback in self.listeners:
+                try:
+                    callback(kind, name, service)
+                except Exception as e:
+                    logging.error(f"Errore notifica inventario Docker ({kind} {name}): {e}")
+
+    def _list_containers(self, filters=None):
+        return {
+            container['Id']: service_from_container(container)
+            for container in self.docker.list_containers(all=True, filters=filters)
+        }
+
+    def resync(self):
+        try:
+            containers = self._list_containers()
+        except Exception as e:
+            logging.error(f"Errore risincronizzazione servizi Docker: {e}")
+            return False
+        with self._lock:
+            self._containers = containers
+            changes = self._rebuild_services()
+            self.last_sync_time = time.time()
+        self._notify(changes)
+        logging.debug(f"Inventario Docker risincronizzato: {len(containers)} container")
+        return True
+
+    def refresh_container(self, container_id):
+        try:
+            found = self._list_containers({'id': [container_id]})
+        except Exception as e:
+            logging.error(f"Errore aggiornamento container {container_id[:12]}: {e}")
+            return
+        with self._lock:
+            service = found.get(container_id)
+            if service is None:
+                self._containers.pop(container_id, None)
+            elif self._containers.get(container_id) != service:
+                self._containers[container_id] = service
+            else:
+                return
+            changes = self._rebuild_services()
+        self._notify(changes)
+
+    def remove_container(self, container_id):
+        with self._lock:
+            if self._containers.pop(container_id, None) is None:
+                return
+            changes = self._rebuild_services()
+        self._notify(changes)
+
+    def handle_event(self, event):
+        if event.get('Type', 'container') != 'container':
+            return
+        action = (event.get('Action') or event.get('status') or '').split(':')[0]
+        container_id = event.get('id') or event.get('Actor', {}).get('ID')
+        if not container_id or action not in CONTAINER_ACTIONS:
+            return
+        self.events_received += 1
+        if action == 'destroy':
+            self.remove_container(container_id)
+        else:
+            self.refresh_container(container_id)
+
+    def _open_events(self):
+        try:
+            return self.docker.events(filters={'type': ['container']})
+        except Exception as e:
+            logging.error(f"Errore apertura stream eventi Docker: {e}")
+            return None
+
+    def follow_events(self):
+        logging.info("Avvio ascolto eventi Docker...")
+        events, self._events = self._events, None
+        while not self.shutdown_event.is_set():
+            try:
+                if events is None:
+                    events = self.docker.events(filters={'type': ['container']})
+                    # Gli eventi persi mentre lo stream era giù vengono recuperati con una risincronizzazione
+                    self.resync()
+                for event in events:
+                    self.handle_event(event)
+                if not self.shutdown_event.is_set():
+                    logging.warning("Stream eventi Docker terminato, riavvio...")
+            except Exception as e:
+                if not self.shutdown_event.is_set():
+                    logging.error(f"Errore stream eventi Docker: {e}")
+            events = None
+            self.shutdown_event.wait(EVENTS_RESTART_DELAY_SECONDS)
+        logging.info("Ascolto eventi Docker fermato.")
+
+    def resync_periodically(self):
+        while not self.shutdown_event.wait(self.resync_interval):
+            self.resync()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Supervisore asyncio unico per tutti i processi cloudflared: un solo event loop, una coroutine per tunnel
+"""
+
+import asyncio
+import subprocess
+import threading
+import warnings
+import logging
+import signal
+import psutil
+import stat
+import time
+import sys
+import os
+from log_buffer import LogRingBuffer
+from tunnel_profiles import BUILTIN_PROFILES, profile_args
+from cloudflared_metrics import metrics_args
+from cloudflared_parser import parse_line, output_args, error_text, EVENT_URL, EVENT_CONNECTION, EVENT_ERROR, EVENT_RATE_LIMITED
+
+URL_CAPTURE_TIMEOUT_SECONDS = 35
+PIPE_DRAIN_GRACE_SECONDS = 1
+POOL_SLOT_ENV = "TUNNEL_MANAGER_POOL_SLOT"  # Marca nell'ambiente i cloudflared del pool (vedi tunnel_pool.py)
+STOP_GRACE_SECONDS = 3   # Attesa dopo SIGTERM prima di passare a SIGKILL
+KILL_WAIT_SECONDS = 2    # Attesa della terminazione dopo SIGKILL
+CLOUDFLARED_BIN = os.environ.get('CLOUDFLARED_BIN', 'cloudflared')  # Es. benchmarks/fakes/cloudflared per i test di carico
+
+def use_pidfd_child_watcher(loop):
+    # Fino a Python 3.11 il watcher di default (ThreadedChildWatcher) crea un thread per ogni figlio;
+    # con pidfd l'uscita dei processi arriva direttamente all'event loop
+    if sys.version_info >= (3, 12) or not hasattr(asyncio, 'PidfdChildWatcher') or not hasattr(os, 'pidfd_open'):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return False
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(loop)
+        asyncio.get_event_loop_policy().set_child_watcher(watcher)
+    return True
+
+
+def build_tunnel_command(url, profile=None, metrics_port=None):
+    """profile: opzioni di un profilo di tunnel_profiles.py (default: quelle del profilo 'default' predefinito);
+    metrics_port: porta locale delle metriche Prometheus di cloudflared (--metrics)."""
+    return [CLOUDFLARED_BIN, "tunnel", *output_args(), "--url", url, "--no-autoupdate",
+            *profile_args(profile or BUILTIN_PROFILES['default']), *metrics_args(metrics_port)]
+
+
+def tunnel_target(cmdline):
+    """Restituisce il valore di --url nella riga di comando di cloudflared, oppure None."""
+    for i, arg in enumerate(cmdline):
+        if arg == '--url' and i + 1 < len(cmdline):
+            return cmdline[i + 1]
+        if arg.startswith('--url='):
+            return arg[len('--url='):]
+    return None
+
+
+def find_cloudflared_processes():
+    """Processi cloudflared vivi con --url: {pid: {'cmdline', 'target', 'create_time', 'pool_slot'}}."""
+    found = {}
+    for proc in psutil.process_iter(['pid', 'cmdline', 'create_time']):
+        cmdline = proc.info.get('cmdline') or []
+        # cloudflared può essere avviato anche tramite un interprete o uno script wrapper
+        if not any(os.path.basename(arg) in ('cloudflared', os.path.basename(CLOUDFLARED_BIN)) for arg in cmdline[:2]):
+            continue
+        target = tunnel_target(cmdline)
+        if target:
+            try:
+                pool_slot = proc.environ().get(POOL_SLOT_ENV)
+            except psutil.Error:
+                pool_slot = None
+            found[proc.info['pid']] = {'cmdline': cmdline, 'target': target,
+                                       'create_time': proc.info['create_time'], 'pool_slot': pool_slot}
+    return found
+
+
+class AdoptedProcess:
+    """Processo cloudflared sopravvissuto a un riavvio del manager: non è un figlio, l'uscita arriva tramite pidfd."""
+
+    def __init__(self, loop, pid):
+        self.loop = loop
+        self.pid = pid
+        self.returncode = None
+        self._pidfd = os.pidfd_open(pid)
+        self._exited = loop.create_future()
+        loop.add_reader(self._pidfd, self._on_exit)
+
+    def _on_exit(self):
+        self.loop.remove_reader(self._pidfd)
+        os.close(self._pidfd)
+        self._pidfd = None
+        self.returncode = -1  # Il codice di uscita di un processo non figlio non è disponibile
+        if not self._exited.done():
+            self._exited.set_result(self.returncode)
+
+    async def wait(self):
+        return await asyncio.shield(self._exited)
+
+    def send_signal(self, sig):
+        if self._pidfd is None:
+            raise ProcessLookupError(self.pid)
+        # Segnale tramite pidfd: nessun rischio di colpire un processo che ha riusato il PID
+        signal.pidfd_send_signal(self._pidfd, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class TunnelProcess:
+    """Handle di un processo cloudflared utilizzabile anche da thread esterni al loop (interfaccia simile a Popen)."""
+
+    def __init__(self, loop, service_name, cmd):
+        self.loop = loop
+        self.service_name = service_name
+        self.cmd = cmd
+        self.proc = None
+        self.pid = None
+        self.returncode = None
+        self.start_time = time.time()
+        self.url = None
+        self.url_label = None
+        self.url_time = None
+        self.connections = 0       # Connessioni all'edge registrate
+        self.last_error = None     # Ultimo messaggio di errore di cloudflared
+        self.rate_limited = False  # trycloudflare.com ha rifiutato la richiesta (429)
+        self.stopping = False
+        self.exited = threading.Event()
+        self.url_found = asyncio.Event()
+        self.capture_done = asyncio.Event()
+        self.logs = LogRingBuffer()
+        self.adopted = False
+        self.on_url = None  # Callback specifiche del processo (es. slot del pool); altrimenti quelle del manager
+        self.on_exit = None
+        self.streams = []   # [(nome, StreamReader, transport)] delle pipe di output
+        self.task = None
+
+    def poll(self):
+        return self.returncode
+
+    def _signal(self, method):
+        if self.returncode is None and self.proc is not None:
+            try: getattr(self.proc, method)()
+            except ProcessLookupError: pass
+
+    def terminate(self):
+        self.loop.call_soon_threadsafe(self._signal, 'terminate')
+
+    def kill(self):
+        self.loop.call_soon_threadsafe(self._signal, 'kill')
+
+    def wait(self, timeout=None):
+        if not self.exited.wait(timeout):
+            raise subprocess.TimeoutExpired(self.cmd, timeout)
+        return self.returncode
+
+
+class AsyncTunnelManager:
+    """API awaitable per avviare, osservare e fermare processi cloudflared dentro un event loop."""
+
+    def __init__(self, on_url=None, on_exit=None, url_timeout=URL_CAPTURE_TIMEOUT_SECONDS):
+        self.on_url = on_url    # callback(handle, url o None, etichetta pattern)
+        self.on_exit = on_exit  # callback(handle)
+        self.url_timeout = url_timeout
+        self.processes = {}     # {service_name: TunnelProcess}
+
+    async def _callback(self, callback, *args):
+        # Le callback toccano stato e file del manager: girano fuori dal loop per non bloccarlo.
+        # Le coroutine (es. quelle del pool) girano invece direttamente nel loop
+        if callback:
+            try:
+                if asyncio.iscoroutinefunction(callback):
+                    await callback(*args)
+                else:
+                    await asyncio.get_running_loop().run_in_executor(None, callback, *args)
+            except Exception as e:
+                logging.error(f"Errore callback supervisore: {e}", exc_info=True)
+
+    @staticmethod
+    async def _open_stream(fd):
+        reader = asyncio.StreamReader()
+        transport, _ = await asyncio.get_running_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+        return reader, transport
+
+    async def start_tunnel(self, service_name, cmd, env=None, on_url=None, on_exit=None):
+        loop = asyncio.get_running_loop()
+        handle = TunnelProcess(loop, service_name, cmd)
+        handle.on_url, handle.on_exit = on_url, on_exit
+        # Pipe create qui e non da asyncio: il figlio riceve anche il lato di lettura, così una scrittura
+        # su stdout/stderr non fallisce (EPIPE) se il manager muore, e un nuovo manager può riaprirle
+        # da /proc/<pid>/fd per riadottare il processo. Nuova sessione: un Ctrl-C al manager non lo ferma.
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        try:
+            handle.proc = await asyncio.create_subprocess_exec(
+                *cmd, stdin=subprocess.DEVNULL, stdout=out_w, stderr=err_w,
+                pass_fds=(out_r, err_r), start_new_session=True,
+                env={**os.environ, **env} if env else None
+            )
+        except BaseException:
+            for fd in (out_r, err_r): os.close(fd)
+            raise
+        finally:
+            for fd in (out_w, err_w): os.close(fd)
+        handle.pid = handle.proc.pid
+        for name, fd in (('stderr', err_r), ('stdout', out_r)):
+            reader, transport = await self._open_stream(fd)
+            handle.streams.append((name, reader, transport))
+        self.processes[service_name] = handle
+        handle.task = loop.create_task(self._supervise(handle), name=f"Tunnel-{service_name}")
+        return handle
+
+    async def adopt_tunnel(self, service_name, pid, cmd, url):
+        """Riprende la supervisione di un cloudflared avviato da un'istanza precedente del manager."""
+        loop = asyncio.get_running_loop()
+        handle = TunnelProcess(loop, service_name, cmd)
+        handle.proc = AdoptedProcess(loop, pid)
+        handle.pid = pid
+        handle.adopted = True
+        handle.url, handle.url_label = url, "riadottato"
+        handle.url_found.set()
+        handle.capture_done.set()
+        handle.logs.append('manager', "…[processo riadottato dopo il riavvio del manager]")
+        for name, fd_number in (('stderr', 2), ('stdout', 1)):
+            try:
+                fd = os.open(f"/proc/{pid}/fd/{fd_number}", os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                continue
+            if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+                os.close(fd) # Output su file o terminale (processo avviato a mano): niente da leggere
+                continue
+            reader, transport = await self._open_stream(fd)
+            handle.streams.append((name, reader, transport))
+        self.processes[service_name] = handle
+        handle.task = loop.create_task(self._supervise(handle), name=f"Tunnel-{service_name}")
+        return handle
+
+    async def _supervise(self, handle):
+        logging.info(f"Monitoraggio output per {handle.service_name} (PID: {handle.pid})...")
+        # Entrambe le pipe vengono lette per tutta la vita del processo: una pipe piena bloccherebbe cloudflared
+        drains = [asyncio.ensure_future(self._drain(handle, reader, name)) for name, reader, _ in handle.streams]
+        # La cattura gira a parte: chi attende l'uscita (stop) non dipende dalla callback on_url
+        capture = None if handle.capture_done.is_set() else asyncio.ensure_future(self.capture_url(handle))
+        handle.returncode = await handle.proc.wait()
+        # Un eventuale figlio rimasto può tenere aperte le pipe: non si aspetta all'infinito l'EOF
+        if drains:
+            _, pending = await asyncio.wait(drains, timeout=PIPE_DRAIN_GRACE_SECONDS)
+            for task in pending: task.cancel()
+        for _, _, transport in handle.streams: transport.close()
+        handle.logs.close()
+        handle.exited.set()
+        if capture: await capture
+        if self.processes.get(handle.service_name) is handle:
+            del self.processes[handle.service_name]
+        if not handle.stopping:
+            logging.warning(f"Processo cloudflared per {handle.service_name} terminato (codice: {handle.returncode}).")
+        await self._callback(handle.on_exit or self.on_exit, handle)
+
+    async def _drain(self, handle, stream, stream_name):
+        while True:
+            try:
+                raw = await stream.readline()
+            except ValueError:
+                # Riga oltre il limite dello StreamReader: è già stata scartata dal buffer interno
+                handle.logs.append(stream_name, "…[riga troppo lunga scartata]")
+                continue
+            if not raw:
+                break
+            event = parse_line(raw.decode('utf-8', errors='replace').rstrip('\r\n'))
+            handle.logs.append(stream_name, event.text)
+            if event.kind == EVENT_CONNECTION:
+                handle.connections += 1
+            elif event.kind == EVENT_ERROR:
+                handle.last_error = error_text(event)
+            elif event.kind == EVENT_RATE_LIMITED:
+                handle.last_error = error_text(event)
+                if not handle.rate_limited:
+                    handle.rate_limited = True
+                    logging.warning(f"Richiesta di quick tunnel limitata da Cloudflare (429) per {handle.service_name}.")
+            elif event.kind == EVENT_URL and handle.url is None:
+                handle.url, handle.url_label, handle.url_time = event.url, event.label, time.time()
+                handle.url_found.set()
+                if handle.capture_done.is_set():
+                    # URL arrivato dopo il timeout di cattura: il manager viene comunque aggiornato
+                    logging.info(f"URL tunnel trovato in ritardo per {handle.service_name} (pattern {event.label}): {event.url}")
+                    await self._callback(handle.on_url or self.on_url, handle, event.url, event.label)
+
+    async def capture_url(self, handle):
+        handle.capture_done.clear()
+        url_wait = asyncio.ensure_future(handle.url_found.wait())
+        exit_wait = asyncio.ensure_future(handle.proc.wait())
+        await asyncio.wait({url_wait, exit_wait}, timeout=self.url_timeout, return_when=asyncio.FIRST_COMPLETED)
+        url_wait.cancel()
+        exit_wait.cancel()
+        tunnel_url, label = handle.url, handle.url_label
+        if tunnel_url:
+            logging.info(f"URL tunnel trovato per {handle.service_name} (pattern {label}): {tunnel_url}")
+        else:
+            if handle.proc.returncode is not None:
+                if not handle.stopping:
+                    logging.warning(f"Processo cloudflared per {handle.service_name} terminato prematuramente"
+                                    f"{' (limite di richieste di Cloudflare)' if handle.rate_limited else ''}: {handle.last_error}")
+            else:
+                logging.warning(f"Timeout ({self.url_timeout}s) ricerca URL per {handle.service_name}.")
+            logging.debug(f"Log buffer per {handle.service_name} (ricerca URL fallita):\n" + "\n".join(
+                entry['line'] for entry in handle.logs.tail(20)))
+        handle.capture_done.set()
+        await self._callback(handle.on_url or self.on_url, handle, tunnel_url, label)
+        return tunnel_url
+
+    async def wait_for_url(self, service_name, timeout=None):
+        handle = self.processes.get(service_name)
+        if not handle:
+            return None
+        try:
+            await asyncio.wait_for(handle.capture_done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return handle.url
+
+    async def wait_for_captures(self, handles, timeout=None):
+        """Attende la fine della ricerca URL di più processi insieme (timeout unico per tutti)."""
+        waits = [asyncio.ensure_future(handle.capture_done.wait()) for handle in handles]
+        if not waits:
+            return
+        _, pending = await asyncio.wait(waits, timeout=timeout)
+        for task in pending: task.cancel()
+
+    async def terminate_many(self, handles, grace=STOP_GRACE_SECONDS, kill_wait=KILL_WAIT_SECONDS):
+        """SIGTERM a tutti i processi insieme, SIGKILL a quelli ancora vivi alla scadenza comune.
+        Restituisce il conteggio {'terminated', 'killed', 'unresponsive'}."""
+        handles = [handle for handle in handles if handle.proc is not None]
+        for handle in handles:
+            handle.stopping = True
+            handle._signal('terminate')
+        waits = {asyncio.ensure_future(handle.proc.wait()): handle for handle in handles}
+        result = {'terminated': 0, 'killed': 0, 'unresponsive': 0}
+        if not waits:
+            return result
+        done, pending = await asyncio.wait(waits, timeout=grace)
+        result['terminated'] = len(done)
+        if pending:
+            logging.warning(f"Timeout SIGTERM per {len(pending)} tunnel, invio SIGKILL: "
+                            f"{', '.join(sorted(waits[task].service_name for task in pending))}")
+            for task in pending:
+                waits[task]._signal('kill')
+            killed, pending = await asyncio.wait(pending, timeout=kill_wait)
+            result['killed'] = len(killed)
+            for task in pending:
+                task.cancel()
+                logging.error(f"Processo {waits[task].service_name} (PID: {waits[task].pid}) non risponde a SIGKILL.")
+            result['unresponsive'] = len(pending)
+        return result
+
+    async def stop_tunnel(self, service_name, grace=STOP_GRACE_SECONDS):
+        handle = self.processes.get(service_name)
+        if not handle:
+            return None
+        await self.terminate_many([handle], grace)
+        return handle.proc.returncode
+
+    async def stop_all(self, grace=STOP_GRACE_SECONDS):
+        return await self.terminate_many(list(self.processes.values()), grace)
+
+
+class TunnelSupervisor:
+    """Esegue un AsyncTunnelManager in un thread dedicato e lo espone al codice sincrono (Flask)."""
+
+    def __init__(self, on_url=None, on_exit=None):
+        self.loop = asyncio.new_event_loop()
+        self.manager = AsyncTunnelManager(on_url=on_url, on_exit=on_exit)
+        self.thread = threading.Thread(target=self._run, daemon=True, name="TunnelSupervisor")
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        if use_pidfd_child_watcher(self.loop):
+            logging.debug("Supervisore: uscita processi rilevata tramite pidfd")
+        self.thread.start()
+
+    def call(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def spawn(self, service_name, cmd):
+        return self.call(self.manager.start_tunnel(service_name, cmd), timeout=10)
+
+    def wait_for_urls(self, handles, timeout=URL_CAPTURE_TIMEOUT_SECONDS + 5):
+        self.call(self.manager.wait_for_captures(handles, timeout), timeout=timeout + 5)
+
+    def terminate(self, handles, grace=STOP_GRACE_SECONDS, kill_wait=KILL_WAIT_SECONDS, wait=True):
+        """Termina i processi in parallelo; con wait=False restituisce subito un concurrent.futures.Future."""
+        future = asyncio.run_coroutine_threadsafe(self.manager.terminate_many(handles, grace, kill_wait), self.loop)
+        if not wait:
+            return future
+        return future.result(grace + kill_wait + 2)
+
+    def adopt(self, service_name, pid, cmd, url):
+        return self.call(self.manager.adopt_tunnel(service_name, pid, cmd, url), timeout=10)
+
+    def recapture_url(self, handle):
+        if handle.capture_done.is_set(): # Una cattura ancora in corso riporterà comunque l'URL
+            asyncio.run_coroutine_threadsafe(self.manager.capture_url(handle), self.loop)
+
+    async def _detach_all(self):
+        # I processi ancora vivi restano in esecuzione: un nuovo manager potrà riadottarli
+        handles = list(self.manager.processes.values())
+        for handle in handles:
+            for _, _, transport in handle.streams: transport.close()
+        tasks = [handle.task for handle in handles if handle.task]
+        for task in tasks: task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        if not self.thread.is_alive():
+            return
+        try:
+            self.call(self._detach_all(), timeout=2)
+        except Exception as e:
+            logging.debug(f"Supervisore: errore nel rilascio dei processi: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=3)
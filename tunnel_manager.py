@@ -1,718 +1,990 @@
 #!/usr/bin/env python3
 """
-Interfaccia Web Universale per gestire tunnel Cloudflare per tutti i servizi Docker
+Gestore dei tunnel Cloudflare per i servizi Docker: registro, processi cloudflared, scadenze e persistenza.
+Viene eseguito dentro app.py (processo unico) oppure nel demone tunneld.py, a cui i worker web si collegano via rpc.py
 """
 
 import subprocess
 import psutil
-import re
 import time
-import json
 import os
-from flask import Flask, render_template, jsonify, request
+import signal
 import threading
 import socket
-from datetime import datetime, timedelta # Aggiunto per la scadenza
-
-app = Flask(__name__)
-
-DEFAULT_TUNNEL_DURATION_HOURS = 48 # Ore
+from datetime import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from service_inventory import ServiceInventory, extract_ports
+from event_bus import EventBus
+from supervisor import TunnelSupervisor, STOP_GRACE_SECONDS, KILL_WAIT_SECONDS, build_tunnel_command, find_cloudflared_processes
+from scheduler import DeadlineScheduler
+from persistence import ConfigStore
+from tunnel_pool import TunnelPool
+from prober import LatencyProber, ProbeTarget, percentile
+from resource_sampler import ResourceSampler
+from idle_reaper import IdleReaper, IdleTarget, IDLE_TIMEOUT_MINUTES
+from cloudflared_metrics import CloudflaredMetricsScraper, metrics_enabled, allocate_metrics_port, metrics_address
+from tunnel_registry import TunnelRegistry, VersionClock
+from tunnel_profiles import load_profiles, PROFILES_FILE, DEFAULT_PROFILE
+from metrics import REGISTRY as METRICS, SLOW_BUCKETS
+
+DEFAULT_TUNNEL_DURATION_HOURS = 48
+EXPIRATION_WARNING_SECONDS = 15 * 60 # Preavviso (evento tunnel_expiring) prima della scadenza
+START_CONCURRENCY = int(os.environ.get('TUNNEL_START_CONCURRENCY', 8)) # Avvii in parallelo per /api/start-tunnels
+# Tempo totale concesso all'arresto (docker stop invia SIGKILL dopo 10 s)
+SHUTDOWN_BUDGET_SECONDS = float(os.environ.get('SHUTDOWN_BUDGET_SECONDS', 8))
+# Con KEEP_TUNNELS_ON_SHUTDOWN=1 l'arresto lascia vivi i cloudflared, che il manager riavviato riadotta
+KEEP_TUNNELS_ON_SHUTDOWN = os.environ.get('KEEP_TUNNELS_ON_SHUTDOWN', '').lower() in ('1', 'true', 'yes')
+# Directory dei dati (es. per i benchmark in benchmarks/loadtest.py)
+DATA_DIR = os.environ.get('TUNNEL_MANAGER_DATA_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+ADOPTION_START_TIME_TOLERANCE_SECONDS = 60
+# Attesa massima della fine dell'avvio per avvii e stop richiesti mentre il manager si sta ancora avviando
+STARTUP_WAIT_SECONDS = float(os.environ.get('TUNNEL_MANAGER_STARTUP_WAIT_SECONDS', 30))
+STARTING_MESSAGE = "Manager in avvio (configurazione e servizi Docker in caricamento): riprovare tra poco."
+# Riavvio dei cloudflared terminati inaspettatamente, con attesa esponenziale: 1, 2, 4... secondi fino al massimo
+RESTART_ON_CRASH = os.environ.get('TUNNEL_RESTART_ON_CRASH', '1').lower() not in ('0', 'false', 'no')
+RESTART_BACKOFF_SECONDS = float(os.environ.get('TUNNEL_RESTART_BACKOFF_SECONDS', 1))
+RESTART_BACKOFF_MAX_SECONDS = float(os.environ.get('TUNNEL_RESTART_BACKOFF_MAX_SECONDS', 60))
+# Oltre CRASH_LOOP_RESTARTS crash nella finestra il tunnel è in crash loop: nessun altro riavvio automatico
+CRASH_LOOP_RESTARTS = int(os.environ.get('TUNNEL_CRASH_LOOP_RESTARTS', 5))
+CRASH_LOOP_WINDOW_SECONDS = float(os.environ.get('TUNNEL_CRASH_LOOP_WINDOW_SECONDS', 600))
+
+# --- Metriche (/metrics) ---
+SPAWN_TO_URL_SECONDS = METRICS.histogram(
+    'tunnel_manager_spawn_to_url_seconds', "Tempo dall'avvio di cloudflared all'URL (pattern riconosciuto, timeout, exited o pool)",
+    ['pattern'], SLOW_BUCKETS)
+DOCKER_SERVICES_SECONDS = METRICS.histogram('tunnel_manager_get_docker_services_seconds', "Durata di get_docker_services()")
+SAVE_CONFIG_SECONDS = METRICS.histogram('tunnel_manager_save_config_seconds', "Durata di save_config() (registrazione in memoria)")
+CONFIG_FLUSH_SECONDS = METRICS.histogram('tunnel_manager_config_flush_seconds', "Durata della scrittura + fsync del journal di configurazione")
+TUNNEL_STARTS = METRICS.counter('tunnel_manager_tunnel_starts_total', "Tunnel avviati (spawn, pool) o estesi (extend)", ['mode'])
+TUNNEL_STOPS = METRICS.counter('tunnel_manager_tunnel_stops_total', "Tunnel fermati, per motivo", ['reason'])
+TUNNEL_CRASHES = METRICS.counter('tunnel_manager_tunnel_crashes_total', "Processi cloudflared terminati inaspettatamente")
+TUNNEL_RESTARTS = METRICS.counter('tunnel_manager_tunnel_restarts_total', "Riavvii automatici di cloudflared dopo un crash")
+CRASH_LOOPS = METRICS.counter('tunnel_manager_tunnel_crash_loops_total', "Tunnel lasciati fermi perché in crash loop")
+# Interruzione del tunnel: dal primo crash al nuovo URL, attese di backoff e riavvii falliti compresi
+RECOVERY_SECONDS = METRICS.histogram('tunnel_manager_tunnel_recovery_seconds', "Dal crash di cloudflared al nuovo URL",
+                                     buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600))
+URL_CAPTURE_FAILURES = METRICS.counter('tunnel_manager_url_capture_failures_total', "Ricerche dell'URL fallite", ['cause'])
+
+
+def stop_reason_label(reason):
+    """Riduce il motivo (testo libero) a poche etichette stabili per le metriche."""
+    reason = (reason or '').lower()
+    if 'scaduto' in reason: return 'expired'
+    if 'cambio porta' in reason: return 'port_change'
+    if 'cambio profilo' in reason: return 'profile_change'
+    if reason == 'idle': return 'idle'
+    if 'arresto applicazione' in reason: return 'shutdown'
+    if 'pulizia' in reason: return 'cleanup'
+    if 'api' in reason: return 'api'
+    return 'other'
 
 class UniversalTunnelManager:
+    """Il costruttore crea solo gli oggetti, senza I/O né thread; start() esegue l'avvio in background."""
+
     def __init__(self):
-        self.active_tunnels = {}  # {service_name: {'process': process, 'url': url, 'port': port, 'expiration_time': timestamp}}
-        self.local_ip = self.get_local_ip()
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        self.data_dir = os.path.join(script_dir, "data")
+        constructed = time.monotonic()
+        # Modifiche serializzate per tunnel; letture da istantanee immutabili, senza lock
+        # Versione di stato unica per tunnel e servizi Docker: ETag e delta di /api/status
+        self.state_clock = VersionClock()
+        self.registry = TunnelRegistry(self.state_clock)
+        self._shutdown_lock = threading.Lock()
+        self._shutdown_done = False
+        self.event_bus = EventBus()
+        # Un solo event loop asyncio possiede tutti i processi cloudflared
+        self.supervisor = TunnelSupervisor(on_url=self.on_tunnel_url, on_exit=self.on_tunnel_exit)
+        # Profili di prestazioni di cloudflared: predefiniti più data/tunnel_profiles.json (o TUNNEL_PROFILES_FILE)
+        profiles_file = PROFILES_FILE or os.path.join(DATA_DIR, "tunnel_profiles.json")
+        self.profiles = load_profiles(profiles_file if PROFILES_FILE or os.path.exists(profiles_file) else None)
+        self.default_profile = DEFAULT_PROFILE if DEFAULT_PROFILE in self.profiles else 'default'
+        if self.default_profile != DEFAULT_PROFILE:
+            logging.warning(f"TUNNEL_DEFAULT_PROFILE={DEFAULT_PROFILE} sconosciuto: uso il profilo 'default'.")
+        # Quick tunnel pre-avviati (TUNNEL_POOL_SIZE > 0): URL disponibile subito all'avvio di un tunnel
+        self.tunnel_pool = TunnelPool(self.supervisor, profile=self.profiles[self.default_profile])
+        # Controllo periodico di origine e URL pubblico di ogni tunnel (latenza, ultimo errore)
+        self.prober = LatencyProber(self.supervisor, self.probe_targets, on_change=self.on_probe_change)
+        # Metriche interne di ogni cloudflared (--metrics su una porta locale), lette nel loop del supervisore
+        self.cloudflared_metrics = CloudflaredMetricsScraper(self.supervisor, self.metrics_targets)
+        self.local_ip = None # Risolto all'avvio (hostname -I può richiedere fino a 2 s)
+        self.data_dir = DATA_DIR
         self.config_file = os.path.join(self.data_dir, "tunnel_config.json")
         
         os.makedirs(self.data_dir, exist_ok=True)
-        self.load_config_and_restore_expirations() # Modificato per ripristinare le scadenze
-        self.clean_invalid_urls_from_config_file()
+        # Scritture accorpate in un journal + snapshot atomici, fuori dai thread delle richieste
+        self.config_store = ConfigStore(self.config_file, on_flush=lambda seconds, entries: CONFIG_FLUSH_SECONDS.observe(seconds))
+        # Scadenze e preavvisi in un min-heap: il thread dorme fino alla prossima scadenza
+        self.scheduler = DeadlineScheduler()
+        # CPU, memoria, fd, thread e I/O di ogni processo cloudflared, in un solo thread
+        self.resource_sampler = ResourceSampler(self.sampled_processes)
+        # Connessioni di cloudflared verso l'origine: arresto dei tunnel inattivi oltre idle_timeout_minutes
+        self.idle_reaper = IdleReaper(self.idle_targets, on_idle=self.stop_idle_tunnel)
+
+        # Inventario Docker caricato una volta e poi aggiornato da `docker events`
+        self.service_inventory = ServiceInventory(clock=self.state_clock)
+        self.service_inventory.add_listener(self.on_service_change)
+
+        self.scheduler_thread = threading.Thread(
+            target=self.scheduler.run, 
+            daemon=True,
+            name="ExpirationScheduler"
+        )
+        # Avvio in background: fase corrente, durata di ogni fase, eventuale errore
+        self.started = threading.Event() # Avvio terminato, anche con errore
+        self.startup_phase = None
+        self.startup_error = None
+        self.startup_timings = {'construct': round(time.monotonic() - constructed, 4)}
+        self.startup_thread = None
+
+    def start(self, background=True):
+        """Avvio: supervisore, IP locale, configurazione (con riadozione dei cloudflared), thread di servizio e
+        inventario Docker. In background le letture sono servite subito; avvii e stop attendono la fine."""
+        # Dalla creazione del processo: interprete, import e costruzione del manager
+        self.startup_timings['process_to_start'] = round(time.time() - psutil.Process().create_time(), 4)
+        self.startup_thread = threading.Thread(target=self._run_startup, daemon=True, name="Startup")
+        self.startup_thread.start()
+        if not background:
+            self.startup_thread.join()
+
+    def _run_startup(self):
+        phases = [
+            ('supervisor', self.supervisor.start),
+            ('local_ip', self.resolve_local_ip),
+            ('load_config', self.load_config_and_restore_expirations),
+            ('clean_config', self.clean_invalid_urls_from_config_file),
+            ('config_store', self.config_store.start),
+            ('tunnel_pool', self.tunnel_pool.start),
+            ('prober', self.prober.start),
+            ('cloudflared_metrics', self.cloudflared_metrics.start),
+            ('resource_sampler', self.resource_sampler.start),
+            ('idle_reaper', self.idle_reaper.start),
+            ('docker_discovery', self.service_inventory.start),
+            ('scheduler', self.scheduler_thread.start),
+        ]
+        startup_began = time.monotonic()
+        try:
+            for phase, step in phases:
+                if self._shutdown_done:
+                    self.startup_error = "arresto durante l'avvio"
+                    return
+                self.startup_phase = phase
+                phase_began = time.monotonic()
+                step()
+                self.startup_timings[phase] = round(time.monotonic() - phase_began, 4)
+            self.startup_phase = None
+            self.startup_timings['startup'] = round(time.monotonic() - startup_began, 4)
+            self.startup_timings['process_to_ready'] = round(time.time() - psutil.Process().create_time(), 4)
+            logging.info(f"Avvio completato in {self.startup_timings['startup']:.2f}s "
+                         f"({self.startup_timings['process_to_ready']:.2f}s dall'avvio del processo): " + ", ".join(
+                             f"{phase} {self.startup_timings[phase]:.3f}s" for phase, _ in phases))
+        except Exception as e:
+            self.startup_error = f"{self.startup_phase}: {e}"
+            logging.error(f"Avvio del manager fallito nella fase {self.startup_phase}: {e}", exc_info=True)
+        finally:
+            self.started.set()
 
-        # Thread per il controllo delle scadenze
-        self.shutdown_event = threading.Event()
-        self.expiration_checker_thread = threading.Thread(target=self.check_expired_tunnels_periodically, daemon=True)
-        self.expiration_checker_thread.start()
-        
-    def save_config(self):
-        config_to_save = {
-            'timestamp': time.time(),
-            'tunnels': {
-                name: {
-                    'url': info.get('url'),
-                    'port': info.get('port'),
-                    'local_url': info.get('local_url'), # Salva anche local_url
-                    'start_time': info.get('start_time'), # Salva start_time
-                    'expiration_time': info.get('expiration_time') # Salva expiration_time
-                } for name, info in self.active_tunnels.items() if info.get('process') and info.get('url') # Salva solo se processo e URL esistono
-            }
+    @property
+    def ready(self):
+        return self.started.is_set() and self.startup_error is None
+
+    def wait_until_ready(self, timeout=STARTUP_WAIT_SECONDS):
+        return self.started.wait(timeout) and self.startup_error is None
+
+    def resolve_local_ip(self):
+        self.local_ip = self.get_local_ip()
+
+    @property
+    def active_tunnels(self):
+        """Vista di sola lettura dell'istantanea corrente: {nome: record}."""
+        return self.registry.snapshot().tunnels
+
+    def persisted_record(self, info):
+        process = info.get('process')
+        return {
+            'pid': process.pid if process else None, # Per riadottare il processo dopo un riavvio
+            'url': info.get('url'),
+            'port': info.get('port'),
+            'local_url': info.get('local_url'),
+            'profile': info.get('profile'),
+            'idle_timeout_minutes': info.get('idle_timeout_minutes'),
+            'start_time': info.get('start_time'),
+            'expiration_time': info.get('expiration_time')
         }
+
+    def save_config(self, service_name):
+        # Registra la modifica in memoria; la scrittura su disco avviene in background (ConfigWriter).
+        # Chiamata con il lock del tunnel acquisito, così le scritture di uno stesso tunnel restano in ordine
+        with SAVE_CONFIG_SECONDS.time():
+            self._save_config(service_name)
+
+    def _save_config(self, service_name):
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(config_to_save, f, indent=2)
-            print(f"Configurazione salvata in: {self.config_file}")
+            info = self.registry.get(service_name)
+            if info:
+                self.config_store.put(service_name, self.persisted_record(info))
+            else:
+                self.config_store.delete(service_name)
         except Exception as e:
-            print(f"Errore nel salvataggio della configurazione: {e}")
+            logging.error(f"Errore nel salvataggio della configurazione: {e}")
             
     def load_config_and_restore_expirations(self):
-        if not os.path.exists(self.config_file):
-            print(f"File di configurazione non trovato: {self.config_file}")
-            return
-            
         try:
-            with open(self.config_file, 'r') as f:
-                config_loaded = json.load(f)
-                
-            print(f"Configurazione caricata da: {self.config_file}")
-            # Ripristina le informazioni sui tunnel, incluse le scadenze, ma senza riavviare i processi
-            # I tunnel non verranno riavviati automaticamente, ma le loro info (inclusa scadenza)
-            # saranno disponibili se l'utente decide di riattivarli.
-            # Oppure, se un tunnel fosse ancora attivo da una sessione precedente (improbabile con quick tunnels),
-            # la sua scadenza verrebbe comunque monitorata.
-            
-            loaded_tunnels_info = config_loaded.get('tunnels', {})
-            print(f"Tunnel precedentemente configurati: {len(loaded_tunnels_info)}")
+            loaded_tunnels_info = self.config_store.load()
+            logging.info(f"Tunnel precedentemente configurati: {len(loaded_tunnels_info)}")
+
+            adopted = self.adopt_surviving_tunnels(loaded_tunnels_info)
 
             for name, data in loaded_tunnels_info.items():
-                # Non sovrascriviamo tunnel già attivi (es. riavvio script veloce)
-                # ma riempiamo le info di scadenza se un tunnel fosse in qualche modo già attivo
-                # e non gestito da questa istanza (più teorico per i quick tunnels).
-                # Principalmente, questo serve a mostrare le info se l'utente riattiva un tunnel.
-                if name not in self.active_tunnels:
-                     self.active_tunnels[name] = {
-                        'process': None, # Non attivo al caricamento
+                if name not in self.registry: # Non sovrascrivere se già in memoria per qualche motivo
+                    self.registry.put(name, {
+                        'process': adopted.get(name), # Processo ancora vivo riadottato, altrimenti None
                         'url': data.get('url'),
                         'port': data.get('port'),
                         'local_url': data.get('local_url'),
+                        'profile': data.get('profile') or 'default', # Record precedenti ai profili: opzioni storiche
+                        'idle_timeout_minutes': data.get('idle_timeout_minutes'),
                         'start_time': data.get('start_time'),
                         'expiration_time': data.get('expiration_time')
-                    }
-                elif self.active_tunnels[name].get('process') is None: # Se esiste ma non ha processo
-                    # Aggiorna le info se il tunnel è in memoria ma non attivo
-                    self.active_tunnels[name].update({
-                        'url': data.get('url', self.active_tunnels[name].get('url')),
-                        'port': data.get('port', self.active_tunnels[name].get('port')),
-                        'local_url': data.get('local_url', self.active_tunnels[name].get('local_url')),
-                        'start_time': data.get('start_time', self.active_tunnels[name].get('start_time')),
-                        'expiration_time': data.get('expiration_time', self.active_tunnels[name].get('expiration_time'))
                     })
-
+                    self.schedule_expiration(name)
         except Exception as e:
-            print(f"Errore nel caricamento della configurazione: {e}")
+            logging.error(f"Errore nel caricamento della configurazione: {e}")
 
-    # ... (clean_invalid_urls_from_config_file, clean_active_invalid_urls, get_local_ip, get_docker_services, extract_ports sono invariati) ...
-    def clean_invalid_urls_from_config_file(self): # Rinominata per chiarezza
-        """Pulisce URL non validi dal file di configurazione"""
-        if os.path.exists(self.config_file):
+    def adopt_surviving_tunnels(self, loaded_tunnels_info):
+        """Riaggancia i cloudflared sopravvissuti al riavvio del manager: stesso URL pubblico, nessun nuovo avvio."""
+        try:
+            candidates = find_cloudflared_processes()
+        except Exception as e:
+            logging.warning(f"Ricerca processi cloudflared fallita: {e}")
+            return {}
+        adopted, claimed = {}, set()
+        for pid, candidate in candidates.items():
+            if candidate.get('pool_slot'):
+                # Slot del pool di un'istanza precedente: il suo forwarder locale non esiste più
+                logging.info(f"Arresto cloudflared orfano del pool (PID: {pid}).")
+                try: psutil.Process(pid).terminate()
+                except psutil.Error: pass
+                claimed.add(pid)
+        for name, data in loaded_tunnels_info.items():
+            local_url, url = data.get('local_url'), data.get('url') or ''
+            pid = data.get('pid')
+            if pid in candidates and candidates[pid]['target'] == local_url:
+                match = pid
+            else: # PID non salvato o cambiato: si cerca per --url
+                match = next((p for p, c in candidates.items() if c['target'] == local_url and p not in claimed), None)
+            if match is None or match in claimed:
+                continue
+            claimed.add(match)
+            start_time = data.get('start_time')
+            if start_time and candidates[match]['create_time'] > start_time + ADOPTION_START_TIME_TOLERANCE_SECONDS:
+                logging.info(f"cloudflared PID {match} per {local_url} avviato dopo il tunnel {name}: non riadottato.")
+                continue
+            if not url.startswith('https://') or 'trycloudflare.com' not in url:
+                # Processo nostro ma con URL sconosciuto: non è utilizzabile, meglio non lasciarlo orfano
+                logging.info(f"cloudflared PID {match} per {name} senza URL valido: arresto.")
+                try: psutil.Process(match).terminate()
+                except psutil.Error: pass
+                continue
             try:
-                with open(self.config_file, 'r') as f:
-                    config_data = json.load(f) # Rinomina variabile
-                
-                cleaned = False
-                tunnels = config_data.get('tunnels', {})
-                for service_name, tunnel_info in list(tunnels.items()): # Usa list() per iterare su una copia
-                    url = tunnel_info.get('url', '')
-                    # Aggiungi controllo per URL None o vuoti e altri placeholder comuni
-                    if not url or 'website-terms' in url or 'cloudflare.com/website-terms' in url or 'developers.cloudflare.com' in url:
-                        print(f"🧹 Rimosso URL non valido/placeholder per {service_name} dal file config: {url}")
-                        del tunnels[service_name]
-                        cleaned = True
-                
-                if cleaned:
-                    config_data['tunnels'] = tunnels
-                    with open(self.config_file, 'w') as f:
-                        json.dump(config_data, f, indent=2)
-                    print("🧹 Configurazione su file pulita dagli URL non validi")
+                adopted[name] = self.supervisor.adopt(name, match, candidates[match]['cmdline'], url)
+                logging.info(f"♻️ Tunnel {name} riadottato (PID: {match}): {url}")
             except Exception as e:
-                print(f"Errore nella pulizia della configurazione su file: {e}")
+                logging.warning(f"Impossibile riadottare {name} (PID: {match}): {e}")
+        for pid, candidate in candidates.items():
+            if pid not in claimed:
+                logging.info(f"cloudflared PID {pid} ({candidate['target']}) non associato a nessun tunnel salvato.")
+        return adopted
 
-    def clean_active_invalid_urls(self): # Per pulire i tunnel attivi in memoria
-        """Pulisce URL non validi dai tunnel attivi in memoria."""
+    def clean_invalid_urls_from_config_file(self):
         cleaned = False
-        for service_name, tunnel_info in list(self.active_tunnels.items()): # Usa list() per iterare su una copia
-            url = tunnel_info.get('url')
-            if url and ('website-terms' in url or 'developers.cloudflare.com' in url or 'connect.cloudflare.com' in url): # Aggiunto connect.cloudflare.com
-                print(f"🧹 Rimosso URL non valido per tunnel attivo {service_name}: {url}")
-                tunnel_info['url'] = None # Non rimuovere il tunnel, solo l'URL errato
+        for service_name, tunnel_info in self.registry.snapshot().tunnels.items():
+            if tunnel_info.get('process'):
+                continue
+            url = tunnel_info.get('url') or ''
+            if not url or 'website-terms' in url or 'cloudflare.com/website-terms' in url or 'developers.cloudflare.com' in url:
+                with self.registry.lock(service_name):
+                    if not self.registry.remove(service_name, process=None):
+                        continue
+                    logging.info(f"🧹 Rimosso URL non valido per {service_name} dal file config: {url}")
+                    self.cancel_scheduled(service_name)
+                    self.save_config(service_name)
                 cleaned = True
         if cleaned:
-             print("🧹 Tunnel attivi puliti da URL non validi. Saranno aggiornati al prossimo rilevamento.")
-
+            logging.info("🧹 Configurazione su file pulita dagli URL non validi.")
 
     def get_local_ip(self):
-        """Ottiene l'IP locale"""
+        # ... (implementazione come prima) ...
         try:
             env_ip = os.environ.get('LOCAL_IP')
             if env_ip:
-                print(f"🔍 Usando IP da variabile d'ambiente LOCAL_IP: {env_ip}")
+                logging.info(f"IP da LOCAL_IP: {env_ip}")
                 return env_ip
-            
             try:
                 result = subprocess.run(['hostname', '-I'], capture_output=True, text=True, check=False, timeout=2)
                 if result.returncode == 0 and result.stdout.strip():
                     ip = result.stdout.strip().split()[0]
-                    print(f"🔍 IP rilevato da hostname -I: {ip}")
+                    logging.info(f"IP da hostname -I: {ip}")
                     return ip
-            except (FileNotFoundError, subprocess.TimeoutExpired) as e:
-                print(f"ℹ️ 'hostname -I' non disponibile o timeout: {e}")
-
+            except Exception: logging.debug("hostname -I fallito")
             try:
                 s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                s.settimeout(0.1) 
-                s.connect(("8.8.8.8", 80)) 
-                ip = s.getsockname()[0]
-                s.close()
-                print(f"🔍 IP rilevato da socket connect: {ip}")
+                s.settimeout(0.1); s.connect(("8.8.8.8", 80)); ip = s.getsockname()[0]; s.close()
+                logging.info(f"IP da socket connect: {ip}")
                 return ip
-            except Exception as e:
-                print(f"ℹ️ Metodo socket connect fallito: {e}")
-
-            try:
-                hostname = socket.gethostname()
-                ip = socket.gethostbyname(hostname)
-                if ip != "127.0.0.1" and not ip.startswith("127."): 
-                    print(f"🔍 IP rilevato da gethostbyname(hostname): {ip}")
-                    return ip
-            except socket.gaierror as e:
-                print(f"ℹ️ Metodo gethostbyname(hostname) fallito: {e}")
-            
-            print(f"⚠️ Impossibile determinare IP locale affidabile, usando '127.0.0.1'. Potrebbe essere necessario LOCAL_IP.")
-            return "127.0.0.1" 
+            except Exception: logging.debug("socket connect fallito")
+            logging.warning("IP fallback: 127.0.0.1")
+            return "127.0.0.1"
         except Exception as e:
-            print(f"⚠️ Errore critico nel rilevamento dell'IP locale: {e}, usando 127.0.0.1")
+            logging.error(f"Errore get_local_ip: {e}, fallback 127.0.0.1")
             return "127.0.0.1"
-        
+
     def get_docker_services(self):
-        """Ottiene la lista di tutti i servizi Docker con porte esposte"""
-        try:
-            # print(f"🔍 Ricerca servizi Docker in corso... IP Locale: {self.local_ip}")
-            cmd = ["docker", "ps", "-a", "--format", "{{.Names}}\t{{.Status}}\t{{.Ports}}\t{{.Image}}"]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        with DOCKER_SERVICES_SECONDS.time():
+            return self.service_inventory.get_services()
+
+    def on_service_change(self, kind, name, service):
+        self.event_bus.publish(f"service_{kind}", {'name': name, 'service': service})
+
+    def publish_tunnel_event(self, event_type, service_name, reason=None):
+        info = self.registry.get(service_name)
+        self.event_bus.publish(event_type, {
+            'service_name': service_name,
+            'tunnel': self.tunnel_details(service_name, info) if info else None,
+            'reason': reason
+        })
             
-            services = []
-            if result.stdout.strip():
-                lines = result.stdout.strip().split('\n')
-                for line in lines:
-                    parts = line.split('\t')
-                    if len(parts) >= 3:
-                        name = parts[0]
-                        status = parts[1]
-                        ports_str = parts[2]
-                        image = parts[3] if len(parts) > 3 else "unknown"
-                        
-                        exposed_ports = self.extract_ports(ports_str)
-                        
-                        if "Up" in status:
-                            tunnel_info = self.active_tunnels.get(name, {})
-                            is_tunnel_active_and_running = name in self.active_tunnels and \
-                                                           tunnel_info.get('process') is not None and \
-                                                           tunnel_info['process'].poll() is None
-
-                            services.append({
-                                'name': name,
-                                'status': status,
-                                'ports': exposed_ports,
-                                'image': image,
-                                'tunnel_active': is_tunnel_active_and_running,
-                                'tunnel_url': tunnel_info.get('url') if is_tunnel_active_and_running else None,
-                                'selected_port': tunnel_info.get('port'),
-                                'expiration_time': tunnel_info.get('expiration_time') if is_tunnel_active_and_running else None
-                            })
-            
-            # print(f"🔍 Servizi Docker attivi trovati: {len(services)}")
-            return services
-        except subprocess.CalledProcessError as e:
-            print(f"❌ Errore nel recupero servizi Docker (comando fallito): {e}")
-            print(f"❌ Stderr: {e.stderr}")
-            return []
-        except FileNotFoundError:
-            print("❌ Comando 'docker' non trovato. Assicurati che Docker sia installato e nel PATH.")
-            return []
-        except Exception as e:
-            print(f"❌ Errore generico nel recupero servizi Docker: {str(e)}")
-            return []
-    
-    def extract_ports(self, ports_string):
-        if not ports_string or ports_string == "-":
-            return []
-        
-        extracted_ports = set() 
-        port_pattern = r'(?:0\.0\.0\.0:|\[::\]:)(\d+)->\d+/tcp'
-        matches = re.findall(port_pattern, ports_string)
-        for port in matches:
-            extracted_ports.add(int(port))
-        
-        if not extracted_ports:
-            localhost_pattern = r'127\.0\.0\.1:(\d+)->\d+/tcp'
-            localhost_matches = re.findall(localhost_pattern, ports_string)
-            for port in localhost_matches:
-                extracted_ports.add(int(port))
-        return sorted(list(extracted_ports))
-
-    def start_tunnel_for_service(self, service_name, port, duration_hours=None): # Aggiunto duration_hours
-        """Avvia un tunnel Cloudflare per un servizio specifico con una durata definita."""
+    def extract_ports(self, ports):
+        return extract_ports(ports)
+
+    def start_tunnel_for_service(self, service_name, port, duration_hours=None, persist=True, profile=None,
+                                 idle_timeout_minutes=None):
+        """idle_timeout_minutes: arresto dopo tanti minuti senza connessioni verso l'origine (0 = mai); senza,
+        il servizio mantiene il valore precedente o TUNNEL_IDLE_TIMEOUT_MINUTES."""
+        if not self.wait_until_ready():
+            return False, STARTING_MESSAGE
+        if profile is not None and profile not in self.profiles:
+            return False, f"Profilo sconosciuto: {profile}. Disponibili: {', '.join(sorted(self.profiles))}."
+        with self.registry.lock(service_name):
+            return self._start_tunnel_locked(service_name, port, duration_hours, persist, profile, idle_timeout_minutes)
+
+    def _start_tunnel_locked(self, service_name, port, duration_hours, persist=True, profile=None, idle_timeout_minutes=None):
         try:
-            # Controlla se un tunnel è già attivo e in esecuzione
-            if service_name in self.active_tunnels:
-                existing_tunnel = self.active_tunnels[service_name]
-                if existing_tunnel.get('process') and existing_tunnel['process'].poll() is None:
-                    # Se è attivo e la porta è la stessa, potremmo voler solo aggiornare la scadenza
-                    if existing_tunnel.get('port') == port:
-                        new_expiration_time = time.time() + (duration_hours if duration_hours is not None else DEFAULT_TUNNEL_DURATION_HOURS) * 3600
-                        existing_tunnel['expiration_time'] = new_expiration_time
-                        self.save_config()
-                        print(f"⏱️  Scadenza aggiornata per tunnel attivo {service_name} a {datetime.fromtimestamp(new_expiration_time).strftime('%Y-%m-%d %H:%M:%S')}")
+            current_time = time.time()
+            effective_duration_hours = duration_hours if duration_hours is not None else DEFAULT_TUNNEL_DURATION_HOURS
+            new_expiration_time = current_time + (effective_duration_hours * 3600)
+
+            existing_tunnel = self.registry.get(service_name)
+            if profile:
+                # Scelta del servizio salvata nella configurazione: vale anche per i prossimi avvii senza profilo
+                self.config_store.set_service_profile(service_name, profile)
+            # Senza profilo nella richiesta il servizio mantiene quello scelto in precedenza, anche a tunnel fermo
+            profile = profile or (existing_tunnel or {}).get('profile') or self.config_store.get_service_profile(service_name)
+            if profile not in self.profiles:
+                profile = self.default_profile
+            if idle_timeout_minutes is None:
+                idle_timeout_minutes = (existing_tunnel or {}).get('idle_timeout_minutes')
+            if idle_timeout_minutes is None:
+                idle_timeout_minutes = IDLE_TIMEOUT_MINUTES
+            if existing_tunnel:
+                process_is_running = existing_tunnel.get('process') and existing_tunnel['process'].poll() is None
+
+                if process_is_running:
+                    if existing_tunnel.get('port') == port and existing_tunnel.get('profile') == profile: 
+                        existing_tunnel = self.registry.update(service_name, expiration_time=new_expiration_time,
+                                                               idle_timeout_minutes=idle_timeout_minutes)
+                        self.schedule_expiration(service_name)
+                        logging.info(f"Scadenza aggiornata per {service_name} a {datetime.fromtimestamp(new_expiration_time).strftime('%Y-%m-%d %H:%M:%S')}")
+                        if not existing_tunnel.get('url') or existing_tunnel.get('url') == "Ricerca URL fallita":
+                            logging.info(f"Tunnel {service_name} attivo ma senza URL. Tentativo ricattura.")
+                            self.supervisor.recapture_url(existing_tunnel['process'])
+                        if persist: self.save_config(service_name)
+                        TUNNEL_STARTS.inc('extend')
+                        self.publish_tunnel_event('tunnel_updated', service_name)
                         return True, f"Scadenza tunnel per {service_name} aggiornata."
+                    elif existing_tunnel.get('port') != port:
+                        logging.info(f"Tunnel per {service_name} su porta diversa. Stop e riavvio.")
+                        self.stop_tunnel_for_service(service_name, reason="cambio porta")
                     else:
-                        # Se la porta è diversa, bisogna fermare il vecchio e avviarne uno nuovo
-                        print(f"⚠️ Tunnel per {service_name} già attivo su porta diversa. Verrà fermato e riavviato.")
-                        self.stop_tunnel_for_service(service_name) # Ferma il vecchio
-                elif existing_tunnel.get('process') and existing_tunnel['process'].poll() is not None:
-                    # Processo terminato, pulisci prima di riavviare
-                    print(f"🧹 Pulizia tunnel precedentemente terminato per {service_name} prima del riavvio.")
-                    del self.active_tunnels[service_name]
-
-
-            url_to_tunnel = f"http://{self.local_ip}:{port}"
-            print(f"🚀 Avvio tunnel per {service_name} verso {url_to_tunnel}")
-            
-            cmd = [
-                "cloudflared", "tunnel",
-                "--url", url_to_tunnel,
-                "--no-autoupdate",
-                "--edge-ip-version", "auto",
-            ]
+                        logging.info(f"Tunnel per {service_name} con profilo diverso ({existing_tunnel.get('profile')} -> {profile}). Stop e riavvio.")
+                        self.stop_tunnel_for_service(service_name, reason="cambio profilo")
             
-            process = subprocess.Popen(
-                cmd, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1,
-                universal_newlines=True
-            )
-            
-            start_time = time.time()
-            if duration_hours is None:
-                duration_hours = DEFAULT_TUNNEL_DURATION_HOURS
-            
-            expiration_time = start_time + (duration_hours * 3600)
+            url_to_tunnel = f"http://{self.local_ip}:{port}"
+            logging.info(f"Avvio tunnel per {service_name} ({port}, profilo {profile}) -> {url_to_tunnel}")
             
-            self.active_tunnels[service_name] = {
-                'process': process,
-                'url': None,
-                'port': port,
-                'local_url': url_to_tunnel,
-                'start_time': start_time,
-                'expiration_time': expiration_time # Memorizza il timestamp di scadenza
-            }
+            # Gli slot del pool sono avviati con il profilo predefinito
+            use_pool = self.tunnel_pool.enabled and profile == self.default_profile
+            slot = self.tunnel_pool.acquire(service_name, self.local_ip, port) if use_pool else None
+            if slot:
+                # cloudflared già registrato: il forwarder dello slot ora inoltra al servizio
+                process, tunnel_url = slot.handle, slot.url
+            else:
+                # Porta delle metriche scelta solo per un nuovo processo; lo scraper la rilegge dalla riga di
+                # comando (anche dopo una riadozione)
+                cmd = build_tunnel_command(url_to_tunnel, self.profiles[profile],
+                                           allocate_metrics_port() if metrics_enabled() else None)
+                process, tunnel_url = self.supervisor.spawn(service_name, cmd), "Ricerca URL fallita"
             
-            print(f"⏱️  Tunnel per {service_name} scadrà il: {datetime.fromtimestamp(expiration_time).strftime('%Y-%m-%d %H:%M:%S')}")
+            self.registry.put(service_name, {
+                'process': process, 'url': tunnel_url, 'port': port,
+                'local_url': url_to_tunnel, 'profile': profile, 'idle_timeout_minutes': idle_timeout_minutes,
+                'start_time': current_time,
+                'expiration_time': new_expiration_time, 'pool_slot': slot
+            })
+            logging.info(f"Tunnel per {service_name} scadrà: {datetime.fromtimestamp(new_expiration_time).strftime('%Y-%m-%d %H:%M:%S')}")
+            self.schedule_expiration(service_name)
+            if persist: self.save_config(service_name)
+            TUNNEL_STARTS.inc('pool' if slot else 'spawn')
+            self.publish_tunnel_event('tunnel_spawned', service_name)
+            if slot:
+                SPAWN_TO_URL_SECONDS.observe(time.time() - current_time, 'pool')
+                self.publish_tunnel_event('tunnel_url', service_name)
+                return True, f"Tunnel per {service_name} assegnato dal pool: {tunnel_url} (scade in {effective_duration_hours:.1f} ore)."
+            return True, f"Avvio tunnel per {service_name} (scade in {effective_duration_hours:.1f} ore)..."
 
-            threading.Thread(
-                target=self.capture_tunnel_url,
-                args=(service_name, process),
-                daemon=True
-            ).start()
-            
-            return True, f"Tentativo di avvio tunnel per {service_name} su porta {port} (scade in {duration_hours} ore)..."
         except Exception as e:
-            print(f"❌ Errore critico nell'avvio del tunnel per {service_name}: {e}")
-            if service_name in self.active_tunnels:
-                del self.active_tunnels[service_name]
+            logging.error(f"Errore avvio tunnel {service_name}: {e}", exc_info=True)
+            self.registry.remove(service_name)
+            self.cancel_scheduled(service_name)
+            self.save_config(service_name)
             return False, f"Errore avvio tunnel: {str(e)}"
             
-    # ... (capture_tunnel_url è invariato) ...
-    def capture_tunnel_url(self, service_name, process):
-        """Cattura l'URL del tunnel dal processo cloudflared, leggendo stderr."""
-        print(f"👀 Monitoraggio output stderr per {service_name}...")
-        tunnel_url = None
-        
-        patterns = [
-            re.compile(r"url=(https://[a-zA-Z0-9.-]+\.trycloudflare\.com)"),
-            re.compile(r"URL:\s*(https://[a-zA-Z0-9.-]+\.trycloudflare\.com)"),
-            re.compile(r"established connection.*url=(https://[a-zA-Z0-9.-]+\.trycloudflare\.com)"),
-            re.compile(r"Your quick Tunnel has been created! Visit it at:\s*(https://[a-zA-Z0-9.-]+\.trycloudflare\.com)"),
-            re.compile(r"(https://[a-zA-Z0-9.-]+\.trycloudflare\.com)"), 
-        ]
-
-        timeout_seconds = 30 
-        start_capture_time = time.time()
-
-        try:
-            for stream_name, stream in [("stderr", process.stderr), ("stdout", process.stdout)]:
-                if tunnel_url: break 
-                # print(f"👂 In ascolto su {stream_name} per {service_name}") # Meno verboso
-                for line in iter(stream.readline, ''):
-                    if not line and process.poll() is not None: 
-                        print(f"⚠️ Processo cloudflared per {service_name} terminato prematuramente durante la cattura dell'URL.")
-                        break
-                    
-                    # print(f"RAW LOG ({service_name} - {stream_name}): {line.strip()}") # Verboso per debug
-                    
-                    for pattern_idx, pattern in enumerate(patterns):
-                        match = pattern.search(line)
-                        if match:
-                            potential_url = match.group(1)
-                            if ".trycloudflare.com" in potential_url and not any(bad_keyword in potential_url for bad_keyword in ["website-terms", "developers.cloudflare.com"]):
-                                tunnel_url = potential_url
-                                print(f"✅ URL tunnel trovato per {service_name} (pattern {pattern_idx}): {tunnel_url}")
-                                break 
-                    
-                    if tunnel_url:
-                        break 
-                    
-                    if time.time() - start_capture_time > timeout_seconds:
-                        print(f"⏳ Timeout ({timeout_seconds}s) raggiunto durante la ricerca dell'URL per {service_name}.")
-                        break
-                if tunnel_url or (time.time() - start_capture_time > timeout_seconds):
-                    break 
-
-
-            if service_name in self.active_tunnels:
-                if tunnel_url:
-                    self.active_tunnels[service_name]['url'] = tunnel_url
-                    self.save_config() 
-                else:
-                    print(f"❌ Impossibile trovare l'URL del tunnel per {service_name} dopo {timeout_seconds}s.")
-                    self.active_tunnels[service_name]['url'] = "Ricerca URL fallita"
+    def start_tunnels_batch(self, items, concurrency=None, wait_for_urls=True):
+        """Avvia più tunnel in parallelo; items: [{'service_name', 'port', 'duration_hours', 'profile', 'idle_timeout_minutes'}].
+        Restituisce (risultati per elemento, secondi fino all'ultimo URL o None)."""
+        if not self.wait_until_ready():
+            return [{'service_name': item['service_name'], 'port': item['port'], 'success': False,
+                     'message': STARTING_MESSAGE} for item in items], None
+        batch_start = time.time()
+        concurrency = max(1, min(concurrency or START_CONCURRENCY, len(items) or 1))
+
+        def start_one(item):
+            success, message = self.start_tunnel_for_service(
+                item['service_name'], item['port'], item.get('duration_hours'), persist=False, profile=item.get('profile'),
+                idle_timeout_minutes=item.get('idle_timeout_minutes'))
+            return {'service_name': item['service_name'], 'port': item['port'], 'success': success, 'message': message}
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="BatchStart") as pool:
+            results = list(pool.map(start_one, items))
+
+        # Una sola tornata di scritture per tutto il lotto (il ConfigWriter le accorpa in un'unica scrittura)
+        for result in results:
+            with self.registry.lock(result['service_name']):
+                self.save_config(result['service_name'])
+
+        handles = {}
+        for result in results:
+            info = self.registry.get(result['service_name']) if result['success'] else None
+            if info and info.get('process'):
+                handles[result['service_name']] = info['process']
+        if wait_for_urls and handles:
+            self.supervisor.wait_for_urls(list(handles.values()))
+
+        url_times = []
+        for result in results:
+            handle = handles.get(result['service_name'])
+            result['url'] = handle.url if handle else None
+            result['url_seconds'] = round(handle.url_time - handle.start_time, 3) if handle and handle.url_time else None
+            if handle and handle.url_time: url_times.append(handle.url_time)
+        all_found = wait_for_urls and url_times and len(url_times) == len(results)
+        time_to_all_urls = round(max(url_times) - batch_start, 3) if all_found else None
+        logging.info(f"Avvio in blocco: {sum(r['success'] for r in results)}/{len(results)} tunnel, "
+                     f"URL: {len(url_times)}, tempo totale: {time_to_all_urls}s")
+        return results, time_to_all_urls
+
+    def on_tunnel_url(self, process, tunnel_url, pattern):
+        service_name = process.service_name
+        with self.registry.lock(service_name):
+            info = self.registry.get(service_name)
+            if not info or info.get('process') is not process:
+                if not process.stopping:
+                    logging.warning(f"{service_name} non in active_tunnels durante cattura URL.")
+                return
+            if tunnel_url:
+                if info.get('url') != tunnel_url: # Una ricattura dopo un'estensione non è un nuovo URL
+                    SPAWN_TO_URL_SECONDS.observe((process.url_time or time.time()) - process.start_time, pattern or 'generico')
+                recovery = {}
+                if info.get('crashed_at'): # Primo URL dopo un crash: fine dell'interruzione
+                    recovery_seconds = (process.url_time or time.time()) - info['crashed_at']
+                    RECOVERY_SECONDS.observe(recovery_seconds)
+                    logging.info(f"Tunnel {service_name} ripristinato in {recovery_seconds:.1f}s: {tunnel_url}")
+                    recovery = {'crashed_at': None, 'last_recovery_seconds': round(recovery_seconds, 3)}
+                info = self.registry.update(service_name, process=process, url=tunnel_url, **recovery)
             else:
-                print(f"⚠️ {service_name} non trovato in active_tunnels durante la cattura dell'URL (forse è stato fermato).")
-
-        except Exception as e:
-            print(f"❌ Errore critico nel catturare l'URL del tunnel per {service_name}: {e}")
-            if service_name in self.active_tunnels:
-                self.active_tunnels[service_name]['url'] = f"Errore cattura URL: {e}"
-        finally:
-            print(f"🏁 Monitoraggio output completato per {service_name}. URL: {tunnel_url}")
-
-
-    def stop_tunnel_for_service(self, service_name, reason="richiesta utente"): # Aggiunto reason
-        """Ferma un tunnel Cloudflare per un servizio specifico."""
+                logging.error(f"Impossibile trovare URL per {service_name}.")
+                # 'url' rimane "Ricerca URL fallita"
+                cause = 'timeout' if process.poll() is None else 'exited'
+                SPAWN_TO_URL_SECONDS.observe(time.time() - process.start_time, cause)
+                URL_CAPTURE_FAILURES.inc(cause)
+            self.save_config(service_name)
+            if tunnel_url:
+                self.publish_tunnel_event('tunnel_url', service_name)
+            elif process.poll() is None:
+                self.publish_tunnel_event('tunnel_url_failed', service_name)
+        logging.info(f"Monitoraggio output completato per {service_name}. URL finale: {info.get('url')}")
+
+    def on_tunnel_exit(self, process):
+        if process.stopping:
+            return
+        # Uscita rilevata subito dal supervisore (attesa del figlio o pidfd per i processi riadottati)
+        service_name = process.service_name
+        with self.registry.lock(service_name):
+            info = self.registry.get(service_name)
+            if not info or info.get('process') is not process:
+                return
+            TUNNEL_CRASHES.inc()
+            self._handle_crash_locked(service_name, info, f"codice {process.returncode}")
+
+    def _handle_crash_locked(self, service_name, info, reason):
+        """Programma il riavvio con backoff esponenziale, oppure segna il crash loop; il record resta visibile
+        (con l'ultimo processo) fino al riavvio o alla sua scadenza."""
+        now = time.time()
+        crash_times = [t for t in info.get('crash_times', ()) if now - t < CRASH_LOOP_WINDOW_SECONDS] + [now]
+        crash_loop = len(crash_times) > CRASH_LOOP_RESTARTS
+        expiration_time = info.get('expiration_time')
+        restart_at = None
+        if RESTART_ON_CRASH and not crash_loop and not self._shutdown_done and expiration_time and expiration_time > now:
+            restart_at = now + min(RESTART_BACKOFF_MAX_SECONDS, RESTART_BACKOFF_SECONDS * 2 ** (len(crash_times) - 1))
+        # crashed_at resta quello del primo crash finché non torna un URL: misura l'intera interruzione
+        self.registry.update(service_name, process=info.get('process'), crash_reported=True, crash_times=crash_times,
+                             crashed_at=info.get('crashed_at') or now, crash_loop=crash_loop, restart_at=restart_at)
+        self.publish_tunnel_event('tunnel_crashed', service_name, reason=reason)
+        if crash_loop:
+            CRASH_LOOPS.inc()
+            logging.error(f"Tunnel {service_name} in crash loop ({len(crash_times)} crash in "
+                          f"{CRASH_LOOP_WINDOW_SECONDS:.0f}s): nessun altro riavvio automatico.")
+            self.publish_tunnel_event('tunnel_crash_loop', service_name, reason=f"{len(crash_times)} crash")
+        elif restart_at:
+            logging.info(f"Riavvio di {service_name} tra {restart_at - now:.1f}s (crash {len(crash_times)} nella finestra).")
+            self.scheduler.schedule((service_name, 'restart'), restart_at, self.restart_crashed_tunnel,
+                                    service_name, info.get('process'))
+
+    def restart_crashed_tunnel(self, service_name, crashed_process):
+        with self.registry.lock(service_name):
+            info = self.registry.get(service_name)
+            if not info or info.get('process') is not crashed_process or self._shutdown_done:
+                return # Fermato, riavviato a mano o esteso nel frattempo
+            if not info.get('expiration_time') or info['expiration_time'] <= time.time():
+                return # Scaduto durante l'attesa: lo rimuove expire_tunnel
+            profile = info.get('profile') if info.get('profile') in self.profiles else self.default_profile
+            slot = info.get('pool_slot')
+            if slot: # Il forwarder dello slot non serve più: il nuovo processo punta direttamente all'origine
+                self.tunnel_pool.release(slot)
+            cmd = build_tunnel_command(info.get('local_url'), self.profiles[profile],
+                                       allocate_metrics_port() if metrics_enabled() else None)
+            try:
+                process = self.supervisor.spawn(service_name, cmd)
+            except Exception as e:
+                logging.error(f"Riavvio di {service_name} fallito: {e}")
+                # Conta come un nuovo crash: backoff più lungo, e dopo troppi tentativi crash loop
+                info = self.registry.update(service_name, process=crashed_process, pool_slot=None)
+                self._handle_crash_locked(service_name, info, f"riavvio fallito: {e}")
+                return
+            restarts = info.get('restarts', 0) + 1
+            self.registry.put(service_name, {**info, 'process': process, 'url': "Ricerca URL fallita", 'pool_slot': None,
+                                             'crash_reported': False, 'restart_at': None, 'restarts': restarts})
+            self.save_config(service_name)
+            TUNNEL_RESTARTS.inc()
+            logging.info(f"Tunnel {service_name} riavviato dopo il crash (PID: {process.pid}, riavvio n. {restarts}).")
+            self.publish_tunnel_event('tunnel_restarted', service_name)
+
+    def stop_tunnel_for_service(self, service_name, reason="richiesta utente"):
+        if not self.wait_until_ready():
+            return False, STARTING_MESSAGE
+        with self.registry.lock(service_name):
+            return self._stop_tunnel_locked(service_name, reason)
+
+    def _detach_tunnel_locked(self, service_name, reason):
+        """Rimuove il tunnel da registro, scadenze e configurazione; restituisce (trovato, processo da terminare)."""
+        tunnel_info = self.registry.remove(service_name)
+        if not tunnel_info:
+            return False, None
+        process = tunnel_info.get('process')
+        pid_str = f"(PID: {process.pid})" if process else "(Nessun processo)"
+        logging.info(f"Stop tunnel {service_name} {pid_str}, Motivo: {reason}")
+        self.cancel_scheduled(service_name)
+        self.save_config(service_name)
+        TUNNEL_STOPS.inc(stop_reason_label(reason))
+        self.publish_tunnel_event('tunnel_stopped', service_name, reason=reason)
+        if tunnel_info.get('pool_slot'):
+            # Lo slot torna al pool (TUNNEL_POOL_RECYCLE) oppure viene terminato dal pool stesso
+            self.tunnel_pool.release(tunnel_info['pool_slot'])
+            return True, None
+        if process: process.stopping = True # Da qui in poi l'uscita non è un crash
+        return True, process if process and process.poll() is None else None
+
+    def _stop_tunnel_locked(self, service_name, reason):
         try:
-            if service_name not in self.active_tunnels or not self.active_tunnels[service_name].get('process'):
-                # Potrebbe esserci un record senza processo se caricato da config, quindi rimuovilo se presente
-                if service_name in self.active_tunnels:
-                    del self.active_tunnels[service_name]
-                    self.save_config()
-                return False, "Nessun tunnel attivo o processo associato per questo servizio."
-                
-            tunnel_info = self.active_tunnels[service_name]
-            process = tunnel_info['process']
-            
-            print(f"🔌 Tentativo di fermare il tunnel per {service_name} (PID: {process.pid if process else 'N/A'}, Motivo: {reason})")
-            
+            found, process = self._detach_tunnel_locked(service_name, reason)
+            if not found:
+                logging.info(f"Tentativo stop per {service_name} (non trovato).")
+                return True, "Tunnel non trovato o già fermato."
             if process:
-                process.terminate()
-                try:
-                    process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    process.kill()
-                    process.wait(timeout=2)
-            
-            del self.active_tunnels[service_name]
-            self.save_config()
-            
-            print(f"✔️ Tunnel per {service_name} fermato e rimosso (Motivo: {reason}).")
-            return True, f"Tunnel fermato con successo (Motivo: {reason})."
+                # SIGTERM/SIGKILL gestiti dal supervisore: la richiesta non attende l'uscita del processo
+                self.supervisor.terminate([process], wait=False)
+            logging.info(f"Tunnel {service_name} fermato e rimosso (Motivo: {reason}).")
+            return True, f"Tunnel fermato (Motivo: {reason})."
         except Exception as e:
-            print(f"❌ Errore nel fermare il tunnel per {service_name}: {e}")
-            # Non rimuovere il tunnel in caso di errore qui, potrebbe essere ancora parzialmente attivo
+            logging.error(f"Errore stop tunnel {service_name}: {e}", exc_info=True)
             return False, f"Errore: {str(e)}"
-    
-    def stop_all_tunnels(self, reason="richiesta utente globale"): # Aggiunto reason
-        """Ferma tutti i tunnel attivi gestiti da questa istanza."""
-        print(f"🔌 Tentativo di fermare tutti i tunnel attivi (Motivo: {reason})...")
-        stopped_count = 0
-        services_to_stop = list(self.active_tunnels.keys())
-        
-        for service_name in services_to_stop:
-            success, _ = self.stop_tunnel_for_service(service_name, reason=f"globale - {reason}")
-            if success:
-                stopped_count +=1
-        
-        message = f"Fermati {stopped_count}/{len(services_to_stop)} tunnel gestiti (Motivo: {reason})."
-        print(message)
-        return True, message
-    
-    def get_status(self):
-        self.clean_active_invalid_urls()
-        active_tunnels_details = []
-        current_time = time.time()
 
-        for name, info in list(self.active_tunnels.items()): # list() per iterare su una copia
-            is_running = False
-            process_status = "Non attivo"
-            
-            if info.get('process'):
-                if info['process'].poll() is None:
-                    process_status = "In esecuzione"
-                    is_running = True
-                else:
-                    process_status = f"Terminato (codice: {info['process'].returncode})"
-                    # Se il processo è terminato ma il record esiste ancora, consideralo non attivo qui
-                    # La pulizia effettiva avverrà tramite check_expired o stop manuale
-            
-            # Se il tunnel non è in esecuzione, non ha senso parlare di scadenza attiva
-            expiration_timestamp = info.get('expiration_time') if is_running else None
-            time_remaining_seconds = None
-            if expiration_timestamp:
-                time_remaining_seconds = expiration_timestamp - current_time
-                if time_remaining_seconds < 0: # Se è scaduto ma non ancora pulito dal checker
-                    time_remaining_seconds = 0 
-                    # Potrebbe essere stato fermato dal checker tra questo calcolo e il prossimo ciclo
-                    # La visualizzazione mostrerà "scaduto" o 0s rimanenti.
-            
-            # Non includere tunnel che non hanno un processo o sono terminati
-            # O meglio, includili ma segnala il loro stato.
-            # Se un tunnel è in self.active_tunnels ma il processo è None o terminato,
-            # è uno stato transitorio o un residuo.
-            
-            # La logica in get_docker_services già aggiorna 'tunnel_active' e 'expiration_time'
-            # basandosi sullo stato corrente, qui arricchiamo per i tunnel *effettivamente gestiti*
-            
-            # Se il tunnel non è più in esecuzione, non dovrebbe avere un URL attivo o scadenza rilevante
-            if not is_running:
-                # Potremmo voler rimuovere il tunnel da active_tunnels se il processo è morto
-                # ma questo è gestito da check_expired_tunnels_periodically o da stop_tunnel
-                # Per ora, mostriamo lo stato come non in esecuzione
-                pass
-
-
-            active_tunnels_details.append({
-                'service_name': name,
-                'url': info.get('url') if is_running else None,
-                'port': info.get('port'),
-                'local_url': info.get('local_url'),
-                'process_status': process_status,
-                'is_running': is_running,
-                'start_time': info.get('start_time') if is_running else None,
-                'expiration_time': expiration_timestamp, # Timestamp UNIX
-                'time_remaining_seconds': time_remaining_seconds if expiration_timestamp else None
-            })
+    def stop_all_tunnels(self, reason="richiesta utente globale", wait=False, grace=STOP_GRACE_SECONDS, kill_wait=KILL_WAIT_SECONDS):
+        # All'arresto si ferma comunque quanto già caricato
+        if not self._shutdown_done and not self.wait_until_ready():
+            return False, STARTING_MESSAGE
+        logging.info(f"Stop tutti i tunnel (Motivo: {reason})...")
+        count, processes = 0, []
+        for name in self.registry.snapshot().tunnels:
+            with self.registry.lock(name):
+                try:
+                    found, process = self._detach_tunnel_locked(name, f"globale - {reason}")
+                except Exception as e:
+                    logging.error(f"Errore stop tunnel {name}: {e}", exc_info=True)
+                    continue
+            if found: count += 1
+            if process: processes.append(process)
+        if wait:
+            # Anche i processi ancora in chiusura dopo uno stop precedente rientrano nella scadenza comune
+            processes += [handle for handle in list(self.supervisor.manager.processes.values())
+                          if handle.poll() is None and handle not in processes]
+        # SIGTERM a tutti nello stesso momento, SIGKILL ai superstiti alla scadenza comune
+        future = self.supervisor.terminate(processes, grace, kill_wait, wait=False)
+        msg = f"Fermati {count} tunnel (Motivo: {reason})."
+        if wait and processes:
+            try:
+                result = future.result(grace + kill_wait + 1)
+                if result['killed'] or result['unresponsive']:
+                    msg += f" Forzati con SIGKILL: {result['killed']}, non terminati: {result['unresponsive']}."
+            except Exception as e:
+                logging.error(f"Errore terminazione tunnel: {e}")
+        logging.info(msg)
+        return True, msg
+
+    def tunnel_details(self, name, info, current_time=None):
+        current_time = current_time or time.time()
+        is_running = info.get('process') and info['process'].poll() is None
+        url_display = info.get('url')
+        # Non mostrare "Ricerca URL fallita" se il tunnel non è in esecuzione o è scaduto
+        if not is_running and url_display == "Ricerca URL fallita":
+            url_display = None # O l'ultimo URL valido se esisteva prima della terminazione
+
+        exp_time = info.get('expiration_time')
+        time_rem = None
+        if exp_time and is_running: time_rem = max(0, exp_time - current_time)
         
         return {
-            'services': self.get_docker_services(), # Questa ora include info di scadenza parziali
-            'active_tunnels': active_tunnels_details,
-            'active_tunnels_count': len([t for t in active_tunnels_details if t['is_running']]),
+            'service_name': name, 'url': url_display, 'port': info.get('port'),
+            'local_url': info.get('local_url'), 'is_running': bool(is_running), 'profile': info.get('profile'),
+            'expiration_time': exp_time, 'time_remaining_seconds': time_rem,
+            # origin_up/public_up cambiano la versione di stato; le latenze no (dati indicativi)
+            'origin_up': info.get('origin_up'), 'public_up': info.get('public_up'),
+            'probe': self.prober.get(name) if is_running else {},
+            # Cambia la versione di stato solo idle_timeout_minutes; l'attività è letta al momento (dati indicativi)
+            'idle_timeout_minutes': info.get('idle_timeout_minutes'),
+            'activity': self.idle_reaper.get(name) if is_running else None,
+            # Riavvii dopo un crash: prossimo tentativo, crash loop e durata dell'ultima interruzione
+            'restarts': info.get('restarts', 0), 'restart_at': info.get('restart_at'),
+            'crash_loop': bool(info.get('crash_loop')), 'crashed_at': info.get('crashed_at'),
+            'last_recovery_seconds': info.get('last_recovery_seconds')
+        }
+
+    def probe_targets(self):
+        targets = []
+        for name, info in self.registry.snapshot().tunnels.items():
+            process = info.get('process')
+            if not process or process.poll() is not None:
+                continue
+            targets.append(ProbeTarget(name, 'origin', info.get('local_url')))
+            if (info.get('url') or '').startswith('https://'):
+                targets.append(ProbeTarget(name, 'public', info['url']))
+        return targets
+
+    def sampled_processes(self):
+        return {name: info['process'].pid for name, info in self.registry.snapshot().tunnels.items()
+                if info.get('process') and info['process'].poll() is None}
+
+    def metrics_targets(self):
+        targets = {}
+        for name, info in self.registry.snapshot().tunnels.items():
+            process = info.get('process')
+            address = metrics_address(process.cmd) if process and process.poll() is None else None
+            if address:
+                targets[name] = address
+        return targets
+
+    def idle_targets(self):
+        targets = {}
+        for name, info in self.registry.snapshot().tunnels.items():
+            process = info.get('process')
+            if not process or process.poll() is not None:
+                continue
+            slot = info.get('pool_slot')
+            # I tunnel del pool si collegano al forwarder locale dello slot, non direttamente all'origine
+            host, port = ('127.0.0.1', slot.port) if slot else (self.local_ip, info.get('port'))
+            timeout_minutes = info.get('idle_timeout_minutes') or 0
+            targets[name] = IdleTarget(process.pid, host, port, timeout_minutes * 60)
+        return targets
+
+    def stop_idle_tunnel(self, service_name, pid, idle_seconds):
+        with self.registry.lock(service_name):
+            info = self.registry.get(service_name)
+            process = info.get('process') if info else None
+            if not process or process.pid != pid or process.poll() is not None:
+                return # Fermato o riavviato nel frattempo
+            logging.info(f"Tunnel {service_name} senza connessioni verso l'origine da {idle_seconds:.0f}s. Arresto...")
+            self.publish_tunnel_event('tunnel_idle', service_name)
+            self._stop_tunnel_locked(service_name, reason="idle")
+
+    def on_probe_change(self, service_name, kind, up):
+        with self.registry.lock(service_name):
+            if self.registry.update(service_name, **{f'{kind}_up': up}):
+                self.publish_tunnel_event('tunnel_health', service_name, reason=f"{kind} {'raggiungibile' if up else 'non raggiungibile'}")
+
+    def get_status(self, since=None):
+        """Stato completo, oppure con since= solo tunnel e servizi aggiunti, modificati o rimossi dopo quella versione.
+        Una versione sconosciuta (futura o di un'istanza precedente) restituisce lo stato completo."""
+        version = self.state_clock.read() # Letta per prima: le istantanee seguenti la contengono sicuramente
+        current_time = time.time()
+        tunnels = self.registry.snapshot()
+        inventory = self.service_inventory.snapshot()
+        status = {
+            'version': version,
             'local_ip': self.local_ip,
             'default_tunnel_duration_hours': DEFAULT_TUNNEL_DURATION_HOURS
         }
+        if since is None or not self.state_clock.origin <= since <= version:
+            status['services'] = inventory.services
+            status['active_tunnels'] = [
+                self.tunnel_details(name, info, current_time) for name, info in tunnels.tunnels.items()
+            ]
+            return status
+        services = {svc['name']: svc for svc in inventory.services}
+        changed_services = [name for name, changed in inventory.changed.items() if changed > since]
+        changed_tunnels = [name for name, changed in tunnels.changed.items() if changed > since]
+        status.update({
+            'since': since,
+            'services_changed': [services[name] for name in changed_services if name in services],
+            'services_removed': [name for name in changed_services if name not in services],
+            'tunnels_changed': [self.tunnel_details(name, tunnels.tunnels[name], current_time)
+                                for name in changed_tunnels if name in tunnels.tunnels],
+            'tunnels_removed': [name for name in changed_tunnels if name not in tunnels.tunnels]
+        })
+        return status
+
+    # --- API per app.py e per i client RPC: argomenti e risultati serializzabili in JSON ---
+
+    def status_version(self):
+        return self.state_clock.read()
+
+    def event_stream(self):
+        """Eventi per /api/events come (tipo, dati, id): istantanea iniziale (e dopo un overflow), poi i delta.
+        None = nessun evento entro il timeout, il chiamante invia un keep-alive."""
+        subscription = self.event_bus.subscribe()
+        try:
+            yield 'snapshot', self.get_status(), self.event_bus.sequence
+            while True:
+                if subscription.overflowed:
+                    subscription.overflowed = False
+                    while subscription.get(timeout=0): pass
+                    yield 'snapshot', self.get_status(), self.event_bus.sequence
+                event = subscription.get()
+                yield (event['type'], event['data'], event['id']) if event else None
+        finally:
+            self.event_bus.unsubscribe(subscription)
+
+    def read_logs(self, service_name, count=None, after=0, wait=None):
+        """Righe del buffer dei log con seq > after (le ultime `count`); con wait attende fino a `wait` secondi
+        che ne arrivino di nuove. None se il tunnel non ha un processo."""
+        info = self.registry.get(service_name)
+        process = info.get('process') if info else None
+        if not process:
+            return None
+        logs = process.logs
+        lines = logs.wait_for_lines(after, timeout=wait) if wait else logs.tail(count, after)
+        return {'pid': process.pid, 'lines': lines, 'sequence': logs.sequence, 'closed': logs.closed,
+                'returncode': process.returncode}
+
+    def tunnel_stats(self, service_name):
+        """Serie delle risorse del processo cloudflared; None se il tunnel non esiste."""
+        if service_name not in self.registry:
+            return None
+        stats = self.resource_sampler.get(service_name) or {'pid': None, 'error': None, 'samples': []}
+        return {'service_name': service_name, 'interval_seconds': self.resource_sampler.interval, **stats}
+
+    def readiness(self):
+        return {'ready': self.ready, 'phase': self.startup_phase, 'error': self.startup_error,
+                'startup_seconds': dict(self.startup_timings)}
+
+    def get_profiles(self):
+        return {'default_profile': self.default_profile, 'profiles': self.profiles,
+                'service_profiles': self.config_store.service_profiles()}
+
+    def pool_stats(self):
+        return self.tunnel_pool.get_stats()
+
+    def cloudflared_metrics_summary(self):
+        return self.cloudflared_metrics.summary()
+
+    def debug_info(self):
+        snapshot = self.registry.snapshot() # Vista coerente: conteggio e dettagli della stessa versione
+        return {
+            'registry_version': snapshot.version,
+            'active_tunnels_count': len(snapshot.tunnels),
+            'active_tunnels_details': {
+                name: {
+                    'url': info.get('url'),
+                    'port': info.get('port'),
+                    'is_running': info.get('process').poll() is None if info.get('process') else False,
+                    'edge_connections': getattr(info.get('process'), 'connections', None),
+                    'last_error': getattr(info.get('process'), 'last_error', None),
+                    'rate_limited': getattr(info.get('process'), 'rate_limited', None),
+                    'expiration': datetime.fromtimestamp(info.get('expiration_time')).isoformat() if info.get('expiration_time') else None
+                } for name, info in snapshot.tunnels.items()
+            },
+            'tunnel_pool': self.tunnel_pool.get_stats(),
+            'cloudflared_metrics': {
+                'interval_seconds': self.cloudflared_metrics.interval,
+                'rounds': self.cloudflared_metrics.rounds,
+                'last_round_seconds': self.cloudflared_metrics.last_round_seconds
+            },
+            'idle_reaper': {
+                'interval_seconds': self.idle_reaper.interval,
+                'tracked_tunnels': len(self.idle_reaper.activity),
+                'last_round_seconds': self.idle_reaper.last_round_seconds
+            },
+            'docker_inventory': {
+                'services_count': len(self.service_inventory.get_services()),
+                'last_sync_time': self.service_inventory.last_sync_time,
+                'events_received': self.service_inventory.events_received
+            }
+        }
 
-    def check_expired_tunnels_periodically(self):
-        """Controlla periodicamente i tunnel scaduti e li ferma."""
-        print("⏳ Avvio del controllore di scadenza tunnel...")
-        while not self.shutdown_event.is_set():
-            current_time = time.time()
-            # Iterare su una copia delle chiavi perché il dizionario potrebbe cambiare
-            for service_name in list(self.active_tunnels.keys()):
-                try:
-                    tunnel_info = self.active_tunnels.get(service_name)
-                    if not tunnel_info: # Potrebbe essere stato rimosso nel frattempo
-                        continue
+    def metrics_text(self):
+        return METRICS.render()
 
-                    # Controlla solo se il processo esiste ed è in esecuzione
-                    process = tunnel_info.get('process')
-                    if not process or process.poll() is not None: # Se non c'è processo o è terminato
-                        if service_name in self.active_tunnels: # Verifica se esiste ancora prima di cancellare
-                            print(f"🧹 Pulizia record tunnel non attivo o terminato: {service_name}")
-                            del self.active_tunnels[service_name]
-                            self.save_config() # Salva dopo la pulizia
-                        continue # Passa al prossimo
-
-                    expiration_time = tunnel_info.get('expiration_time')
-                    if expiration_time and current_time >= expiration_time:
-                        print(f"⌛ Tunnel per {service_name} è scaduto. Tentativo di arresto...")
-                        self.stop_tunnel_for_service(service_name, reason="scaduto automaticamente")
-                except KeyError:
-                    # Il tunnel potrebbe essere stato rimosso da un'altra operazione
-                    print(f"ℹ️ Tunnel {service_name} non trovato durante il controllo scadenza (già rimosso?).")
-                except Exception as e:
-                    print(f"❌ Errore durante il controllo di scadenza per {service_name}: {e}")
-            
-            # Aspetta un po' prima del prossimo controllo (es. ogni 60 secondi)
-            self.shutdown_event.wait(60) 
-        print("🛑 Controllore di scadenza tunnel fermato.")
-
-    def shutdown(self): # Metodo per fermare il thread del checker
-        print("🚦 Richiesta di arresto per UniversalTunnelManager...")
-        self.shutdown_event.set()
-        self.stop_all_tunnels(reason="arresto applicazione")
-        if self.expiration_checker_thread.is_alive():
-            self.expiration_checker_thread.join(timeout=5) # Attendi che il thread termini
-        print("🏁 UniversalTunnelManager arrestato.")
-
-
-# Istanza globale del manager
-tunnel_manager = UniversalTunnelManager()
-
-# Gestione dell'arresto pulito
-import atexit
-atexit.register(tunnel_manager.shutdown)
-
-@app.route('/')
-def index():
-    return render_template('universal.html')
-
-@app.route('/api/status')
-def api_status():
-    return jsonify(tunnel_manager.get_status())
-
-@app.route('/api/start-tunnel', methods=['POST'])
-def api_start_tunnel():
-    try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'message': 'Richiesta JSON non valida o vuota'}), 400
-            
-        service_name = data.get('service_name')
-        port_str = data.get('port')
-        duration_hours_str = data.get('duration_hours') # Nuovo parametro
-        
-        if not service_name or not port_str:
-            return jsonify({'success': False, 'message': 'Parametri mancanti: service_name e port sono richiesti'}), 400
-        
-        try:
-            port = int(port_str)
-            if not (0 < port < 65536):
-                raise ValueError("Porta non valida")
-        except ValueError:
-            return jsonify({'success': False, 'message': f"Porta non valida: '{port_str}'."}), 400
-
-        duration_hours = None
-        if duration_hours_str:
-            try:
-                duration_hours = float(duration_hours_str) # Permetti anche frazioni di ora, es. 0.5 per 30 min
-                if duration_hours <= 0:
-                    return jsonify({'success': False, 'message': 'La durata deve essere un numero positivo.'}), 400
-            except ValueError:
-                return jsonify({'success': False, 'message': f"Durata non valida: '{duration_hours_str}'. Deve essere un numero."}), 400
+
+    def schedule_expiration(self, service_name):
+        info = self.registry.get(service_name)
+        expiration_time = info.get('expiration_time')
+        deadline = expiration_time or time.time()
+        self.scheduler.schedule((service_name, 'expire'), deadline, self.expire_tunnel, service_name, expiration_time)
+        warn_at = deadline - EXPIRATION_WARNING_SECONDS
+        if warn_at > time.time():
+            self.scheduler.schedule((service_name, 'warn'), warn_at, self.warn_tunnel_expiring, service_name)
         else:
-            duration_hours = DEFAULT_TUNNEL_DURATION_HOURS # Usa il default se non specificato
-            
-        success, message = tunnel_manager.start_tunnel_for_service(service_name, port, duration_hours)
-        status_code = 200 if success else 500
-        if not success and ("già attivo" in message or "aggiornata" in message):
-             status_code = 200 # Se è già attivo e abbiamo aggiornato la scadenza, è un successo
-        elif not success:
-             status_code = 409 if "già attivo" in message else 500
-
-        return jsonify({'success': success, 'message': message}), status_code
-    except Exception as e:
-        print(f"Errore imprevisto in api_start_tunnel: {e}")
-        return jsonify({'success': False, 'message': f'Errore server: {str(e)}'}), 500
-
-# ... (api_stop_tunnel, api_stop_all, api_debug sono per lo più invariati, ma passano 'reason') ...
-
-@app.route('/api/stop-tunnel', methods=['POST'])
-def api_stop_tunnel():
-    try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'message': 'Richiesta JSON non valida o vuota'}), 400
-
-        service_name = data.get('service_name')
-        
-        if not service_name:
-            return jsonify({'success': False, 'message': 'Nome servizio (service_name) mancante'}), 400
-        
-        success, message = tunnel_manager.stop_tunnel_for_service(service_name, reason="richiesta API utente")
-        status_code = 200 if success else (404 if "Nessun tunnel attivo" in message else 500)
-        return jsonify({'success': success, 'message': message}), status_code
-    except Exception as e:
-        print(f"Errore imprevisto in api_stop_tunnel: {e}")
-        return jsonify({'success': False, 'message': f'Errore server: {str(e)}'}), 500
-
-@app.route('/api/stop-all', methods=['POST'])
-def api_stop_all():
-    try:
-        success, message = tunnel_manager.stop_all_tunnels(reason="richiesta API utente globale")
-        return jsonify({'success': success, 'message': message})
-    except Exception as e:
-        print(f"Errore imprevisto in api_stop_all: {e}")
-        return jsonify({'success': False, 'message': f'Errore server: {str(e)}'}), 500
-
-@app.route('/api/debug', methods=['GET'])
-def api_debug():
-    """API per debug - mostra info sui processi e configurazione"""
-    try:
-        debug_info = {
-            'timestamp': time.time(),
-            'local_ip': tunnel_manager.local_ip,
-            'config_file_path': tunnel_manager.config_file,
-            'default_tunnel_duration_hours': DEFAULT_TUNNEL_DURATION_HOURS,
-            'active_tunnels_manager_state': [],
-            'docker_services_detected': tunnel_manager.get_docker_services(), 
-            'cloudflared_processes_psutil': []
-        }
-        
-        current_time_debug = time.time()
-        for name, info in tunnel_manager.active_tunnels.items():
-            proc_info = info.get('process')
-            is_running_debug = proc_info.poll() is None if proc_info else False
-            exp_time = info.get('expiration_time')
-            time_rem_sec_debug = None
-            if exp_time and is_running_debug:
-                time_rem_sec_debug = exp_time - current_time_debug
-
-            debug_info['active_tunnels_manager_state'].append({
-                'service_name': name,
-                'port': info.get('port'),
-                'url': info.get('url'),
-                'local_url': info.get('local_url'),
-                'start_time': info.get('start_time'),
-                'expiration_time': exp_time,
-                'expiration_time_readable': datetime.fromtimestamp(exp_time).strftime('%Y-%m-%d %H:%M:%S') if exp_time else None,
-                'time_remaining_seconds': time_rem_sec_debug,
-                'process_pid': proc_info.pid if proc_info else None,
-                'process_running': is_running_debug,
-                'process_return_code': proc_info.returncode if proc_info and proc_info.poll() is not None else None
-            })
-        
-        for proc in psutil.process_iter(['pid', 'name', 'cmdline', 'status', 'create_time']):
-            try:
-                if 'cloudflared' in proc.info['name'].lower():
-                    debug_info['cloudflared_processes_psutil'].append({
-                        'pid': proc.info['pid'],
-                        'name': proc.info['name'],
-                        'cmdline': ' '.join(proc.info['cmdline'] if proc.info['cmdline'] else []),
-                        'status': proc.info['status'],
-                        'create_time': proc.info['create_time']
-                    })
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                pass
-        
-        try:
-            if os.path.exists(tunnel_manager.config_file):
-                with open(tunnel_manager.config_file, 'r') as f:
-                    debug_info['config_file_content'] = json.load(f)
+            self.scheduler.cancel((service_name, 'warn'))
+
+    def cancel_scheduled(self, service_name):
+        for kind in ('expire', 'warn', 'restart'):
+            self.scheduler.cancel((service_name, kind))
+
+    def expire_tunnel(self, service_name, expiration_time):
+        with self.registry.lock(service_name):
+            info = self.registry.get(service_name)
+            if not info or info.get('expiration_time') != expiration_time:
+                return # Fermato o esteso nel frattempo
+            process = info.get('process')
+            if process and process.poll() is None:
+                logging.info(f"Tunnel {service_name} scaduto. Arresto...")
+                self.publish_tunnel_event('tunnel_expired', service_name)
+                self._stop_tunnel_locked(service_name, reason="scaduto")
             else:
-                debug_info['config_file_content'] = "File non esistente."
-        except Exception as e:
-            debug_info['config_file_content_error'] = str(e)
-        
-        return jsonify(debug_info)
-    except Exception as e:
-        print(f"Errore in api_debug: {e}")
-        return jsonify({'error': str(e)}), 500
-
-
-if __name__ == '__main__':
-    print("🚀 Avvio Universal Cloudflare Tunnel Manager con Scadenza")
-    host_ip_for_display = tunnel_manager.local_ip if tunnel_manager.local_ip != "127.0.0.1" else "localhost"
-    print(f"🐍 Versione Python: {socket.sys.version}")
-    print(f"📦 Percorso script: {os.path.dirname(os.path.abspath(__file__))}")
-    print(f"🏠 Directory dati: {tunnel_manager.data_dir}")
-    print(f"⚙️ File configurazione: {tunnel_manager.config_file}")
-    print(f"⏱️ Durata tunnel default: {DEFAULT_TUNNEL_DURATION_HOURS} ore")
-    print(f"🖥️  Interfaccia Web disponibile su: http://{host_ip_for_display}:5001")
-    
-    # In sviluppo con thread, use_reloader=False può essere più stabile.
-    # Per produzione, debug=False.
-    try:
-        app.run(host='0.0.0.0', port=5001, debug=True, use_reloader=False) # use_reloader=False è importante con thread e atexit
-    except KeyboardInterrupt:
-        print("\n⌨️ Interruzione da tastiera ricevuta. Arresto in corso...")
-    finally:
-        tunnel_manager.shutdown() # Assicura che il cleanup avvenga
\ No newline at end of file
+                logging.info(f"Pulizia record tunnel non attivo/terminato: {service_name}")
+                self.registry.remove(service_name)
+                self.save_config(service_name)
+                TUNNEL_STOPS.inc('cleanup')
+                self.publish_tunnel_event('tunnel_stopped', service_name, reason="pulizia")
+
+    def warn_tunnel_expiring(self, service_name):
+        info = self.registry.get(service_name)
+        if info and info.get('process') and info['process'].poll() is None:
+            self.publish_tunnel_event('tunnel_expiring', service_name)
+
+    def shutdown(self):
+        with self._shutdown_lock: # Chiamato sia dal gestore di SIGTERM sia da atexit
+            if self._shutdown_done:
+                return
+            self._shutdown_done = True
+        started = time.monotonic()
+        logging.info(f"Arresto UniversalTunnelManager (budget {SHUTDOWN_BUDGET_SECONDS:.0f}s)...")
+        # Circa un secondo resta per salvataggio finale e thread; il resto va ai processi cloudflared
+        kill_wait = min(KILL_WAIT_SECONDS, SHUTDOWN_BUDGET_SECONDS / 4)
+        grace = max(0.5, min(STOP_GRACE_SECONDS, SHUTDOWN_BUDGET_SECONDS - kill_wait - 1))
+        if self.startup_thread and self.startup_thread.is_alive():
+            # L'avvio si interrompe alla fase successiva; la fase in corso (es. elenco Docker) può durare ancora un po'
+            self.startup_thread.join(timeout=SHUTDOWN_BUDGET_SECONDS / 4)
+        self.prober.stop()
+        self.cloudflared_metrics.stop()
+        self.resource_sampler.stop()
+        self.idle_reaper.stop()
+        # Prima il pool: niente nuovi slot durante l'arresto; i suoi processi rientrano nella scadenza comune
+        self.tunnel_pool.stop(wait=KEEP_TUNNELS_ON_SHUTDOWN, grace=grace)
+        if KEEP_TUNNELS_ON_SHUTDOWN:
+            logging.info(f"Tunnel lasciati attivi per la riadozione al prossimo avvio: {len(self.registry)}")
+        else:
+            self.stop_all_tunnels(reason="arresto applicazione", wait=True, grace=grace, kill_wait=kill_wait)
+        if 'load_config' in self.startup_timings:
+            self.config_store.close() # Senza configurazione caricata il salvataggio finale la cancellerebbe
+        self.service_inventory.stop()
+        self.scheduler.stop()
+        if self.scheduler_thread.is_alive():
+            self.scheduler_thread.join(timeout=max(0.1, SHUTDOWN_BUDGET_SECONDS - (time.monotonic() - started)))
+        self.supervisor.stop()
+        logging.info(f"UniversalTunnelManager arrestato in {time.monotonic() - started:.2f}s.")
+
+
+def register_gauges(manager):
+    """Gauge di /metrics letti dal manager, registrati una volta per manager (app.py o tunneld.py); con un nuovo
+    manager nello stesso processo (altra app, test) le stesse famiglie passano a quello."""
+    if getattr(manager, 'gauges_registered', False):
+        return
+    manager.gauges_registered = True
+    def running_tunnels_count():
+        return sum(1 for info in manager.registry.snapshot().tunnels.values()
+                   if info.get('process') and info['process'].poll() is None)
+
+    METRICS.gauge('tunnel_manager_tunnels_running', "Tunnel con processo cloudflared in esecuzione", running_tunnels_count)
+    METRICS.gauge('tunnel_manager_tunnels_configured', "Tunnel nel registro (anche non in esecuzione)", lambda: len(manager.registry))
+    METRICS.gauge('tunnel_manager_threads', "Thread attivi nel processo del manager", threading.active_count)
+    METRICS.gauge('tunnel_manager_sse_subscribers', "Client connessi a /api/events", lambda: manager.event_bus.subscribers_count)
+    METRICS.gauge('tunnel_manager_probe_up', "Esito dell'ultimo controllo della sonda (1 raggiungibile, 0 no)", lambda: {
+        (name, kind): int(bool(stats.up)) for (name, kind), stats in list(manager.prober.stats.items()) if stats.up is not None
+    }, ['tunnel', 'target'])
+    METRICS.gauge('tunnel_manager_probe_latency_seconds', "Latenza mobile della sonda (ultimi campioni)", lambda: {
+        (name, kind, str(q)): percentile(list(stats.samples), q)
+        for (name, kind), stats in list(manager.prober.stats.items()) if stats.samples for q in (0.5, 0.95)
+    }, ['tunnel', 'target', 'quantile'])
+    def sampled_metric(field):
+        return lambda: {(name,): getattr(sample, field) for name, sample in manager.resource_sampler.latest().items()}
+
+    METRICS.gauge('tunnel_manager_tunnel_cpu_percent', "CPU del processo cloudflared (ultimo campione)", sampled_metric('cpu_percent'), ['tunnel'])
+    METRICS.gauge('tunnel_manager_tunnel_rss_bytes', "Memoria residente del processo cloudflared", sampled_metric('rss_bytes'), ['tunnel'])
+    METRICS.gauge('tunnel_manager_tunnel_open_fds', "Descrittori aperti dal processo cloudflared", sampled_metric('num_fds'), ['tunnel'])
+    METRICS.gauge('tunnel_manager_tunnel_threads', "Thread del processo cloudflared", sampled_metric('num_threads'), ['tunnel'])
+    METRICS.gauge('tunnel_manager_tunnel_io_bytes', "Byte letti/scritti dal processo cloudflared dall'avvio (rchar/wchar)", lambda: {
+        (name, direction): getattr(sample, f'{direction}_bytes')
+        for name, sample in manager.resource_sampler.latest().items() for direction in ('read', 'write')
+    }, ['tunnel', 'direction'])
+    # Serie "info" da unire alle metriche per tunnel (es. I/O) per confrontare i profili
+    METRICS.gauge('tunnel_manager_tunnel_profile', "Profilo cloudflared dei tunnel in esecuzione (valore sempre 1)", lambda: {
+        (name, info.get('profile') or ''): 1 for name, info in manager.registry.snapshot().tunnels.items()
+        if info.get('process') and info['process'].poll() is None
+    }, ['tunnel', 'profile'])
+    METRICS.gauge('tunnel_manager_tunnel_idle_seconds', "Secondi dall'ultima connessione di cloudflared verso l'origine", lambda: {
+        (name,): time.time() - activity.last_activity for name, activity in list(manager.idle_reaper.activity.items())
+    }, ['tunnel'])
+    METRICS.gauge('tunnel_manager_tunnel_crash_loop', "1 per i tunnel fermi in crash loop", lambda: {
+        (name,): 1 for name, info in manager.registry.snapshot().tunnels.items() if info.get('crash_loop')
+    }, ['tunnel'])
+    # Serie di cloudflared di tutti i tunnel, con l'etichetta tunnel
+    METRICS.register(manager.cloudflared_metrics)
+    METRICS.gauge('tunnel_manager_ready', "1 se l'avvio del manager è terminato senza errori", lambda: int(manager.ready))
+    METRICS.gauge('tunnel_manager_startup_seconds', "Durata delle fasi di avvio del manager", lambda: {
+        (phase,): seconds for phase, seconds in list(manager.startup_timings.items())}, ['phase'])
+    METRICS.gauge('tunnel_manager_pool_slots', "Slot del pool di tunnel per stato", lambda: {
+        (state,): manager.tunnel_pool.get_stats()[state] for state in ('ready', 'warming', 'bound')}, ['state'])
+
+
+def handle_termination_signal(signum, frame):
+    # docker stop invia SIGTERM al processo principale (PID 1, che senza gestore lo ignora):
+    # si esce dal server e l'arresto avviene nel blocco finally / atexit
+    logging.info(f"Ricevuto {signal.Signals(signum).name}. Arresto...")
+    raise SystemExit(0)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Pool di quick tunnel pre-avviati: ogni slot è un cloudflared già registrato (URL noto) che punta a un
+forwarder TCP locale del manager; all'avvio di un tunnel lo slot viene collegato alla porta del servizio
+"""
+
+import itertools
+import asyncio
+import logging
+import time
+import os
+from supervisor import POOL_SLOT_ENV, STOP_GRACE_SECONDS, build_tunnel_command
+from cloudflared_metrics import metrics_enabled, allocate_metrics_port
+
+TUNNEL_POOL_SIZE = int(os.environ.get('TUNNEL_POOL_SIZE', 0))                       # 0 = pool disattivato
+TUNNEL_POOL_REFILL_SECONDS = float(os.environ.get('TUNNEL_POOL_REFILL_SECONDS', 2))  # Intervallo minimo tra due avvii
+# Riassegnare lo slot di un tunnel fermato: il vecchio URL porterebbe a un altro servizio, per questo è opzionale
+TUNNEL_POOL_RECYCLE = os.environ.get('TUNNEL_POOL_RECYCLE', '').lower() in ('1', 'true', 'yes')
+FORWARD_CONNECT_TIMEOUT_SECONDS = 5
+FORWARD_BUFFER_SIZE = 64 * 1024
+
+UNAVAILABLE_RESPONSE = b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+BAD_GATEWAY_RESPONSE = b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+
+class PoolSlot:
+    def __init__(self, number):
+        self.number = number
+        self.key = f"pool-{number}"
+        self.server = None
+        self.port = None
+        self.handle = None
+        self.url = None
+        self.target = None       # (host, porta) del servizio collegato, None se libero
+        self.service_name = None
+        self.ready_time = None
+
+
+async def _pump(reader, writer):
+    try:
+        while True:
+            data = await reader.read(FORWARD_BUFFER_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (ConnectionError, OSError):
+        pass
+
+
+class TunnelPool:
+    """Gestito interamente nel loop del supervisore; i metodi sincroni sono per i thread di Flask."""
+
+    def __init__(self, supervisor, size=TUNNEL_POOL_SIZE, refill_seconds=TUNNEL_POOL_REFILL_SECONDS,
+                 recycle=TUNNEL_POOL_RECYCLE, profile=None):
+        self.supervisor = supervisor
+        self.profile = profile  # Opzioni cloudflared degli slot: il pool serve solo i tunnel con questo profilo
+        self.size = max(0, size)
+        self.refill_seconds = refill_seconds
+        self.recycle = recycle
+        self.warming = {}   # {numero: PoolSlot} in attesa dell'URL
+        self.ready = []     # Slot pronti, dal più vecchio
+        self.bound = {}     # {numero: PoolSlot} collegati a un servizio
+        self.stats = {'hits': 0, 'misses': 0, 'recycled': 0, 'retired': 0, 'failed': 0}
+        self._numbers = itertools.count(1)
+        self._changed = None
+        self._refill_task = None
+        self._stopped = False
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    # --- API sincrona ---
+
+    def start(self):
+        if self.enabled:
+            self.supervisor.call(self._start(), timeout=5)
+            logging.info(f"Pool tunnel attivo: {self.size} slot, un avvio ogni {self.refill_seconds}s, "
+                         f"riuso slot {'attivo' if self.recycle else 'disattivato'}")
+
+    def acquire(self, service_name, host, port):
+        """Collega uno slot pronto a host:port e lo restituisce; None se il pool è vuoto (miss)."""
+        if not self.enabled or self._stopped:
+            return None
+        return self.supervisor.call(self._acquire(service_name, host, port), timeout=5)
+
+    def release(self, slot):
+        self.supervisor.call(self._release(slot), timeout=5)
+
+    def stop(self, wait=False, grace=STOP_GRACE_SECONDS):
+        if self._refill_task is None:
+            return
+        handles = self.supervisor.call(self._stop(), timeout=5)
+        if handles:
+            if wait:
+                self.supervisor.terminate(handles, grace)
+            else:
+                self.supervisor.terminate(handles, wait=False)
+
+    def get_stats(self):
+        requests = self.stats['hits'] + self.stats['misses']
+        return {
+            'size': self.size,
+            'ready': len(self.ready),
+            'warming': len(self.warming),
+            'bound': len(self.bound),
+            **self.stats,
+            'hit_ratio': round(self.stats['hits'] / requests, 3) if requests else None,
+            'recycle': self.recycle
+        }
+
+    # --- Nel loop del supervisore ---
+
+    async def _start(self):
+        self._changed = asyncio.Event()
+        self._refill_task = asyncio.ensure_future(self._refill_loop())
+
+    async def _refill_loop(self):
+        while not self._stopped:
+            if len(self.ready) + len(self.warming) < self.size:
+                try:
+                    await self._spawn_slot()
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    logging.error(f"Pool tunnel: avvio slot fallito: {e}")
+                await asyncio.sleep(self.refill_seconds)  # Limite alla velocità di riempimento
+                continue
+            self._changed.clear()
+            await self._changed.wait()
+
+    async def _spawn_slot(self):
+        slot = PoolSlot(next(self._numbers))
+        slot.server = await asyncio.start_server(
+            lambda reader, writer: self._forward(slot, reader, writer), host='127.0.0.1', port=0)
+        slot.port = slot.server.sockets[0].getsockname()[1]
+        try:
+            slot.handle = await self.supervisor.manager.start_tunnel(
+                slot.key, build_tunnel_command(f"http://127.0.0.1:{slot.port}", self.profile,
+                                               allocate_metrics_port() if metrics_enabled() else None),
+                env={POOL_SLOT_ENV: str(slot.port)}, on_url=self._on_slot_url, on_exit=self._on_slot_exit)
+        except Exception:
+            slot.server.close()
+            raise
+        slot.handle.pool_slot = slot
+        self.warming[slot.number] = slot
+
+    async def _on_slot_url(self, handle, tunnel_url, label):
+        slot = handle.pool_slot
+        if self.warming.pop(slot.number, None) is None:
+            return
+        if tunnel_url and not self._stopped:
+            slot.url, slot.ready_time = tunnel_url, time.time()
+            self.ready.append(slot)
+            logging.info(f"Pool tunnel: {slot.key} pronto ({tunnel_url}) in {slot.ready_time - handle.start_time:.1f}s")
+        else:
+            self.stats['failed'] += 1
+            self._retire(slot)
+        self._changed.set()
+
+    async def _on_slot_exit(self, handle):
+        # Solo slot liberi: quelli collegati usano le callback del manager (crash del tunnel)
+        slot = handle.pool_slot
+        self.warming.pop(slot.number, None)
+        if slot in self.ready:
+            self.ready.remove(slot)
+            if not handle.stopping:
+                logging.warning(f"Pool tunnel: {slot.key} terminato mentre era in attesa.")
+        self._retire(slot)
+        self._changed.set()
+
+    async def _acquire(self, service_name, host, port):
+        while self.ready:
+            slot = self.ready.pop(0)
+            if slot.handle.poll() is not None:
+                self._retire(slot)
+                continue
+            slot.target, slot.service_name = (host, port), service_name
+            self.bound[slot.number] = slot
+            # Da qui il processo appartiene al tunnel del servizio: nome e callback del manager
+            self._rename(slot.handle, service_name)
+            slot.handle.on_url = slot.handle.on_exit = None
+            self.stats['hits'] += 1
+            self._changed.set()
+            logging.info(f"Pool tunnel: {slot.key} assegnato a {service_name} -> {host}:{port} ({slot.url})")
+            return slot
+        self.stats['misses'] += 1
+        return None
+
+    async def _release(self, slot):
+        if self.bound.pop(slot.number, None) is None:
+            return
+        slot.target, slot.service_name = None, None
+        if self.recycle and not self._stopped and slot.handle.poll() is None:
+            self._rename(slot.handle, slot.key)
+            slot.handle.on_url, slot.handle.on_exit = self._on_slot_url, self._on_slot_exit
+            slot.handle.stopping = False
+            self.ready.append(slot)
+            self.stats['recycled'] += 1
+            logging.info(f"Pool tunnel: {slot.key} restituito al pool ({slot.url})")
+        else:
+            self._retire(slot)
+        self._changed.set()
+
+    def _rename(self, handle, name):
+        processes = self.supervisor.manager.processes
+        if processes.get(handle.service_name) is handle:
+            del processes[handle.service_name]
+        handle.service_name = name
+        processes[name] = handle
+
+    def _retire(self, slot):
+        if slot.server is not None:
+            slot.server.close()
+            slot.server = None
+            self.stats['retired'] += 1
+        if slot.handle is not None and slot.handle.poll() is None and slot.number not in self.bound:
+            slot.handle.stopping = True
+            asyncio.ensure_future(self.supervisor.manager.terminate_many([slot.handle]))
+
+    async def _stop(self):
+        self._stopped = True
+        if self._refill_task:
+            self._refill_task.cancel()
+        slots = list(self.warming.values()) + self.ready + list(self.bound.values())
+        self.warming.clear()
+        self.ready.clear()
+        handles = []
+        for slot in slots:
+            if slot.server is not None:
+                slot.server.close()
+                slot.server = None
+            if slot.handle is not None and slot.handle.poll() is None:
+                slot.handle.stopping = True
+                handles.append(slot.handle)
+        return handles
+
+    async def _forward(self, slot, client_reader, client_writer):
+        target = slot.target
+        try:
+            if target is None:
+                client_writer.write(UNAVAILABLE_RESPONSE)  # Slot libero: nessun servizio collegato
+                return
+            try:
+                upstream_reader, upstream_writer = await asyncio.wait_for(
+                    asyncio.open_connection(*target), FORWARD_CONNECT_TIMEOUT_SECONDS)
+            except (OSError, asyncio.TimeoutError):
+                client_writer.write(BAD_GATEWAY_RESPONSE)
+                return
+            try:
+                await asyncio.gather(_pump(client_reader, upstream_writer), _pump(upstream_reader, client_writer))
+            finally:
+                upstream_writer.close()
+        finally:
+            client_writer.close()
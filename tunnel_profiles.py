@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Profili di prestazioni di cloudflared: insiemi nominati di opzioni (protocollo, connessioni HA, keep-alive e
+timeout verso l'origine) scelti per tunnel all'avvio
+"""
+
+import logging
+import json
+import os
+import re
+
+# File opzionale con profili aggiuntivi o ridefiniti: {"nome": {"protocol": "quic", "ha_connections": 4, ...}}
+PROFILES_FILE = os.environ.get('TUNNEL_PROFILES_FILE')
+DEFAULT_PROFILE = os.environ.get('TUNNEL_DEFAULT_PROFILE', 'default')  # Profilo dei tunnel avviati senza profile
+
+# Chiave del profilo -> opzione di cloudflared; l'ordine è quello della riga di comando
+PROFILE_OPTIONS = {
+    'protocol': '--protocol',                                       # auto, http2 o quic
+    'edge_ip_version': '--edge-ip-version',                         # auto, 4 o 6
+    'ha_connections': '--ha-connections',                           # Connessioni all'edge
+    'proxy_connect_timeout': '--proxy-connect-timeout',             # Timeout di connessione all'origine
+    'proxy_tcp_keepalive': '--proxy-tcp-keepalive',
+    'proxy_keepalive_connections': '--proxy-keepalive-connections', # Connessioni inattive tenute verso l'origine
+    'proxy_keepalive_timeout': '--proxy-keepalive-timeout',
+}
+INTEGER_OPTIONS = ('ha_connections', 'proxy_keepalive_connections')
+DURATION_OPTIONS = ('proxy_connect_timeout', 'proxy_tcp_keepalive', 'proxy_keepalive_timeout')
+CHOICES = {'protocol': ('auto', 'http2', 'quic'), 'edge_ip_version': ('auto', '4', '6')}
+DURATION_PATTERN = re.compile(r"^(\d+(\.\d+)?(ms|s|m|h))+$")  # Durate di Go: 500ms, 30s, 1m30s
+
+BUILTIN_PROFILES = {
+    # Opzioni usate finora per tutti i tunnel
+    'default': {'protocol': 'http2', 'edge_ip_version': 'auto'},
+    'quic': {'protocol': 'quic', 'edge_ip_version': 'auto'},
+    # Più connessioni all'edge e più connessioni riutilizzate verso l'origine, per servizi con molto traffico
+    'throughput': {'protocol': 'quic', 'edge_ip_version': 'auto', 'ha_connections': 4,
+                   'proxy_keepalive_connections': 256, 'proxy_keepalive_timeout': '2m'},
+    # Origini lente ad accettare connessioni (avvio a freddo, container sovraccarichi)
+    'slow-origin': {'protocol': 'http2', 'edge_ip_version': 'auto', 'proxy_connect_timeout': '90s',
+                    'proxy_tcp_keepalive': '15s'},
+}
+
+
+def validate_profile(options):
+    """Restituisce un messaggio di errore, oppure None se le opzioni sono valide."""
+    if not isinstance(options, dict):
+        return "il profilo deve essere un oggetto"
+    for key, value in options.items():
+        if key not in PROFILE_OPTIONS:
+            return f"opzione sconosciuta: {key}"
+        if key in INTEGER_OPTIONS:
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+                return f"{key} deve essere un intero positivo"
+        elif key in DURATION_OPTIONS:
+            if not isinstance(value, str) or not DURATION_PATTERN.match(value):
+                return f"{key} deve essere una durata come 30s o 1m30s"
+        elif str(value) not in CHOICES[key]:
+            return f"{key} deve essere uno tra {', '.join(CHOICES[key])}"
+    return None
+
+
+def load_profiles(path=PROFILES_FILE):
+    """Profili predefiniti più quelli del file; un profilo del file parte dalle opzioni di 'default'."""
+    profiles = {name: dict(options) for name, options in BUILTIN_PROFILES.items()}
+    if not path:
+        return profiles
+    try:
+        with open(path) as f:
+            custom = json.load(f)
+    except FileNotFoundError:
+        logging.warning(f"File dei profili {path} non trovato: solo profili predefiniti.")
+        return profiles
+    except (OSError, ValueError) as e:
+        logging.error(f"File dei profili {path} non leggibile: {e}")
+        return profiles
+    if not isinstance(custom, dict):
+        logging.error(f"File dei profili {path}: atteso un oggetto {{nome: opzioni}}.")
+        return profiles
+    for name, options in custom.items():
+        error = validate_profile(options)
+        if error:
+            logging.error(f"Profilo {name} ignorato: {error}")
+            continue
+        profiles[name] = {**BUILTIN_PROFILES['default'], **options}
+    logging.info(f"Profili cloudflared: {', '.join(sorted(profiles))}")
+    return profiles
+
+
+def profile_args(options):
+    """Argomenti di cloudflared per un profilo."""
+    args = []
+    for key, option in PROFILE_OPTIONS.items():
+        if options.get(key) is not None:
+            args += [option, str(options[key])]
+    return args
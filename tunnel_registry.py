@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Registro thread-safe dei tunnel attivi: lock per tunnel sulle modifiche, istantanee immutabili e versionate per le letture
+"""
+
+import collections
+import threading
+import time
+from types import MappingProxyType
+
+# Istantanea di sola lettura: version cresce a ogni modifica, tunnels è {nome: record immutabile},
+# changed è {nome: versione dell'ultima modifica}, anche per i tunnel rimossi (non più in tunnels)
+RegistrySnapshot = collections.namedtuple('RegistrySnapshot', ['version', 'tunnels', 'changed'])
+
+_ANY = object()
+
+
+class VersionClock:
+    """Versione di stato condivisa (registro tunnel e inventario Docker), crescente anche tra un riavvio e l'altro."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Parte dall'ora in millisecondi: una versione di un'istanza precedente è sempre più vecchia
+        self.origin = self.value = int(time.time() * 1000)
+
+    def tick(self, publish):
+        """Assegna una nuova versione e chiama publish(versione) prima di renderla visibile a read()."""
+        with self._lock:
+            self.value += 1
+            publish(self.value)
+            return self.value
+
+    def read(self):
+        # Con il lock: tutto ciò che ha versione <= del valore letto è già pubblicato
+        with self._lock:
+            return self.value
+
+
+class TunnelRegistry:
+    def __init__(self, clock=None):
+        self.clock = clock or VersionClock()
+        self._commit_lock = threading.Lock()   # Serializza solo lo scambio dell'istantanea (copy-on-write)
+        self._locks_guard = threading.Lock()
+        self._locks = {}                       # {nome: RLock} per le sequenze leggi-modifica-scrivi di un tunnel
+        self._snapshot = RegistrySnapshot(self.clock.origin, MappingProxyType({}), MappingProxyType({}))
+
+    # --- Letture: nessun lock, il riferimento all'istantanea viene sostituito in modo atomico ---
+
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def get(self, name):
+        return self._snapshot.tunnels.get(name)
+
+    def __contains__(self, name):
+        return name in self._snapshot.tunnels
+
+    def __len__(self):
+        return len(self._snapshot.tunnels)
+
+    # --- Modifiche ---
+
+    def lock(self, name):
+        """Lock rientrante del singolo tunnel: operazioni su tunnel diversi non si bloccano a vicenda."""
+        with self._locks_guard:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = self._locks[name] = threading.RLock()
+            return lock
+
+    def _commit(self, name, change, process):
+        """Applica change(record attuale) -> nuovo record (None = rimozione); restituisce (modificato, precedente)."""
+        with self._commit_lock:
+            tunnels = self._snapshot.tunnels
+            current = tunnels.get(name)
+            if current is None:
+                return False, None
+            if process is not _ANY and current.get('process') is not process:
+                return False, current  # Il record appartiene ormai a un altro processo
+            record = change(current)
+            updated = dict(tunnels)
+            if record is None:
+                del updated[name]
+            else:
+                updated[name] = MappingProxyType(record)
+            self._publish(name, updated)
+            return True, current
+
+    def _publish(self, name, tunnels):
+        # Chiamato con _commit_lock acquisito. I nomi rimossi restano in changed per i delta di /api/status:
+        # sono nomi di servizi, un insieme limitato
+        def swap(version):
+            changed = dict(self._snapshot.changed)
+            changed[name] = version
+            self._snapshot = RegistrySnapshot(version, MappingProxyType(tunnels), MappingProxyType(changed))
+        self.clock.tick(swap)
+
+    def put(self, name, record):
+        """Inserisce o sostituisce il record di un tunnel; restituisce il record immutabile."""
+        record = MappingProxyType(dict(record))
+        with self._commit_lock:
+            updated = dict(self._snapshot.tunnels)
+            updated[name] = record
+            self._publish(name, updated)
+        return record
+
+    def update(self, name, process=_ANY, **changes):
+        """Aggiorna alcuni campi; con process= solo se il record appartiene ancora a quel processo.
+        Restituisce il nuovo record, oppure None se non è stato aggiornato nulla."""
+        changed, _ = self._commit(name, lambda current: {**current, **changes}, process)
+        return self.get(name) if changed else None
+
+    def remove(self, name, process=_ANY):
+        """Rimuove il record (senza KeyError se già rimosso); restituisce il record rimosso o None."""
+        changed, previous = self._commit(name, lambda current: None, process)
+        return previous if changed else None
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Demone dei tunnel: un solo UniversalTunnelManager (processi cloudflared, scadenze, sonda, persistenza) servito
+via RPC su socket UNIX ai worker web senza stato
+
+Uso: python tunneld.py
+     TUNNEL_MANAGER_SOCKET=/app/data/tunneld.sock gunicorn -w 4 -k gthread --threads 16 -b 0.0.0.0:5001 "app:create_app()"
+"""
+
+import logging
+import signal
+import os
+from tunnel_manager import UniversalTunnelManager, DATA_DIR, register_gauges, handle_termination_signal
+from rpc import RPCServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(threadName)s] - %(message)s')
+
+SOCKET_PATH = os.environ.get('TUNNEL_MANAGER_SOCKET') or os.path.join(DATA_DIR, "tunneld.sock")
+
+
+def main():
+    logging.info("Avvio demone Universal Cloudflare Tunnel Manager")
+    signal.signal(signal.SIGTERM, handle_termination_signal)
+    tunnel_manager = UniversalTunnelManager()
+    register_gauges(tunnel_manager)
+    tunnel_manager.start() # In background: il socket risponde subito, gli avvii attendono la fine (readiness)
+    server = None
+    try:
+        server = RPCServer(tunnel_manager, SOCKET_PATH)
+        logging.info(f"Demone in ascolto su {SOCKET_PATH}")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Interruzione da tastiera. Arresto...")
+    finally:
+        if server:
+            server.server_close() # Prima il socket: i worker ricevono subito un errore invece di attendere
+        tunnel_manager.shutdown()
+
+
+if __name__ == '__main__':
+    main()